@@ -1,38 +1,141 @@
 # api_parser.py method to parse and extract data from Kaspi API
+import asyncio
 import json
 import os
 import random
 import re
+import time
 import uuid
 from decimal import Decimal
-from collections import defaultdict
-from datetime import datetime
-from typing import Literal, Any, Optional
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
+from typing import Literal, Any, AsyncIterator, Optional
 
 import aiohttp
 import asyncpg
 import pandas as pd
 import requests
-from aiohttp import ClientSession
 from fastapi import HTTPException, status
 from httpx import HTTPError
-from playwright.async_api import async_playwright, Page, Cookie
+from playwright.async_api import Page, Cookie
 
+from browser_pool import browser_pool
+from sms_session_store import SmsCapacityError, sms_session_store
 from db import create_pool
 from error_handlers import ErrorHandler, logger
+from http_client import get_session, KASPI_HOST, KASPI_MC_HOST
+from metrics import login_seconds, observe_error, stage_seconds
+from offer_cache import offer_cache
+from product_counts import product_counts
+from store_versions import bump_store_versions
+from price_publisher import price_publisher, PRICE_PUBLISH_MODE
+from rate_governor import rate_governor
+from session_registry import session_registry
+from session_refresher import login_claim, session_refresher
 from proxy_balancer import proxy_balancer
-from proxy_config import get_proxy_config
+from proxy_config import get_proxy_url as _proxy_url
 from utils import LoginError, get_product_count
 
 
-def _proxy_url(proxy_dict: Optional[dict] = None) -> Optional[str]:
-    cfg = get_proxy_config(proxy_dict)
-    return cfg.get('http') if cfg else None
+def _report_proxy_error(proxy_dict: Optional[dict], error: BaseException):
+    """Сетевой сбой/таймаут через прокси — в здоровье порта (HTTP-статусы репортятся при ответе)"""
+    if isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+        proxy_balancer.report(proxy_dict, error=True)
 
 
 OUTPUT_DIR = 'preorder_exports'
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# ── Проверка сессий ───────────────────────────────────────────────────────────
+SESSION_VALIDATION_TIMEOUT = float(os.getenv("SESSION_VALIDATION_TIMEOUT", "5"))  # сек на запрос /s/m
+SESSION_VERDICT_TTL = float(os.getenv("SESSION_VERDICT_TTL", "120"))  # сек, сколько верим результату проверки
+SESSION_VERDICT_MAX_SIZE = int(os.getenv("SESSION_VERDICT_MAX_SIZE", "5000"))  # вердиктов в кэше
+
+SESSION_CHECK_HEADERS = {
+    "x-auth-version": "3",
+    "Origin": "https://kaspi.kz",
+    "Referer": "https://kaspi.kz/",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/134.0.0.0 Safari/537.36 OPR/119.0.0.0",
+    "Accept": "application/json, text/plain, */*",
+    "Accept-Encoding": "gzip, deflate, br, zstd",
+    "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
+    "Cache-Control": "no-cache",
+    "Pragma": "no-cache",
+}
+
+# (merchant_uid, отпечаток cookies) -> (валидна ли сессия, time.monotonic() проверки);
+# LRU: после каждой смены cookies (перелогин, плановое обновление) прежний ключ больше
+# не читается и вытесняется, как в offer_cache
+_session_verdicts: "OrderedDict[tuple, tuple[bool, float]]" = OrderedDict()
+_revalidating: set[tuple] = set()
+_revalidation_tasks: set[asyncio.Task] = set()
+# один Playwright-логин на магазин, даже если сессию одновременно грузят несколько задач
+_reauth_locks: dict[str, asyncio.Lock] = {}
+
+validation_stats = {
+    "calls": 0,  # всего запросов вердикта
+    "cache_hits": 0,  # свежий вердикт из кэша
+    "stale_served": 0,  # отдан устаревший вердикт, проверка ушла в фон
+    "network_checks": 0,  # реальные запросы к /s/m
+    "timeouts": 0,
+    "errors": 0,
+    "remote_check_seconds": 0.0,  # суммарная длительность запросов /s/m из async-пути (не простой loop)
+    "sync_calls": 0,  # вызовы старого блокирующего is_session_valid
+    "sync_check_seconds": 0.0,  # суммарная длительность блокирующих проверок (из loop — его простой)
+    "evictions": 0,  # вердиктов вытеснено из кэша
+}
+
+
+def get_validation_stats() -> dict:
+    return {**validation_stats, "cached_verdicts": len(_session_verdicts)}
+
+
+def _verdict_key(merchant_uid: Optional[str], cookies: dict) -> tuple:
+    return merchant_uid, hash(tuple(sorted(cookies.items())))
+
+
+def _put_verdict(key: tuple, valid: bool):
+    _session_verdicts[key] = (valid, time.monotonic())
+    _session_verdicts.move_to_end(key)
+    while len(_session_verdicts) > SESSION_VERDICT_MAX_SIZE:
+        _session_verdicts.popitem(last=False)
+        validation_stats["evictions"] += 1
+
+
+def _remember_verdict(merchant_uid: Optional[str], cookies: dict, valid: bool):
+    _put_verdict(_verdict_key(merchant_uid, cookies), valid)
+
+
+async def _check_session_remote(cookies: dict, timeout: float) -> Optional[bool]:
+    """Запрос к /s/m через общий пул. None — Kaspi не ответил (таймаут/сеть)"""
+    validation_stats["network_checks"] += 1
+    started = time.monotonic()
+    try:
+        session = await get_session(KASPI_MC_HOST)
+        async with session.get("https://mc.shop.kaspi.kz/s/m", headers=SESSION_CHECK_HEADERS, cookies=cookies,
+                               timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            # 401 Unauthorized и прочие не-200 — сессия невалидна
+            return response.status == 200
+    except asyncio.TimeoutError:
+        validation_stats["timeouts"] += 1
+        logger.warning(f"Проверка сессии не уложилась в {timeout} сек")
+        return None
+    except aiohttp.ClientError as e:
+        validation_stats["errors"] += 1
+        logger.warning(f"Ошибка при проверке сессии: {e}")
+        return None
+    finally:
+        validation_stats["remote_check_seconds"] += time.monotonic() - started
+
+
+async def _revalidate(key: tuple, cookies: dict, timeout: float):
+    try:
+        verdict = await _check_session_remote(cookies, timeout)
+        if verdict is not None:
+            _put_verdict(key, verdict)
+    finally:
+        _revalidating.discard(key)
+
 
 class SessionManager:
     """Менеджер сессий для работы с cookies и авторизацией"""
@@ -43,23 +146,47 @@ class SessionManager:
         self.session_data = None
         self.last_login = None
         self.shop_uid = shop_uid
+        self.store_id = shop_uid  # id в kaspi_stores, известен после загрузки
         self.pool = None
 
     async def load(self):
         """Загружает данные сессии из базы данных и проверяет её актуальность"""
+        await self._load_session_data()
+
+        # Проверяем, актуальна ли сессия
+        if not await self.is_session_valid_async():
+            email, password = self.get_email_password()
+            if not email or not password:
+                # нет учётки -> пусть верхний уровень решает (демпер пропустит)
+                return False
+            if session_refresher.running:
+                # перелогин — дело фонового session_refresher, горячий путь не ждёт Playwright
+                session_refresher.request(self.store_id)
+                return False
+            # refresher в этом процессе не запущен (воркеры демпера) — логинимся сами,
+            # под тем же захватом, что и refresher других процессов
+            async with login_claim(self.store_id) as claimed:
+                if not claimed:
+                    # магазин сейчас логинит другой процесс — свежие cookies подхватит следующий load()
+                    return False
+                return await self.reauthorize()
+        return True
+
+    async def _load_session_data(self):
+        """Читает guid/merchant_id магазина из kaspi_stores"""
         if not self.pool:
             self.pool = await create_pool()  # Создаем пул соединений, если он еще не создан
 
         if self.shop_uid:
             query = """
-                    SELECT guid, merchant_id, last_login
+                    SELECT id, guid, merchant_id, last_login
                     FROM kaspi_stores
                     WHERE id = $1 \
                     """
             response = await self.pool.fetch(query, self.shop_uid)
         else:
             query = """
-                    SELECT guid, merchant_id, last_login
+                    SELECT id, guid, merchant_id, last_login
                     FROM kaspi_stores
                     WHERE user_id = $1
                       AND merchant_id = $2 \
@@ -69,8 +196,14 @@ class SessionManager:
         if not response:
             raise Exception("Магазин не найден")
 
-        guid_data = response[0]["guid"]
-        self.merchant_uid = response[0].get("merchant_id")
+        self.apply_row(response[0])
+
+    def apply_row(self, row):
+        """Заполняет сессию из строки kaspi_stores (id, guid, merchant_id, last_login)"""
+        guid_data = row["guid"]
+        self.merchant_uid = row.get("merchant_id")
+        self.store_id = str(row["id"])
+        self.last_login = row.get("last_login")
 
         # Проверяем, что guid является списком cookies или строкой
         if isinstance(guid_data, list):  # Если это список cookies
@@ -84,16 +217,6 @@ class SessionManager:
         else:
             self.session_data = guid_data
 
-        # Проверяем, актуальна ли сессия
-        if not self.is_session_valid():
-            # Если сессия невалидна, выполняем повторный логин
-            email, password = self.get_email_password()
-            if email and password:
-                return await self.reauthorize()
-            # нет учётки -> пусть верхний уровень решает (демпер пропустит)
-            return False
-        return True
-
     def get_cookies(self):
         """Возвращает cookies из сохраненной сессии"""
         if self.session_data:
@@ -115,8 +238,8 @@ class SessionManager:
             "email": email,
             "password": password
         }
-        # Добавляем метку времени последнего входа
-        self.last_login = datetime.now()
+        # Добавляем метку времени последнего входа (timestamptz — храним в UTC)
+        self.last_login = datetime.now(timezone.utc)
 
         if not self.pool:
             self.pool = await create_pool()  # Создаем пул соединений, если он ещё не создан
@@ -131,73 +254,128 @@ class SessionManager:
                     """
             await connection.execute(query, json.dumps(self.session_data), self.last_login, self.merchant_uid)
 
+        # только что залогинились — проверять эти cookies запросом не нужно
+        _remember_verdict(self.merchant_uid, get_formatted_cookies(cookies), True)
+
         return {
             "cookies": cookies,
             "email": email,
             "password": password
         }
 
-    def is_session_expired(self, session_timeout: int = 3600) -> bool:
-        """Проверяет, истекла ли сессия"""
+    def is_session_expired(self, session_timeout: float = 3600) -> bool:
+        """Проверяет, прошло ли с последнего входа больше session_timeout секунд"""
         if not self.last_login:
             return True
 
-        last_login_time = datetime.fromisoformat(self.last_login)
-        return (datetime.now() - last_login_time).seconds > session_timeout
+        # из базы приходит datetime (timestamptz), из старых guid — строка
+        last_login_time = self.last_login
+        if isinstance(last_login_time, str):
+            last_login_time = datetime.fromisoformat(last_login_time)
+        if last_login_time.tzinfo is None:
+            last_login_time = last_login_time.replace(tzinfo=timezone.utc)
+        # total_seconds, а не .seconds: у timedelta это остаток без дней
+        return (datetime.now(timezone.utc) - last_login_time).total_seconds() > session_timeout
 
     def is_session_valid(self) -> bool:
-        """Проверяет, действительна ли текущая сессия"""
+        """
+        Блокирующая проверка сессии. Из async-кода не вызывать — там есть
+        is_session_valid_async; длительность проверок — sync_check_seconds в validation_stats.
+        """
         cookies = self.get_cookies()
 
         if not cookies:
             return False
 
-        # Пример запроса для проверки сессии
+        validation_stats["sync_calls"] += 1
+        started = time.monotonic()
         try:
-            headers = {
-                "x-auth-version": "3",
-                "Origin": "https://kaspi.kz",
-                "Referer": "https://kaspi.kz/",
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/134.0.0.0 Safari/537.36 OPR/119.0.0.0",
-                "Accept": "application/json, text/plain, */*",
-                "Accept-Encoding": "gzip, deflate, br, zstd",
-                "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
-                "Cache-Control": "no-cache",
-                "Pragma": "no-cache",
-            }
-
-            response = requests.get("https://mc.shop.kaspi.kz/s/m", headers=headers, cookies=cookies)
-            if response.status_code != 200:
-                # print(response.status_code)
-                # print(response.text)
-                return False  # Если 401 Unauthorized, сессия невалидна
-            return True  # Если запрос успешен, сессия действительна
+            response = requests.get("https://mc.shop.kaspi.kz/s/m", headers=SESSION_CHECK_HEADERS, cookies=cookies,
+                                    timeout=SESSION_VALIDATION_TIMEOUT)
+            valid = response.status_code == 200  # Если 401 Unauthorized, сессия невалидна
+            _remember_verdict(self.merchant_uid, cookies, valid)
+            return valid
         except requests.RequestException as e:
             print(f"Ошибка при проверке сессии: {e}")
-            # traceback.print_exc()
             return False  # Если запрос не удался, сессия считается невалидной
+        finally:
+            validation_stats["sync_check_seconds"] += time.monotonic() - started
 
-    async def reauthorize(self):
-        """Повторная авторизация, если сессия невалидна"""
+    async def is_session_valid_async(self, timeout: float = SESSION_VALIDATION_TIMEOUT) -> bool:
+        """
+        Неблокирующая проверка сессии через общий HTTP-пул.
+        Свежий вердикт берётся из кэша; устаревший положительный отдаётся сразу,
+        а перепроверка уходит в фон. Сам запрос ограничен timeout.
+        """
+        cookies = self.get_cookies()
+
+        if not cookies:
+            return False
+
+        validation_stats["calls"] += 1
+        key = _verdict_key(self.merchant_uid, cookies)
+        cached = _session_verdicts.get(key)
+        if cached is not None:
+            _session_verdicts.move_to_end(key)
+            valid, checked_at = cached
+            if time.monotonic() - checked_at < SESSION_VERDICT_TTL:
+                validation_stats["cache_hits"] += 1
+                return valid
+            if valid:
+                validation_stats["stale_served"] += 1
+                if key not in _revalidating:
+                    _revalidating.add(key)
+                    task = asyncio.create_task(_revalidate(key, cookies, timeout))
+                    _revalidation_tasks.add(task)
+                    task.add_done_callback(_revalidation_tasks.discard)
+                return True
+
+        verdict = await _check_session_remote(cookies, timeout)
+        if verdict is None:
+            # Kaspi не ответил: держимся прежнего вердикта, без него считаем сессию невалидной
+            return cached[0] if cached is not None else False
+        _put_verdict(key, verdict)
+        return verdict
+
+    async def reauthorize(self, refresh_after: Optional[float] = None):
+        """
+        Повторная авторизация, если сессия невалидна.
+        refresh_after — плановое обновление: логинимся, даже если сессия ещё жива,
+        но только если с последнего входа прошло больше refresh_after секунд.
+        """
         # Получаем email и пароль из сохраненной сессии
         email, password = self.get_email_password()
         if not email or not password:
             print("Не удалось получить email и пароль из сохраненной сессии")
             return False
 
-        # Выполняем повторный логин
-        print("Сессия невалидна, требуется повторный логин")
-
-        # Пример выполнения повторного логина (вам нужно будет передать email и пароль)
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            context = await browser.new_context()
-            page = await context.new_page()
-
-            # Выполняем логин с новыми данными
-            success, cookies = await login_to_kaspi(page, email, password)
+        lock_key = str(self.merchant_uid or self.shop_uid)
+        lock = _reauth_locks.get(lock_key)
+        if lock is None:
+            lock = _reauth_locks[lock_key] = asyncio.Lock()
+
+        async with lock:
+            # пока ждали, соседняя задача могла уже перелогиниться и сохранить новые cookies
+            if self.shop_uid or self.merchant_uid:
+                await self._load_session_data()
+                if refresh_after is not None:
+                    if not self.is_session_expired(refresh_after):
+                        return True
+                elif await self.is_session_valid_async():
+                    return True
+                email, password = self.get_email_password()
+                if not email or not password:
+                    return False
+
+            # Выполняем повторный логин
+            print("Сессия невалидна, требуется повторный логин")
+
+            async with browser_pool.timed_login("reauthorize"), browser_pool.context() as context:
+                page = await context.new_page()
+
+                # Выполняем логин с новыми данными
+                success, cookies = await login_to_kaspi(page, email, password)
             await self.save(cookies, email, password)
-            await browser.close()
         return True
 
 
@@ -263,69 +441,66 @@ async def login_and_get_merchant_info(email: str, password: str, user_id: str) -
     session_manager = SessionManager(user_id)
 
     try:
-        # Выполняем логин и получаем cookies
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            context = await browser.new_context()
+        # Выполняем логин и получаем cookies; контекст браузера возвращаем сразу —
+        # дальше только HTTP-запросы
+        async with browser_pool.timed_login("password"), browser_pool.context() as context:
             page = await context.new_page()
 
             success, cookies = await login_to_kaspi(page, email, password)
 
-            # Преобразуем cookies в словарь для использования в aiohttp
-            cookies_dict = get_formatted_cookies(cookies)
-
-            # Сохраняем сессию
-            guid = await session_manager.save(cookies, email, password)
-
-            # Извлекаем информацию о магазине (merchant_id и shop_name)
-            headers = {
-                "x-auth-version": "3",
-                "Origin": "https://kaspi.kz",
-                "Referer": "https://kaspi.kz/",
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/134.0.0.0 Safari/537.36 OPR/119.0.0.0",
-                "Accept": "application/json, text/plain, */*",
-                "Accept-Encoding": "gzip, deflate, br, zstd",
-                "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
-                "Cache-Control": "no-cache",
-                "Pragma": "no-cache",
-            }
-
-            # Получаем список магазинов
-            async with aiohttp.ClientSession() as session:
-                async with session.get("https://mc.shop.kaspi.kz/s/m", headers=headers,
-                                       cookies=cookies_dict) as response:
-                    response_merchants = await response.json()
-
-                # Проверьте, что это список, и извлекайте merchant_uid
-                if isinstance(response_merchants.get('merchants'), list) and len(response_merchants['merchants']) > 0:
-                    merchant_uid = response_merchants['merchants'][0]['uid']
-                else:
-                    raise LoginError("Не удалось извлечь merchant_uid из ответа Kaspi")
-
-                # Получаем информацию о магазине по merchant_uid
-                payload = {
-                    "operationName": "getMerchant",
-                    "variables": {"id": merchant_uid},
-                    "query": """
-                        query getMerchant($id: String!) {
-                          merchant(id: $id) {
-                            id
-                            name
-                            logo {
-                              url
-                            }
-                          }
-                        }
-                    """
-                }
+        # Преобразуем cookies в словарь для использования в aiohttp
+        cookies_dict = get_formatted_cookies(cookies)
+
+        # Сохраняем сессию
+        guid = await session_manager.save(cookies, email, password)
+
+        # Извлекаем информацию о магазине (merchant_id и shop_name)
+        headers = {
+            "x-auth-version": "3",
+            "Origin": "https://kaspi.kz",
+            "Referer": "https://kaspi.kz/",
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/134.0.0.0 Safari/537.36 OPR/119.0.0.0",
+            "Accept": "application/json, text/plain, */*",
+            "Accept-Encoding": "gzip, deflate, br, zstd",
+            "Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
+            "Cache-Control": "no-cache",
+            "Pragma": "no-cache",
+        }
 
-                url_shop_info = "https://mc.shop.kaspi.kz/mc/facade/graphql?opName=getMerchant"
-                async with session.post(url_shop_info, json=payload, headers=headers,
-                                        cookies=cookies_dict) as response_shop_info:
-                    shop_info = await response_shop_info.json()
-                    shop_name = shop_info['data']['merchant']['name']
+        # Получаем список магазинов
+        session = await get_session(KASPI_MC_HOST)
+        async with session.get("https://mc.shop.kaspi.kz/s/m", headers=headers,
+                               cookies=cookies_dict) as response:
+            response_merchants = await response.json()
 
-            await browser.close()
+        # Проверьте, что это список, и извлекайте merchant_uid
+        if isinstance(response_merchants.get('merchants'), list) and len(response_merchants['merchants']) > 0:
+            merchant_uid = response_merchants['merchants'][0]['uid']
+        else:
+            raise LoginError("Не удалось извлечь merchant_uid из ответа Kaspi")
+
+        # Получаем информацию о магазине по merchant_uid
+        payload = {
+            "operationName": "getMerchant",
+            "variables": {"id": merchant_uid},
+            "query": """
+                query getMerchant($id: String!) {
+                  merchant(id: $id) {
+                    id
+                    name
+                    logo {
+                      url
+                    }
+                  }
+                }
+            """
+        }
+
+        url_shop_info = "https://mc.shop.kaspi.kz/mc/facade/graphql?opName=getMerchant"
+        async with session.post(url_shop_info, json=payload, headers=headers,
+                                cookies=cookies_dict) as response_shop_info:
+            shop_info = await response_shop_info.json()
+            shop_name = shop_info['data']['merchant']['name']
 
         return cookies, merchant_uid, shop_name, guid
 
@@ -336,26 +511,20 @@ async def login_and_get_merchant_info(email: str, password: str, user_id: str) -
 async def sync_store_api(store_id: str):
     """Синхронизация товаров для указанного магазина"""
 
-    # Загружаем сессию магазина по store_id
-    session_manager = SessionManager(shop_uid=store_id)
-    if not await session_manager.load():
+    # Берём проверенную сессию магазина из реестра
+    store_session = await session_registry.get(store_id)
+    if not store_session:
         raise HTTPException(status_code=401,
                             detail="Сессия истекла или отсутствуют учётные данные. Нужен повторный логин.")
 
     # Извлекаем cookies и merchant_id
-    cookies = session_manager.get_cookies()
+    cookies = store_session.cookies
     if not cookies:
         raise HTTPException(status_code=400, detail="Cookies для сессии не найдены")
 
-    # Получение товаров для магазина
-    merchant_id = session_manager.merchant_uid
-    products = await get_products(cookies, merchant_id)
-    
-    current_count = len(products)
-    
     pool = await create_pool()
     async with pool.acquire() as conn:
-        user_id_result = await conn.fetchrow(
+        store_exists = await conn.fetchrow(
             """
             SELECT user_id
             FROM kaspi_stores
@@ -363,31 +532,43 @@ async def sync_store_api(store_id: str):
             """,
             store_id
         )
-    
-    if not user_id_result:
+
+    if not store_exists:
         raise HTTPException(status_code=404, detail="Магазин не найден")
-    user_id = user_id_result["user_id"]
-    current_product_count = await get_product_count(store_id)
-    
-    # Убираем ограничения по подписке - разрешаем неограниченное количество товаров
-    max_products = 1000
 
-    current_count = len(products)
+    # Получение товаров для магазина: пишем в БД пачками, пока следующие страницы ещё качаются
+    merchant_id = store_session.merchant_uid
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    fetched = 0
+    pending: list[dict] = []
 
-    # Получаем пул соединений
-    pool = await create_pool()
+    async def flush():
+        chunk_counts = await bulk_upsert_products(pending, store_id, pool)
+        for key, value in chunk_counts.items():
+            counts[key] += value
+        pending.clear()
 
-    # Вставка товаров, если они не существуют в базе данных
-    for product in products:
-        await insert_product_if_not_exists(product, store_id, pool)
+    try:
+        async for batch in get_products(cookies, merchant_id):
+            fetched += len(batch)
+            pending.extend(batch)
+            if len(pending) >= SYNC_UPSERT_CHUNK_SIZE:
+                await flush()
+    except HTTPError:
+        # 401 от Kaspi — cookies протухли, следующий вызов перезагрузит сессию
+        session_registry.invalidate(store_id)
+        raise
+    if pending:
+        await flush()
+    if counts["inserted"]:
+        product_counts.adjust(store_id, counts["inserted"])
+    if counts["inserted"] or counts["updated"]:
+        await bump_store_versions([store_id])
 
     # Обновление количества товаров и метки времени синхронизации
-    update_data = {
-        "products_count": current_count + current_product_count,
-        "last_sync": datetime.now(),
-    }
-
     try:
+        products_count = await count_store_products(store_id, pool)
+        last_sync = datetime.now()
         async with pool.acquire() as connection:
             # Обновление данных в таблице kaspi_stores
             await connection.execute(
@@ -397,18 +578,104 @@ async def sync_store_api(store_id: str):
                     last_sync      = $2
                 WHERE id = $3
                 """,
-                update_data["products_count"], update_data["last_sync"], store_id
+                products_count, last_sync, store_id
             )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка обновления данных: {str(e)}")
 
+    logger.info(f"🔁 [SYNC] Магазин {store_id}: получено {fetched}, {counts}, всего в БД {products_count}")
+
     return {
         "success": True,
-        "products_count": update_data["products_count"],
+        "products_count": products_count,
+        **counts,
         "message": "Товары успешно синхронизированы"
     }
 
 
+SYNC_UPSERT_CHUNK_SIZE = int(os.getenv("SYNC_UPSERT_CHUNK_SIZE", "1000"))  # строк на один INSERT
+
+# Один запрос на пачку: строки приходят массивами через unnest, существующие товары
+# обновляются только если изменились цена/категория/картинка. xmax = 0 у вставленных строк.
+BULK_UPSERT_PRODUCTS_SQL = """
+    INSERT INTO products (kaspi_product_id, kaspi_sku, store_id, price, name, external_kaspi_id, category, image_url)
+    SELECT t.kaspi_product_id, t.kaspi_sku, $8::uuid, t.price, t.name, t.external_kaspi_id, t.category, t.image_url
+    FROM unnest($1::text[], $2::text[], $3::numeric[], $4::text[], $5::text[], $6::text[], $7::text[])
+             AS t(kaspi_product_id, kaspi_sku, price, name, external_kaspi_id, category, image_url)
+    ON CONFLICT (kaspi_sku, store_id) DO UPDATE
+        SET price     = EXCLUDED.price,
+            category  = EXCLUDED.category,
+            image_url = EXCLUDED.image_url
+        WHERE (products.price, products.category, products.image_url)
+                  IS DISTINCT FROM (EXCLUDED.price, EXCLUDED.category, EXCLUDED.image_url)
+    RETURNING (xmax = 0) AS inserted
+"""
+
+
+def _as_text(value) -> Optional[str]:
+    return None if value is None else str(value)
+
+
+def _as_price(value):
+    # minPrice из offer-view — число; всё остальное (нет цены) пишем как NULL
+    return value if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool) else None
+
+
+async def bulk_upsert_products(products: list[dict], store_id: str, pool=None,
+                               chunk_size: int = SYNC_UPSERT_CHUNK_SIZE) -> dict:
+    """
+    Пишет каталог магазина в products пачками по chunk_size строк (INSERT … ON CONFLICT
+    (kaspi_sku, store_id) DO UPDATE … WHERE изменилось). Требует миграцию 004.
+    :return: {"inserted": …, "updated": …, "unchanged": …}
+    """
+    if not pool:
+        pool = await create_pool()
+
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+
+    if not isinstance(pool, asyncpg.Pool):
+        # Supabase-адаптер не умеет произвольный SQL — старый построчный путь
+        for product in products:
+            result = await insert_product_if_not_exists(product, store_id, pool)
+            counts["inserted" if result else "unchanged"] += 1
+        return counts
+
+    # одинаковый SKU дважды в одном INSERT … ON CONFLICT недопустим — оставляем последний
+    unique_products = list({p["kaspi_sku"]: p for p in products if p.get("kaspi_sku")}.values())
+    store_id = str(store_id)
+
+    for i in range(0, len(unique_products), chunk_size):
+        chunk = unique_products[i:i + chunk_size]
+        async with pool.acquire() as connection:
+            rows = await connection.fetch(
+                BULK_UPSERT_PRODUCTS_SQL,
+                [_as_text(p.get("kaspi_product_id")) for p in chunk],
+                [_as_text(p["kaspi_sku"]) for p in chunk],
+                [_as_price(p.get("price")) for p in chunk],
+                [p.get("name") for p in chunk],
+                [_as_text(p.get("external_kaspi_id")) for p in chunk],
+                [p.get("category") for p in chunk],
+                [p.get("image_url") for p in chunk],
+                store_id,
+            )
+        inserted = sum(1 for r in rows if r["inserted"])
+        counts["inserted"] += inserted
+        counts["updated"] += len(rows) - inserted
+        counts["unchanged"] += len(chunk) - len(rows)
+
+    return counts
+
+
+async def count_store_products(store_id: str, pool=None) -> int:
+    """Количество товаров магазина в БД — источник для kaspi_stores.products_count"""
+    if not pool:
+        pool = await create_pool()
+    if not isinstance(pool, asyncpg.Pool):
+        return await get_product_count(store_id)
+    async with pool.acquire() as connection:
+        return await connection.fetchval("SELECT COUNT(*) FROM products WHERE store_id = $1", store_id)
+
+
 async def insert_product_if_not_exists(product: dict, store_id: str, pool=None):
     product["store_id"] = store_id
 
@@ -477,17 +744,72 @@ async def insert_product_if_not_exists(product: dict, store_id: str, pool=None):
         return False
 
 
-async def get_products(cookie_jar: dict, merchant_uid: str, page_size: int = 100) -> list[dict]:
+CATALOG_PREFETCH_PAGES = int(os.getenv("CATALOG_PREFETCH_PAGES", "3"))  # страниц offer-view/list параллельно на продавца
+
+# общий бюджет запросов каталога на продавца: параллельные синхронизации одного магазина делят его
+_catalog_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+def _catalog_semaphore(merchant_uid: str, limit: int) -> asyncio.Semaphore:
+    semaphore = _catalog_semaphores.get(merchant_uid)
+    if semaphore is None:
+        semaphore = _catalog_semaphores[merchant_uid] = asyncio.Semaphore(limit)
+    return semaphore
+
+
+async def _fetch_offers_page(session: aiohttp.ClientSession, merchant_uid: str, page: int, page_size: int,
+                             headers: dict, cookie_jar: dict, proxy_dict: Optional[dict],
+                             semaphore: asyncio.Semaphore) -> list[dict]:
+    """Одна страница /bff/offer-view/list -> список сырых офферов"""
+    url = (
+        f"https://mc.shop.kaspi.kz/bff/offer-view/list"
+        f"?m={merchant_uid}&p={page}&l={page_size}&a=true"
+    )
+    logger.info(f"🌐 [PRODUCTS] Запрос страницы {page}: {url}")
+
+    async with semaphore:
+        await rate_governor.acquire("catalog")
+        started = time.monotonic()
+        try:
+            response = await session.get(url, headers=headers, cookies=cookie_jar, proxy=_proxy_url(proxy_dict))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            _report_proxy_error(proxy_dict, err)
+            raise
+        proxy_balancer.report(proxy_dict, status=response.status, latency=time.monotonic() - started)
+        async with response:
+            logger.info(f"📊 [PRODUCTS] Ответ страницы {page}: статус {response.status}")
+
+            if response.status == 401:
+                logger.error(f"❌ [PRODUCTS] Ошибка авторизации: 401 Unauthorized")
+                raise HTTPError("Ошибка аутентификации: 401 Unauthorized")
+
+            if response.status == 429:
+                logger.error(f"❌ [PRODUCTS] Превышен лимит запросов: 429 Too Many Requests")
+                rate_limit_error = Exception("Too Many Requests from Kaspi API")
+                rate_limit_error.status_code = 429
+                raise rate_limit_error
+
+            response.raise_for_status()
+
+            data = await response.json()
+            return data.get('data', [])
+
+
+async def get_products(cookie_jar: dict, merchant_uid: str, page_size: int = 100,
+                       prefetch: int = CATALOG_PREFETCH_PAGES) -> AsyncIterator[list[dict]]:
     """
-    Получает все товары продавца по пагинации асинхронно, с прокси и авторизацией.
+    Отдаёт товары продавца пачками (по странице) по мере загрузки, с прокси и авторизацией.
+    Следующие prefetch страниц запрашиваются параллельно; пачки идут строго по порядку страниц.
+    Пагинация заканчивается на первой пустой странице.
 
     :param cookie_jar: словарь с куки для аутентификации
     :param merchant_uid: уникальный идентификатор продавца
     :param page_size: количество товаров на страницу (максимум 100)
-    :return: список всех предложений
+    :param prefetch: сколько страниц держать в полёте одновременно
+    :return: асинхронный генератор списков предложений
     """
     logger.info(f"🔍 [PRODUCTS] Начинаем получение товаров для merchant_uid: {merchant_uid}")
-    logger.info(f"📦 [PRODUCTS] Размер страницы: {page_size}")
+    logger.info(f"📦 [PRODUCTS] Размер страницы: {page_size}, параллельно страниц: {prefetch}")
     
     headers = {
         "x-auth-version": "3",
@@ -504,63 +826,30 @@ async def get_products(cookie_jar: dict, merchant_uid: str, page_size: int = 100
         "Cache-Control": "no-cache",
         "Pragma": "no-cache",
     }
-    logger.info(f"📋 [PRODUCTS] Заголовки запроса: {headers}")
 
     # Получаем прокси через балансировщик
     proxy_dict = proxy_balancer.get_balanced_proxy(f"merchant_{merchant_uid}")
     proxy_url = _proxy_url(proxy_dict)
     logger.info(f"🔄 [PRODUCTS] Используем прокси: {proxy_url}")
 
-    all_offers = []
-    page = 0
+    prefetch = max(1, prefetch)
+    semaphore = _catalog_semaphore(merchant_uid, prefetch)
+    session = await get_session(KASPI_MC_HOST)
 
-    async with ClientSession() as session:
-        while True:
-            url = (
-                f"https://mc.shop.kaspi.kz/bff/offer-view/list"
-                f"?m={merchant_uid}&p={page}&l={page_size}&a=true"
-            )
-            logger.info(f"🌐 [PRODUCTS] Запрос страницы {page}: {url}")
+    def fetch(page_number: int) -> asyncio.Task:
+        return asyncio.create_task(_fetch_offers_page(
+            session, merchant_uid, page_number, page_size, headers, cookie_jar, proxy_dict, semaphore
+        ))
 
-            try:
-                # Асинхронный запрос с использованием aiohttp, прокси и авторизации
-                async with session.get(url, headers=headers, cookies=cookie_jar, proxy=proxy_url) as response:
-                    logger.info(f"📊 [PRODUCTS] Ответ страницы {page}: статус {response.status}")
-                    
-                    if response.status == 401:
-                        logger.error(f"❌ [PRODUCTS] Ошибка авторизации: 401 Unauthorized")
-                        raise HTTPError("Ошибка аутентификации: 401 Unauthorized")
-                    
-                    if response.status == 429:
-                        logger.error(f"❌ [PRODUCTS] Превышен лимит запросов: 429 Too Many Requests")
-                        rate_limit_error = Exception("Too Many Requests from Kaspi API")
-                        rate_limit_error.status_code = 429
-                        raise rate_limit_error
-
-                    response.raise_for_status()
-
-                    data = await response.json()
-                    offers = data.get('data', [])
-                    logger.info(f"📦 [PRODUCTS] Получено сырых офферов на странице {page}: {len(offers)}")
-
-                    # Если на странице нет офферов — выходим из цикла
-                    if not offers:
-                        logger.info(f"🏁 [PRODUCTS] Страница {page} пустая, завершаем пагинацию")
-                        break
-
-                    # Добавляем офферы в общий список
-                    processed_count = 0
-                    for o in offers:
-                        mapped_offer = map_offer(o)
-                        all_offers.append(mapped_offer)
-                        processed_count += 1
-                        logger.info(f"✅ [PRODUCTS] Обработан оффер {processed_count}: SKU={mapped_offer.get('kaspi_sku')}, название={mapped_offer.get('name', 'N/A')[:50]}...")
-
-                    logger.info(f"📊 [PRODUCTS] Получено {len(offers)} офферов на странице {page}")
-                    logger.info(f"📈 [PRODUCTS] Всего накоплено офферов: {len(all_offers)}")
-
-                    page += 1
+    in_flight: list[asyncio.Task] = [fetch(p) for p in range(prefetch)]
+    next_page = prefetch
+    page = 0
+    total = 0
 
+    try:
+        while in_flight:
+            try:
+                offers = await in_flight.pop(0)
             except HTTPError as http_err:
                 logger.error(f"❌ [PRODUCTS] Ошибка авторизации при получении офферов: {http_err}")
                 raise
@@ -568,8 +857,30 @@ async def get_products(cookie_jar: dict, merchant_uid: str, page_size: int = 100
                 logger.error(f"❌ [PRODUCTS] Ошибка при запросе офферов: {err}")
                 raise
 
-    logger.info(f"🎉 [PRODUCTS] Всего получено офферов: {len(all_offers)}")
-    return all_offers
+            logger.info(f"📦 [PRODUCTS] Получено сырых офферов на странице {page}: {len(offers)}")
+
+            # Если на странице нет офферов — дальше страниц нет
+            if not offers:
+                logger.info(f"🏁 [PRODUCTS] Страница {page} пустая, завершаем пагинацию")
+                break
+
+            # окно загрузки сдвигается до того, как потребитель начнёт писать пачку в БД
+            in_flight.append(fetch(next_page))
+            next_page += 1
+
+            batch = [map_offer(o) for o in offers]
+            total += len(batch)
+            logger.info(f"📈 [PRODUCTS] Всего получено офферов: {total}")
+            page += 1
+            yield batch
+    finally:
+        # пустая страница, ошибка или потребитель прервал итерацию — лишние запросы не нужны
+        for task in in_flight:
+            task.cancel()
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+    logger.info(f"🎉 [PRODUCTS] Всего получено офферов: {total}")
 
 
 def map_offer(raw_offer: dict) -> dict:
@@ -619,7 +930,7 @@ X_KS_CITY = [
 ]
 
 
-def get_random_headers(sku: str = None) -> dict:
+def get_random_headers(sku: str = None, city_id: str = None) -> dict:
     return {
         "accept": random.choice([
             "application/json, text/*",
@@ -628,18 +939,18 @@ def get_random_headers(sku: str = None) -> dict:
         "accept-encoding": random.choice(ACCEPT_ENCODINGS),
         "accept-language": random.choice(ACCEPT_LANGUAGE),
         "cache-control": random.choice(["no-cache", "max-age=0"]),
-        "connection": random.choice(["keep-alive", "close"]),
+        "connection": "keep-alive",
         "content-type": "application/json; charset=UTF-8",
         "host": "kaspi.kz",
         "origin": "https://kaspi.kz",
         "pragma": random.choice(["no-cache", ""]),
         "referer": f"https://kaspi.kz/shop/p/{sku}" if sku else "https://kaspi.kz/",
         "user-agent": random.choice(USER_AGENTS),
-        "x-ks-city": X_KS_CITY[0],
+        "x-ks-city": city_id or X_KS_CITY[0],
     }
 
 
-async def parse_product_by_sku(sku: str) -> list:
+async def parse_product_by_sku(sku: str, city_id: str = X_KS_CITY[0]) -> list:
     """Парсит данные о товаре по SKU через API Kaspi асинхронно"""
     logger.info(f"🔍 [PARSER] Начинаем парсинг товара SKU: {sku}")
     
@@ -648,12 +959,12 @@ async def parse_product_by_sku(sku: str) -> list:
     logger.info(f"🌐 [PARSER] URL запроса: {url}")
 
     # Заголовки для запроса
-    headers = get_random_headers(sku)
+    headers = get_random_headers(sku, city_id)
     logger.info(f"📋 [PARSER] Заголовки запроса: {headers}")
 
     # Тело запроса
     body = {
-        "cityId": "750000000",  # Убедитесь, что cityId корректный
+        "cityId": city_id,
         "id": sku,
         "merchantUID": [],
         "limit": 5,
@@ -672,41 +983,64 @@ async def parse_product_by_sku(sku: str) -> list:
         proxy_url = _proxy_url(proxy_dict)
         logger.info(f"🔄 [PARSER] Используем прокси: {proxy_url}")
 
-        # Создаем сессию для отправки запроса
-        async with aiohttp.ClientSession() as session:
-            logger.info(f"🚀 [PARSER] Отправляем POST запрос к Kaspi API...")
-            
-            # Отправляем POST запрос с аутентификацией прокси
-            async with session.post(url, json=body, headers=headers, proxy=proxy_url) as response:
-                logger.info(f"📊 [PARSER] Получен ответ: статус {response.status}")
-                
-                # Проверяем, что запрос прошел успешно
-                response.raise_for_status()  # В случае ошибки выбросит HTTPError
-
-                # Получаем данные из ответа
-                product_data = await response.json()
-                logger.info(f"📄 [PARSER] Получены данные товара: {len(str(product_data))} символов")
-                
-                # Парсим данные о ценах
-                parsed_offers = parse_merchant_price_from_offers(product_data)
-                logger.info(f"💰 [PARSER] Найдено предложений: {len(parsed_offers)}")
-                
-                if parsed_offers:
-                    prices = [offer.get('price', 0) for offer in parsed_offers]
-                    logger.info(f"💵 [PARSER] Цены конкурентов: {prices}")
-                    min_price = min(prices) if prices else 0
-                    logger.info(f"🏆 [PARSER] Минимальная цена: {min_price}")
-                
-                return parsed_offers
-
-    except aiohttp.ClientError as e:
+        # Берём общую keep-alive сессию для kaspi.kz
+        session = await get_session(KASPI_HOST)
+        logger.info(f"🚀 [PARSER] Отправляем POST запрос к Kaspi API...")
+
+        # Отправляем POST запрос с аутентификацией прокси
+        await rate_governor.acquire("offers")
+        started = time.monotonic()
+        async with session.post(url, json=body, headers=headers, proxy=proxy_url) as response:
+            proxy_balancer.report(proxy_dict, status=response.status, latency=time.monotonic() - started)
+            logger.info(f"📊 [PARSER] Получен ответ: статус {response.status}")
+
+            # Проверяем, что запрос прошел успешно
+            response.raise_for_status()  # В случае ошибки выбросит HTTPError
+
+            # Получаем данные из ответа: чтение тела — ещё стадия fetch, разбор — parse
+            raw = await response.read()
+            stage_seconds.observe(time.monotonic() - started, stage="fetch")
+            parse_started = time.monotonic()
+            product_data = json.loads(raw)
+            logger.info(f"📄 [PARSER] Получены данные товара: {len(raw)} байт")
+
+            # Парсим данные о ценах
+            parsed_offers = parse_merchant_price_from_offers(product_data)
+            stage_seconds.observe(time.monotonic() - parse_started, stage="parse")
+            logger.info(f"💰 [PARSER] Найдено предложений: {len(parsed_offers)}")
+
+            if parsed_offers:
+                prices = [offer.get('price', 0) for offer in parsed_offers]
+                logger.info(f"💵 [PARSER] Цены конкурентов: {prices}")
+                min_price = min(prices) if prices else 0
+                logger.info(f"🏆 [PARSER] Минимальная цена: {min_price}")
+
+            return parsed_offers
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        _report_proxy_error(proxy_dict, e)
+        observe_error("fetch", e)
         logger.error(f"❌ [PARSER] Ошибка HTTP запроса для SKU {sku}: {e}")
         return []
     except ValueError as ve:
+        # сюда же json.JSONDecodeError
+        observe_error("parse", ve)
         logger.error(f"❌ [PARSER] Ошибка обработки данных для SKU {sku}: {ve}")
         return []
 
 
+async def get_competitor_offers(external_kaspi_id: str, city_id: str = X_KS_CITY[0]) -> list:
+    """
+    Офферы конкурентов по мастер-товару через общий кэш.
+    Один и тот же external_kaspi_id у разных магазинов скрапится один раз за TTL.
+    """
+    external_kaspi_id = str(external_kaspi_id)
+    return await offer_cache.get_or_fetch(
+        (external_kaspi_id, city_id),
+        lambda: parse_product_by_sku(external_kaspi_id, city_id)
+    )
+
+
 def parse_merchant_price_from_offers(response_data: dict) -> list:
     """Парсит данные о продавцах и их ценах из ответа API Kaspi"""
     logger.info(f"🔍 [PARSER] Начинаем парсинг предложений из ответа API")
@@ -747,8 +1081,8 @@ def parse_merchant_price_from_offers(response_data: dict) -> list:
 
 
 # Метод для отправки запроса с обновлением информации о товаре
-async def send_price_update_request(product_data: dict, cookies: dict):
-    """Отправляет запрос на обновление цены и наличия товара по SKU асинхронно"""
+async def send_price_update_request(product_data: dict, cookies: dict) -> bool:
+    """Отправляет запрос на обновление цены и наличия товара по SKU асинхронно. True — Kaspi принял цену."""
 
     # URL API Kaspi для обновления информации о товаре
     url = "https://mc.shop.kaspi.kz/pricefeed/upload/merchant/process"
@@ -784,26 +1118,35 @@ async def send_price_update_request(product_data: dict, cookies: dict):
         proxy_dict = proxy_balancer.get_balanced_proxy(f"merchant_{merchant_id}")
         proxy_url = _proxy_url(proxy_dict)
 
-        # Создаем сессию для асинхронного запроса
-        async with aiohttp.ClientSession() as session:
-            # Отправляем POST запрос с cookies и прокси
-            async with session.post(url, json=body, headers=headers, cookies=cookies, proxy=proxy_url) as response:
-                # Проверяем, что запрос прошел успешно
-                response.raise_for_status()  # В случае ошибки выбросит HTTPError
-
-                # Получаем данные из ответа
-                response_data = await response.json()
-
-                # Логируем или обрабатываем ответ
-                if 'status' in response_data and response_data['status'] == 'success':
-                    print(f"Цена и наличие для товара {product_data['sku']} обновлены успешно.")
-                else:
-                    print(
-                        f"Не удалось обновить цену и наличие для товара {product_data['sku']}. Ответ: {response_data}")
+        # Берём общую keep-alive сессию для кабинета продавца
+        session = await get_session(KASPI_MC_HOST)
+        # Отправляем POST запрос с cookies и прокси
+        await rate_governor.acquire("cabinet_write")
+        started = time.monotonic()
+        async with session.post(url, json=body, headers=headers, cookies=cookies, proxy=proxy_url) as response:
+            proxy_balancer.report(proxy_dict, status=response.status, latency=time.monotonic() - started)
+            if response.status == 401 and product_data.get("store_id"):
+                # cookies магазина протухли — сбрасываем сессию в реестре
+                session_registry.invalidate(product_data["store_id"])
+
+            # Проверяем, что запрос прошел успешно
+            response.raise_for_status()  # В случае ошибки выбросит HTTPError
+
+            # Получаем данные из ответа
+            response_data = await response.json()
+
+            # Логируем или обрабатываем ответ
+            if 'status' in response_data and response_data['status'] == 'success':
+                print(f"Цена и наличие для товара {product_data['sku']} обновлены успешно.")
+                return True
+            print(
+                f"Не удалось обновить цену и наличие для товара {product_data['sku']}. Ответ: {response_data}")
+            return False
 
-    except aiohttp.ClientError as e:
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        _report_proxy_error(proxy_dict, e)
         print(f"Ошибка при запросе: {e}")
-        return {}
+        return False
 
 
 # Метод для извлечения данных товара из базы данных (через asyncpg)
@@ -824,7 +1167,7 @@ async def get_product_data_from_db(product_id):
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
             """
-            SELECT id, kaspi_product_id, price, store_id, kaspi_sku
+            SELECT id, kaspi_product_id, price, store_id, kaspi_sku, name
             FROM products
             WHERE id = $1
             """,
@@ -838,20 +1181,21 @@ async def get_product_data_from_db(product_id):
     if not store_id:
         raise HTTPException(status_code=400, detail="Не указан store_id для товара")
 
-    # Подтянем cookies/merchant через SessionManager по store_id
-    session_manager = SessionManager(shop_uid=str(store_id))
-    if not await session_manager.load():
+    # Подтянем cookies/merchant из реестра сессий по store_id
+    store_session = await session_registry.get(store_id)
+    if not store_session:
         # сессия протухла/не найдена
         return None, None
 
-    cookies = session_manager.get_cookies()
+    cookies = store_session.cookies
 
     # Сформируем структуру для обновления цены
     product_data = {
         "sku": row["kaspi_product_id"],  # SKU для каспи API (тот, что в pricefeed)
         "kaspi_sku": row["kaspi_sku"],  # наш SKU/артикул
         "price": float(row["price"]),  # текущая цена из БД
-        "merchant_id": session_manager.merchant_uid,
+        "name": row["name"],  # для файла цен (колонка model)
+        "merchant_id": store_session.merchant_uid,
         "store_id": str(store_id),
     }
 
@@ -859,8 +1203,13 @@ async def get_product_data_from_db(product_id):
 
 
 # Основной метод синхронизации товара по product_id
-async def sync_product(product_id: str, price: Decimal):
-    """Синхронизация товара для указанного product_id"""
+async def sync_product(product_id: str, price: Decimal, urgent: bool = False):
+    """
+    Синхронизация товара для указанного product_id.
+    В режиме PRICE_PUBLISH_MODE=batch цена уходит файлом вместе с другими изменениями
+    продавца; urgent=True публикует её сразу отдельным запросом.
+    confirmed=False в ответе — цена доставлена файлом, но Kaspi её не подтвердил.
+    """
 
     # Получаем данные товара из базы данных и cookies
     product_data, cookies = await get_product_data_from_db(product_id)
@@ -869,11 +1218,34 @@ async def sync_product(product_id: str, price: Decimal):
         raise HTTPException(status_code=400, detail="Cookies для сессии не найдены")
     product_data['price'] = float(price)
     # Отправляем запрос для обновления товара
-    await send_price_update_request(product_data, cookies)
+    if PRICE_PUBLISH_MODE == "batch":
+        outcome = await price_publisher.publish(product_data, cookies, send_price_update_request, urgent=urgent)
+    else:
+        success = await send_price_update_request(product_data, cookies)
+        outcome = {"sku": product_data["kaspi_sku"], "success": success, "submitted": success, "via": "single",
+                   "error": None if success else "Kaspi не принял цену"}
+
+    if not outcome["submitted"]:
+        return {
+            "success": False,
+            "message": f"Цена товара {product_id} не опубликована: {outcome['error']}",
+            "outcome": outcome,
+        }
+
+    if not outcome["success"]:
+        # цена ушла файлом: доставлена, но кабинет её не подтвердил
+        return {
+            "success": True,
+            "confirmed": False,
+            "message": f"Цена товара {product_id} отправлена в кабинет, подтверждения нет",
+            "outcome": outcome,
+        }
 
     return {
         "success": True,
-        "message": f"Товар {product_id} успешно синхронизирован"
+        "confirmed": True,
+        "message": f"Товар {product_id} успешно синхронизирован",
+        "outcome": outcome,
     }
 
 
@@ -991,40 +1363,43 @@ async def get_sells(shop_id):
     return True, get_sells_delivery_request(session_manager.merchant_uid, cookies)
 
 
-# Хранение активных SMS-сессий: session_id → { browser, context, page, user_id }
-sms_sessions: dict[str, dict] = {}
-
-
 async def sms_login_start(user_id: str, phone: str) -> str:
     """
-    Открываем Playwright, вводим phone → click send.
-    Возвращаем session_id и держим page открытой.
+    Берём контекст из общего браузера, вводим phone → click send.
+    Возвращаем session_id и держим page открытой в sms_session_store до ввода кода.
     """
+    try:
+        await sms_session_store.reserve()
+    except SmsCapacityError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
     session_id = str(uuid.uuid4())
-    p = await async_playwright().start()
-    browser = await p.chromium.launch(headless=True)  # Запускаем браузер в режиме видимости для тестов
-    context = await browser.new_context()
-    page: Page = await context.new_page()
+    try:
+        # вне лимита browser_pool: число SMS-контекстов ограничивает sms_session_store
+        lease = await browser_pool.acquire(bounded=False)
+    except Exception:
+        sms_session_store.cancel_reservation()
+        raise
+    try:
+        context = lease.context
+        page: Page = await context.new_page()
 
-    logger.info("Переход на страницу входа sms...")
-    await page.goto("https://idmc.shop.kaspi.kz/login")  # или реальный URL
-    await page.wait_for_load_state('domcontentloaded')
-    await page.wait_for_selector('#phone_tab', timeout=30000)
-    await page.click("#phone_tab")
+        logger.info("Переход на страницу входа sms...")
+        await page.goto("https://idmc.shop.kaspi.kz/login")  # или реальный URL
+        await page.wait_for_load_state('domcontentloaded')
+        await page.wait_for_selector('#phone_tab', timeout=30000)
+        await page.click("#phone_tab")
 
-    # Шаг 1: Ввод телефона
-    await page.wait_for_selector('#user_phone_field', timeout=30000)
-    await page.fill("#user_phone_field", phone)
+        # Шаг 1: Ввод телефона
+        await page.wait_for_selector('#user_phone_field', timeout=30000)
+        await page.fill("#user_phone_field", phone)
 
-    await page.click('.button.is-primary')
+        await page.click('.button.is-primary')
+    except Exception:
+        sms_session_store.cancel_reservation()
+        await browser_pool.release(lease)
+        raise
 
-    sms_sessions[session_id] = {
-        "playwright": p,
-        "browser": browser,
-        "context": context,
-        "page": page,
-        "user_id": user_id
-    }
+    sms_session_store.put(session_id, user_id, lease, page)
     return session_id
 
 
@@ -1035,13 +1410,11 @@ async def sms_login_verify(session_id: str, user_id: str, code: str):
     """
     Берём сохранённую сессию, вводим код, ждём входа, парсим merchant info.
     """
-    sess = sms_sessions.get(session_id)
-    if not sess:
-        raise HTTPException(404, "session_id не найден")
+    sess = sms_session_store.get(session_id)
+    if not sess or sess.user_id != user_id:
+        raise HTTPException(404, "session_id не найден или истёк")
 
-    page = sess["page"]
-    context = sess["context"]
-    p = sess["playwright"]
+    page = sess.page
     error_handler = ErrorHandler(page)
     # Ввод кода и ожидание
     await page.wait_for_selector('input[name="security-code"]', timeout=30000)
@@ -1064,8 +1437,10 @@ async def sms_login_verify(session_id: str, user_id: str, code: str):
     # Шаг 4: Ждём загрузки панели навигации
     await page.wait_for_selector('nav.navbar', timeout=30000)
     session_manager = SessionManager(user_id)
-    # Забираем куки
+    # Забираем куки; вход завершён — контекст возвращаем в пул
     cookies = await page.context.cookies()
+    login_seconds.observe(sess.age(), kind="sms", result="ok")
+    await sms_session_store.finish(session_id)
     # cookies: list[Cookie] = await context.cookies()
     cookies_dict = get_formatted_cookies(cookies)
     guid = await session_manager.save(cookies, None, None)
@@ -1082,14 +1457,15 @@ async def sms_login_verify(session_id: str, user_id: str, code: str):
         "Cache-Control": "no-cache",
         "Pragma": "no-cache",
     }
-    resp = requests.get(
+    session = await get_session(KASPI_MC_HOST)
+    async with session.get(
         "https://mc.shop.kaspi.kz/s/m",
         headers=headers,
         cookies=cookies_dict,
-        timeout=10
-    )
-    resp.raise_for_status()
-    merchants = resp.json().get("merchants", [])
+        timeout=aiohttp.ClientTimeout(total=10)
+    ) as resp:
+        resp.raise_for_status()
+        merchants = (await resp.json()).get("merchants", [])
     if not merchants:
         raise HTTPException(400, "Не удалось получить merchant_uid")
     merchant_uid = merchants[0]["uid"]
@@ -1104,20 +1480,16 @@ async def sms_login_verify(session_id: str, user_id: str, code: str):
           }
         """
     }
-    shop_info = requests.post(
+    async with session.post(
         "https://mc.shop.kaspi.kz/mc/facade/graphql?opName=getMerchant",
         json=payload,
         headers=headers,
         cookies=cookies_dict,
-        timeout=10
-    ).json()
+        timeout=aiohttp.ClientTimeout(total=10)
+    ) as resp:
+        shop_info = await resp.json()
     shop_name = shop_info["data"]["merchant"]["name"]
 
-    # Закрываем браузер
-    await sess["browser"].close()
-    await p.stop()
-    sms_sessions.pop(session_id, None)
-
     # Возвращаем куки-список, merchant_uid, shop_name
     return cookies, merchant_uid, shop_name, guid
 
@@ -1388,6 +1760,7 @@ async def create_preorder_from_product(
                 if inserted_id is None:
                     # Конфликт уникальности — уже есть заявка
                     return {"success": False, "status": "already_preordered", "product_id": str(product_id)}
+                await bump_store_versions([store_id], conn)
 
                 return {"success": True, "status": "success", "product_id": str(product_id)}
 
@@ -0,0 +1,243 @@
+# browser_pool.py
+# Один долгоживущий Chromium на процесс вместо async_playwright() → chromium.launch()
+# на каждый логин (секунды холодного старта и сотни МБ на вход).
+# Логины берут изолированный контекст (свои cookies/storage) из ограниченного пула:
+# одновременно не больше BROWSER_POOL_SIZE контекстов, остальные ждут в очереди
+# не дольше BROWSER_ACQUIRE_TIMEOUT. Браузер перезапускается после BROWSER_MAX_USES
+# выданных контекстов (старый закрывается, когда вернут его последние контексты)
+# и при падении (событие disconnected или провал проверки здоровья).
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+from playwright.async_api import Browser, BrowserContext, Playwright, async_playwright
+
+from metrics import browser_wait_seconds, login_seconds
+
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "3"))  # одновременных контекстов на процесс
+BROWSER_MAX_USES = int(os.getenv("BROWSER_MAX_USES", "50"))  # контекстов до перезапуска браузера
+BROWSER_ACQUIRE_TIMEOUT = float(os.getenv("BROWSER_ACQUIRE_TIMEOUT", "60"))  # сек ожидания свободного места
+BROWSER_HEALTH_INTERVAL = float(os.getenv("BROWSER_HEALTH_INTERVAL", "60"))  # сек между проверками
+BROWSER_HEADLESS = os.getenv("BROWSER_HEADLESS", "true").lower() in ("1", "true", "yes")
+
+logger = logging.getLogger(__name__)
+
+
+class BrowserPoolTimeout(Exception):
+    """Свободный контекст браузера не появился за BROWSER_ACQUIRE_TIMEOUT"""
+
+
+class BrowserLease:
+    """Выданный контекст; для SMS-входа живёт между запросами start и verify"""
+
+    __slots__ = ("context", "browser", "acquired_at", "bounded")
+
+    def __init__(self, context: BrowserContext, browser: Browser, bounded: bool = True):
+        self.context = context
+        self.browser = browser
+        self.acquired_at = time.monotonic()
+        self.bounded = bounded  # занимает место в пуле (False — лимит держит вызывающий)
+
+
+class BrowserPool:
+    def __init__(self, size: int = BROWSER_POOL_SIZE, max_uses: int = BROWSER_MAX_USES,
+                 acquire_timeout: float = BROWSER_ACQUIRE_TIMEOUT):
+        self.size = size
+        self.max_uses = max_uses
+        self.acquire_timeout = acquire_timeout
+        self._slots = asyncio.Semaphore(size)
+        self._launch_lock = asyncio.Lock()
+        self._playwright: Optional[Playwright] = None
+        self._browser: Optional[Browser] = None
+        self._uses = 0  # контекстов, выданных текущим браузером
+        self._active: Dict[Browser, int] = {}  # браузер -> выданные и не возвращённые контексты
+        self._health_task: Optional[asyncio.Task] = None
+        self._waiting = 0
+        # метрики
+        self.acquires = 0
+        self.timeouts = 0
+        self.launches = 0
+        self.recycles = 0
+        self.crashes = 0
+        self.health_failures = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    # ── Браузер ───────────────────────────────────────────────────────────────
+    async def _current_browser(self) -> Browser:
+        async with self._launch_lock:
+            if self._browser is not None and self._uses >= self.max_uses:
+                self.recycles += 1
+                logger.info(f"Браузер выдал {self._uses} контекстов — перезапуск")
+                self._retire(self._browser)
+            if self._browser is None or not self._browser.is_connected():
+                await self._launch()
+            self._uses += 1
+            return self._browser
+
+    async def _launch(self):
+        if self._playwright is None:
+            self._playwright = await async_playwright().start()
+        browser = await self._playwright.chromium.launch(headless=BROWSER_HEADLESS)
+        browser.on("disconnected", self._on_disconnected)
+        self._browser = browser
+        self._uses = 0
+        self._active.setdefault(browser, 0)
+        self.launches += 1
+        if self._health_task is None:
+            self._health_task = asyncio.create_task(self._health_loop())
+        logger.info(f"Chromium запущен (запуск №{self.launches})")
+
+    def _on_disconnected(self, browser: Browser):
+        if browser is self._browser:
+            # упал или убит снаружи — следующий acquire запустит новый
+            self.crashes += 1
+            self._browser = None
+            logger.warning("Chromium отключился — будет перезапущен при следующем входе")
+        self._active.pop(browser, None)
+
+    def _retire(self, browser: Browser):
+        """Новые контексты идут в свежий браузер; старый закрывается после возврата своих"""
+        if browser is self._browser:
+            self._browser = None
+        if not self._active.get(browser):
+            self._active.pop(browser, None)
+            asyncio.create_task(self._close_browser(browser))
+
+    async def _close_browser(self, browser: Browser):
+        try:
+            await browser.close()
+        except Exception as e:
+            logger.warning(f"Не удалось закрыть Chromium: {e}")
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(BROWSER_HEALTH_INTERVAL)
+            browser = self._browser
+            if browser is None:
+                continue
+            try:
+                # пустой контекст открывается за миллисекунды у живого браузера
+                context = await asyncio.wait_for(browser.new_context(), timeout=10)
+                await context.close()
+            except Exception as e:
+                self.health_failures += 1
+                logger.warning(f"Проверка Chromium не прошла ({e}) — перезапуск")
+                async with self._launch_lock:
+                    if browser is self._browser:
+                        self._browser = None
+                        self._active.pop(browser, None)
+                        await self._close_browser(browser)
+
+    # ── Контексты ─────────────────────────────────────────────────────────────
+    async def acquire(self, bounded: bool = True, **context_options) -> BrowserLease:
+        """
+        Ждёт место в пуле и выдаёт новый изолированный контекст; вернуть через release().
+        bounded=False — контекст вне лимита пула: для долгих SMS-входов, число которых
+        ограничивает sms_session_store, чтобы они не занимали места обычных логинов.
+        """
+        if bounded:
+            started = time.monotonic()
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout=self.acquire_timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise BrowserPoolTimeout(f"Нет свободного браузера за {self.acquire_timeout:.0f} сек")
+            finally:
+                self._waiting -= 1
+            waited = time.monotonic() - started
+            browser_wait_seconds.observe(waited)
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+
+        try:
+            browser = await self._current_browser()
+            context = await browser.new_context(**context_options)
+        except Exception:
+            if bounded:
+                self._slots.release()
+            raise
+        self._active[browser] = self._active.get(browser, 0) + 1
+        self.acquires += 1
+        return BrowserLease(context, browser, bounded)
+
+    async def release(self, lease: BrowserLease):
+        try:
+            await lease.context.close()
+        except Exception as e:
+            # браузер мог уже упасть вместе с контекстом
+            logger.debug(f"Контекст не закрылся: {e}")
+        finally:
+            if lease.bounded:
+                self._slots.release()
+            browser = lease.browser
+            if browser in self._active:
+                self._active[browser] -= 1
+                if browser is not self._browser:
+                    self._retire(browser)
+
+    @asynccontextmanager
+    async def context(self, **context_options):
+        lease = await self.acquire(**context_options)
+        try:
+            yield lease.context
+        finally:
+            await self.release(lease)
+
+    @asynccontextmanager
+    async def timed_login(self, kind: str):
+        """Длительность входа (password, reauthorize, sms) в login_seconds"""
+        started = time.monotonic()
+        result = "error"
+        try:
+            yield
+            result = "ok"
+        finally:
+            login_seconds.observe(time.monotonic() - started, kind=kind, result=result)
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        # до закрытия: штатное отключение не должно считаться падением
+        self._browser = None
+        for browser in list(self._active):
+            await self._close_browser(browser)
+        self._active.clear()
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+    def get_stats(self) -> Dict:
+        logins = {}
+        for labels in login_seconds.label_sets():
+            key = f"{labels['kind']}:{labels['result']}"
+            logins[key] = {
+                "count": login_seconds.count(**labels),
+                "p50": round(login_seconds.quantile(0.5, **labels) or 0.0, 2),
+                "p99": round(login_seconds.quantile(0.99, **labels) or 0.0, 2),
+            }
+        return {
+            "size": self.size,
+            "in_use": sum(self._active.values()),
+            "waiting": self._waiting,
+            "browser_alive": self._browser is not None and self._browser.is_connected(),
+            "browser_uses": self._uses,
+            "browsers_open": len(self._active),
+            "acquires": self.acquires,
+            "timeouts": self.timeouts,
+            "launches": self.launches,
+            "recycles": self.recycles,
+            "crashes": self.crashes,
+            "health_failures": self.health_failures,
+            "avg_wait": round(self.total_wait / self.acquires, 3) if self.acquires else 0.0,
+            "max_wait": round(self.max_wait, 3),
+            "logins": logins,
+        }
+
+
+browser_pool = BrowserPool()
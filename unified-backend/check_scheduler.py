@@ -0,0 +1,121 @@
+# check_scheduler.py
+# Адаптивный интервал проверки товара вместо одного CHECK_INTERVAL_SECONDS на всех.
+# Интервал считается из трёх наблюдений:
+#   - как часто меняется минимальная цена конкурентов (затухающий счётчик изменений
+#     price_change_score: при стабильной частоте λ он ≈ λ * CHECK_VOLATILITY_WINDOW);
+#   - держим ли мы сейчас самую низкую цену (если нет и можем опуститься — проверяем чаще);
+#   - сколько конкурентов (больше продавцов — больше шансов, что кто-то сдвинет цену).
+# Результат ограничен CHECK_INTERVAL_MIN..CHECK_INTERVAL_MAX. Новый товар стартует
+# с CHECK_INTERVAL_SECONDS и без изменений цены постепенно уходит к потолку.
+# Если набор конкурентов целиком не изменился (отпечаток repricing), интервал ещё
+# умножается на CHECK_STABLE_FACTOR.
+import math
+import os
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, NamedTuple, Optional
+
+CHECK_INTERVAL_SECONDS = int(os.getenv("CHECK_INTERVAL_SECONDS", "30"))  # стартовый интервал нового товара
+CHECK_INTERVAL_MIN = int(os.getenv("CHECK_INTERVAL_MIN", "10"))  # сек, пол
+CHECK_INTERVAL_MAX = int(os.getenv("CHECK_INTERVAL_MAX", "1800"))  # сек, потолок
+CHECK_VOLATILITY_WINDOW = float(os.getenv("CHECK_VOLATILITY_WINDOW", "21600"))  # сек памяти о смене цен
+CHECK_PER_PRICE_CHANGE = float(os.getenv("CHECK_PER_PRICE_CHANGE", "2"))  # проверок на одно изменение цены
+CHECK_LOSING_FACTOR = float(os.getenv("CHECK_LOSING_FACTOR", "0.5"))  # множитель, если мы не самые дешёвые
+CHECK_STABLE_FACTOR = float(os.getenv("CHECK_STABLE_FACTOR", "2"))  # множитель, если офферы конкурентов прежние
+
+
+class Schedule(NamedTuple):
+    next_check_at: datetime
+    interval: int  # сек
+    competitor_min_price: Optional[int]
+    competitor_count: Optional[int]
+    price_change_score: float
+    competitor_fingerprint: Optional[int] = None
+
+
+def _initial_score() -> float:
+    # такой счётчик даёт ровно CHECK_INTERVAL_SECONDS без учёта конкурентов
+    return CHECK_VOLATILITY_WINDOW / (CHECK_INTERVAL_SECONDS * CHECK_PER_PRICE_CHANGE)
+
+
+def compute_interval(price_change_score: float, competitor_count: Optional[int], losing: bool,
+                     stable: bool = False) -> int:
+    """Интервал до следующей проверки, сек"""
+    if not competitor_count:
+        # демпинговать не с кем — следующая проверка только чтобы заметить новых продавцов
+        return CHECK_INTERVAL_MAX
+    rate = price_change_score / CHECK_VOLATILITY_WINDOW  # изменений в секунду
+    interval = 1.0 / (rate * CHECK_PER_PRICE_CHANGE) if rate > 0 else float(CHECK_INTERVAL_MAX)
+    interval /= 1.0 + math.log(competitor_count)
+    if losing:
+        interval *= CHECK_LOSING_FACTOR
+    elif stable:
+        interval *= CHECK_STABLE_FACTOR
+    return int(min(max(interval, CHECK_INTERVAL_MIN), CHECK_INTERVAL_MAX))
+
+
+class CheckScheduler:
+    def __init__(self):
+        self.scheduled = 0
+        self.price_changes = 0
+        self.losing = 0
+        self.stable = 0
+        self.at_floor = 0
+        self.at_ceiling = 0
+        self.total_interval = 0
+
+    def schedule(self, product, checked_at: datetime, min_offer_price: Optional[Decimal] = None,
+                 competitor_count: Optional[int] = None, our_price: Optional[Decimal] = None,
+                 min_profit: Decimal = Decimal('0.00'), fingerprint: Optional[int] = None,
+                 stable: bool = False) -> Schedule:
+        """
+        product — строка из очереди (competitor_min_price, price_change_score, last_check_time).
+        Без наблюдения (ошибка запроса) — интервал по прежнему счётчику, снимок конкурентов не трогаем.
+        stable — отпечаток офферов (fingerprint) совпал с прошлой проверкой.
+        """
+        previous_min = product.get("competitor_min_price")
+        score = product.get("price_change_score")
+        if score is None:
+            score = _initial_score()
+        last_check = product.get("last_check_time")
+        if last_check is not None:
+            elapsed = max((checked_at - last_check).total_seconds(), 0.0)
+            score *= math.exp(-elapsed / CHECK_VOLATILITY_WINDOW)
+
+        losing = False
+        observed_min = None
+        if competitor_count is None:
+            competitor_count = product.get("competitor_count")
+        elif min_offer_price is not None:
+            observed_min = int(min_offer_price)
+            if previous_min is not None and observed_min != previous_min:
+                score += 1.0
+                self.price_changes += 1
+            # дороже лидера и есть куда опускаться — ценовая война, смотрим чаще
+            losing = our_price is not None and our_price > min_offer_price and min_offer_price - 1 >= min_profit
+
+        interval = compute_interval(score, competitor_count, losing, stable)
+        self.scheduled += 1
+        self.losing += losing
+        self.stable += stable
+        self.at_floor += interval <= CHECK_INTERVAL_MIN
+        self.at_ceiling += interval >= CHECK_INTERVAL_MAX
+        self.total_interval += interval
+        return Schedule(checked_at + timedelta(seconds=interval), interval, observed_min, competitor_count, score,
+                        fingerprint)
+
+    def get_stats(self) -> Dict:
+        return {
+            "scheduled": self.scheduled,
+            "price_changes": self.price_changes,
+            "losing": self.losing,
+            "stable": self.stable,
+            "at_floor": self.at_floor,
+            "at_ceiling": self.at_ceiling,
+            "avg_interval": round(self.total_interval / self.scheduled, 1) if self.scheduled else 0.0,
+            "min_interval": CHECK_INTERVAL_MIN,
+            "max_interval": CHECK_INTERVAL_MAX,
+        }
+
+
+check_scheduler = CheckScheduler()
@@ -28,6 +28,12 @@ class Settings(BaseSettings):
     POSTGRES_DB: str = Field(default="kaspi_demper", env="POSTGRES_DB")
     POSTGRES_USER: str = Field(default="postgres", env="POSTGRES_USER")
     POSTGRES_PASSWORD: str = Field(default="", env="POSTGRES_PASSWORD")
+    POSTGRES_POOL_MIN_SIZE: int = Field(default=10, env="POSTGRES_POOL_MIN_SIZE")
+    POSTGRES_POOL_MAX_SIZE: int = Field(default=50, env="POSTGRES_POOL_MAX_SIZE")
+    POSTGRES_MAX_QUERIES: int = Field(default=50000, env="POSTGRES_MAX_QUERIES")  # после N запросов соединение пересоздаётся
+    POSTGRES_STATEMENT_CACHE_SIZE: int = Field(default=1024, env="POSTGRES_STATEMENT_CACHE_SIZE")
+    POSTGRES_COMMAND_TIMEOUT: float = Field(default=30, env="POSTGRES_COMMAND_TIMEOUT")  # сек
+    DB_SLOW_QUERY_MS: float = Field(default=500, env="DB_SLOW_QUERY_MS")  # порог для warning в логе
     
     # Аутентификация
     AUTH_METHOD: str = Field(default="playwright", env="AUTH_METHOD")
@@ -1,18 +1,89 @@
 """
 @file: db.py
-@description: Адаптер для работы с Supabase через asyncpg-подобный интерфейс
-@dependencies: supabase, asyncio
+@description: Пул соединений с БД: asyncpg (DB_MODE=postgres) или адаптер Supabase с asyncpg-подобным интерфейсом
+@dependencies: asyncpg, supabase, asyncio
 @created: 2025-01-27
 """
 
 import asyncio
-from typing import Optional, Any, Dict, List
+import logging
+import re
+from typing import Optional, Any, Dict, List, Union
+
+import asyncpg
+
 from config import settings
 from supabase import create_client, Client
 
 _supabase_client: Optional[Client] = None
+_pg_pool: Optional[asyncpg.Pool] = None
 _lock = asyncio.Lock()
 
+logger = logging.getLogger(__name__)
+
+# ── Тайминг запросов (только postgres) ───────────────────────────────────────
+QUERY_STATS_MAX_KEYS = 500  # не даём статистике расти от динамически собранного SQL
+
+_query_stats: Dict[str, Dict[str, float]] = {}
+_whitespace_re = re.compile(r"\s+")
+
+
+def _query_key(query: str) -> str:
+    return _whitespace_re.sub(" ", query).strip()[:200]
+
+
+def _record_query(record: asyncpg.connection.LoggedQuery):
+    """Query logger asyncpg: вызывается после каждого запроса соединения"""
+    elapsed_ms = record.elapsed * 1000
+    key = _query_key(record.query)
+    stats = _query_stats.get(key)
+    if stats is None:
+        if len(_query_stats) >= QUERY_STATS_MAX_KEYS:
+            key = "<other>"
+            stats = _query_stats.get(key)
+        if stats is None:
+            stats = _query_stats[key] = {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+    stats["calls"] += 1
+    stats["total_ms"] += elapsed_ms
+    if elapsed_ms > stats["max_ms"]:
+        stats["max_ms"] = elapsed_ms
+    if record.exception is not None:
+        stats["errors"] += 1
+    if elapsed_ms >= settings.DB_SLOW_QUERY_MS:
+        logger.warning(f"Медленный запрос ({elapsed_ms:.0f} мс): {key}")
+
+
+async def _init_connection(conn: asyncpg.Connection):
+    conn.add_query_logger(_record_query)
+
+
+def get_query_stats(limit: int = 20) -> Dict[str, Any]:
+    """Самые дорогие по суммарному времени запросы + состояние пула"""
+    top = sorted(_query_stats.items(), key=lambda item: item[1]["total_ms"], reverse=True)[:limit]
+    pool_stats = None
+    if _pg_pool is not None and not _pg_pool._closed:
+        pool_stats = {
+            "size": _pg_pool.get_size(),
+            "idle": _pg_pool.get_idle_size(),
+            "min_size": _pg_pool.get_min_size(),
+            "max_size": _pg_pool.get_max_size(),
+        }
+    return {
+        "mode": settings.DB_MODE,
+        "pool": pool_stats,
+        "queries": [
+            {
+                "query": query,
+                "calls": int(stats["calls"]),
+                "errors": int(stats["errors"]),
+                "total_ms": round(stats["total_ms"], 1),
+                "avg_ms": round(stats["total_ms"] / stats["calls"], 2) if stats["calls"] else 0.0,
+                "max_ms": round(stats["max_ms"], 1),
+            }
+            for query, stats in top
+        ],
+    }
+
 
 class SupabaseConnection:
     """Адаптер для имитации asyncpg соединения через Supabase"""
@@ -99,11 +170,34 @@ class SupabasePool:
         pass
 
 
-async def create_pool() -> SupabasePool:
+async def _create_pg_pool() -> asyncpg.Pool:
+    return await asyncpg.create_pool(
+        host=settings.POSTGRES_HOST,
+        port=settings.POSTGRES_PORT,
+        database=settings.POSTGRES_DB,
+        user=settings.POSTGRES_USER,
+        password=settings.POSTGRES_PASSWORD,
+        min_size=settings.POSTGRES_POOL_MIN_SIZE,
+        max_size=settings.POSTGRES_POOL_MAX_SIZE,
+        max_queries=settings.POSTGRES_MAX_QUERIES,
+        # кэш подготовленных выражений на соединение; 0 — для pgbouncer в режиме transaction
+        statement_cache_size=settings.POSTGRES_STATEMENT_CACHE_SIZE,
+        command_timeout=settings.POSTGRES_COMMAND_TIMEOUT,
+        timeout=30,
+        init=_init_connection,
+    )
+
+
+async def create_pool() -> Union[asyncpg.Pool, SupabasePool]:
     """Возвращает пул соединений (синглтон). Пересоздаёт, если закрыт."""
-    global _supabase_client
+    global _supabase_client, _pg_pool
 
     async with _lock:  # защищаем от одновременного вызова
+        if settings.DB_MODE == "postgres":
+            if _pg_pool is None or _pg_pool._closed:
+                _pg_pool = await _create_pg_pool()
+            return _pg_pool
+
         if _supabase_client is None:
             # Создаем Supabase клиент
             _supabase_client = create_client(settings.SUPABASE_URL, settings.SUPABASE_KEY)
@@ -113,5 +207,8 @@ async def create_pool() -> SupabasePool:
 
 async def close_pool():
     """Закрыть пул соединений (на shutdown)."""
-    global _supabase_client
-    _supabase_client = None
\ No newline at end of file
+    global _supabase_client, _pg_pool
+    if _pg_pool is not None and not _pg_pool._closed:
+        await _pg_pool.close()
+    _pg_pool = None
+    _supabase_client = None
@@ -2,18 +2,36 @@
 import asyncio
 import logging
 import os
-import random
+import signal
 import time
+from datetime import datetime, timezone
 from decimal import Decimal
 
-from api_parser import parse_product_by_sku, sync_product, sync_store_api  # твои функции
-from db import create_pool  # должен возвращать asyncpg-пул
+from api_parser import X_KS_CITY, get_competitor_offers, get_validation_stats, sync_product, sync_store_api  # твои функции
+from browser_pool import browser_pool
+from check_scheduler import check_scheduler
+from db import create_pool, close_pool  # должен возвращать asyncpg-пул
+from http_client import close_http_clients
+from metrics import in_flight, observe_error, products_total, stage_seconds, start_metrics_server
+from offer_cache import offer_cache
+from price_log import PriceObservationLog
+from price_publisher import price_publisher
+from proxy_balancer import proxy_balancer
+from rate_governor import rate_governor
+from repricing import RepricingResult, repricing_engine
+from work_queue import ProductWorkQueue
+from write_behind import ProductWriteBuffer
 
 # ── Параметры шардирования ────────────────────────────────────────────────────
+# товары делятся через очередь с арендой (work_queue); индекс нужен только логам
+# и распределению синхронизации магазинов
 INSTANCE_INDEX = int(os.getenv("INSTANCE_INDEX", "0"))  # 0..N-1
 INSTANCE_COUNT = int(os.getenv("INSTANCE_COUNT", "1"))  # N
 ID_IS_UUID = os.getenv("ID_IS_UUID", "false").lower() in ("1", "true", "yes")
 SYNC_STORES_MODE = os.getenv("SYNC_STORES_MODE", "leader")  # "leader" | "shard"
+STORE_SYNC_INTERVAL = int(os.getenv("STORE_SYNC_INTERVAL", "600"))  # сек между синхронизациями магазинов
+DEMPER_LOG_FILE = os.getenv("DEMPER_LOG_FILE", "price_worker.log")  # супервизор даёт каждому воркеру свой
+DEMPER_STATS_INTERVAL = float(os.getenv("DEMPER_STATS_INTERVAL", "10"))  # сек между отчётами супервизору
 
 
 # ── Логи ──────────────────────────────────────────────────────────────────────
@@ -27,7 +45,7 @@ logging.getLogger().addFilter(NoHttpRequestFilter())
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s %(levelname)s [shard %(shard_idx)s/%(shard_cnt)s] %(message)s",
-    handlers=[logging.FileHandler("price_worker.log", encoding="utf-8"), logging.StreamHandler()]
+    handlers=[logging.FileHandler(DEMPER_LOG_FILE, encoding="utf-8"), logging.StreamHandler()]
 )
 
 
@@ -39,6 +57,11 @@ class ShardContext(logging.Filter):
         return True
 
 
+# на обработчиках, а не только на логгерах демпера: формат требует shard_idx
+# и у записей других модулей (write_behind, rate_governor, metrics ...)
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(ShardContext())
+
 logger = logging.getLogger("price_worker")
 logger.addFilter(ShardContext())
 
@@ -48,74 +71,117 @@ semaphore = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
 
 
 # ── Логика обработки товара ───────────────────────────────────────────────────
-async def process_product(product, clogger, pool):
-    """Обрабатывает данные о продукте и обновляет цену в БД"""
-    start_time = time.time()
-
+# Пачка обрабатывается в три фазы: офферы всех товаров запрашиваются параллельно,
+# новые цены считаются одним векторным проходом (repricing), затем публикуются
+# только изменённые цены.
+async def fetch_product_offers(product, clogger, claimed_at: float = None):
+    """Офферы товара; None — запрос упал с исключением (исход error)"""
     async with semaphore:
-        product_id = product["id"]
-        product_external_id = product["external_kaspi_id"]
-        sku = product["kaspi_sku"]
-        current_price = Decimal(product["price"])
-        min_profit = Decimal(product['min_profit']) if product['min_profit'] else Decimal('0.00')
+        if claimed_at is not None:
+            stage_seconds.observe(time.monotonic() - claimed_at, stage="queue_wait")
+        in_flight.inc()
         try:
-            product_data = await parse_product_by_sku(str(product_external_id))
-            if product_data and len(product_data):
-                min_offer_price = min(Decimal(offer["price"]) for offer in product_data)
+            return await get_competitor_offers(product["external_kaspi_id"]) or []
+        except Exception as e:
+            observe_error("process", e)
+            clogger.error(f"Ошибка при обработке продукта [{product['kaspi_sku']}]: {e}", exc_info=False)
+            return None
+        finally:
+            in_flight.dec()
+
 
-                if current_price > max(min_offer_price, min_profit):
-                    new_price = min_offer_price - Decimal('1.00')
+async def apply_decision(product, offers, decision: RepricingResult, i: int, clogger,
+                         write_buffer: ProductWriteBuffer, started_at: float,
+                         price_log: PriceObservationLog = None):
+    """
+    Публикует новую цену товара i пачки (если изменилась и ещё не опубликована);
+    цена, время проверки и расписание уходят в буфер записи, а изменившийся
+    набор офферов — в журнал цен.
+    """
+    new_price = int(decision.new_price[i])
+    competitor_count = int(decision.competitor_count[i])
+    stable = bool(decision.stable[i])
+    product_id = product["id"]
+    sku = product["kaspi_sku"]
+    current_price = Decimal(product["price"])
+    min_profit = Decimal(product['min_profit']) if product['min_profit'] else Decimal('0.00')
+    written_price = None
+    published = False  # кабинет подтвердил written_price
+    # наблюдение для расписания: None — запрос не удался, интервал считаем по истории
+    observed_count = None
+    min_offer_price = None
+
+    if price_log is not None and offers and not stable:
+        price_log.add(product_id, product["external_kaspi_id"], X_KS_CITY[0], offers,
+                      product.get("merchant_id"), product["price"])
 
+    async with semaphore:
+        in_flight.inc()
+        outcome = "unchanged"
+        try:
+            if offers is None:
+                outcome = "error"
+            elif competitor_count:
+                observed_count = competitor_count
+                min_offer_price = Decimal(int(decision.competitor_min[i]))
+                if decision.skip[i]:
+                    # офферы прежние, цена уже отправлена в кабинет — повторно не публикуем
+                    outcome = "skipped"
+                elif decision.changed[i]:
                     # Синхронизация с внешней системой (если требуется)
-                    sync_result = await sync_product(product_id, new_price)
+                    with stage_seconds.time(stage="publish"):
+                        sync_result = await sync_product(product_id, Decimal(new_price))
 
                     if sync_result.get('success'):
-                        # Обновляем цену продукта в нашей БД
-                        async with pool.acquire() as connection:
-                            await connection.execute(
-                                """
-                                UPDATE products
-                                SET price = $1
-                                WHERE id = $2
-                                """,
-                                int(new_price), product_id
-                            )
-                        clogger.info(f"Демпер: OK [{sku}] -> {new_price}")
+                        written_price = new_price
+                        published = sync_result.get('confirmed', True)
+                        # submitted — ушла файлом без подтверждения, last_published_price не трогаем
+                        outcome = "changed" if published else "submitted"
+                        clogger.info(f"Демпер: OK [{sku}] -> {new_price}"
+                                     + ("" if published else " (файлом, без подтверждения)"))
+                    else:
+                        outcome = "publish_failed"
             else:
+                observed_count = 0
+                outcome = "no_competitors"
                 clogger.warning(f"Конкурентов нет [{sku}]")
         except Exception as e:
+            outcome = "error"
+            observe_error("process", e)
             clogger.error(f"Ошибка при обработке продукта [{sku}]: {e}", exc_info=False)
+        finally:
+            in_flight.dec()
+        products_total.inc(outcome=outcome)
 
-        # легкая рандомная задержка, чтобы не долбить API синхронно
-        await asyncio.sleep(random.uniform(0.1, 0.3))
+        # цена (если сменилась), last_check_time и следующая проверка запишутся пачкой
+        checked_at = datetime.now(timezone.utc)
+        our_price = current_price
+        if written_price is not None or outcome == "skipped":
+            # при пропуске в кабинете уже стоит расчётная цена
+            our_price = Decimal(new_price)
+        schedule = check_scheduler.schedule(product, checked_at, min_offer_price, observed_count,
+                                            our_price, min_profit, decision.fingerprint[i], stable)
+        write_buffer.add(product_id, written_price, checked_at, schedule=schedule, published=published)
 
-    elapsed_time = time.time() - start_time
-    clogger.info(f"Время обработки [{sku}]: {elapsed_time:.2f} сек")
+    clogger.info(f"Время обработки [{sku}]: {time.time() - started_at:.2f} сек")
 
 
-# ── Выборка шардов ────────────────────────────────────────────────────────────
-async def fetch_products(pool):
+async def process_batch(products, clogger, write_buffer: ProductWriteBuffer, claimed_at: float = None,
+                        price_log: PriceObservationLog = None):
     """
-    Извлекаем только свой шард:
-      - если id INT:     (id % INSTANCE_COUNT) = INSTANCE_INDEX
-      - если id UUID:    mod(abs(hashtext(id::text)), INSTANCE_COUNT) = INSTANCE_INDEX
+    Обрабатывает пачку товаров из очереди.
+    claimed_at — time.monotonic() захвата пачки из очереди (для стадии queue_wait).
     """
-    async with pool.acquire() as connection:
-        if ID_IS_UUID:
-            query = """
-                    SELECT id, store_id, kaspi_sku, external_kaspi_id, price, min_profit
-                    FROM products
-                    WHERE bot_active = TRUE
-                      AND mod(abs(hashtext(id::text)), $1) = $2 \
-                    """
-        else:
-            query = """
-                    SELECT id, store_id, kaspi_sku, external_kaspi_id, price, min_profit
-                    FROM products
-                    WHERE bot_active = TRUE
-                      AND mod(abs(hashtext(id::text)), $1) = $2 \
-                    """
-        return await connection.fetch(query, INSTANCE_COUNT, INSTANCE_INDEX)
+    started_at = time.time()
+    offers = await asyncio.gather(*(fetch_product_offers(p, clogger, claimed_at) for p in products))
+
+    with stage_seconds.time(stage="decision"):
+        decision = repricing_engine.decide(products, offers)
+
+    await asyncio.gather(*(
+        apply_decision(product, offers[i], decision, i, clogger, write_buffer, started_at, price_log)
+        for i, product in enumerate(products)
+    ))
 
 
 # ── Синхронизация магазинов ───────────────────────────────────────────────────
@@ -140,43 +206,154 @@ def _should_sync_stores_for_sid(sid: int) -> bool:
         return (abs(hash(str(sid))) % INSTANCE_COUNT) == INSTANCE_INDEX
 
 
+async def fetch_active_store_ids(pool):
+    async with pool.acquire() as connection:
+        rows = await connection.fetch("SELECT DISTINCT store_id FROM products WHERE bot_active = TRUE")
+    return [row["store_id"] for row in rows]
+
+
+async def _sync_stores_loop(pool, clogger):
+    """Синхронизация магазинов по таймеру, отдельно от очереди товаров"""
+    while True:
+        try:
+            store_ids = await fetch_active_store_ids(pool)
+            if SYNC_STORES_MODE == "leader" and INSTANCE_INDEX == 0:
+                clogger.info(f"[leader] Синхронизируем {len(store_ids)} магазинов.")
+                for sid in store_ids:
+                    await sync_store(sid, clogger)
+            elif SYNC_STORES_MODE == "shard":
+                my_store_ids = [sid for sid in store_ids if _should_sync_stores_for_sid(sid)]
+                clogger.info(f"[shard] Моих магазинов: {len(my_store_ids)}")
+                for sid in my_store_ids:
+                    await sync_store(sid, clogger)
+        except Exception as e:
+            clogger.error(f"Ошибка синхронизации магазинов: {e}", exc_info=False)
+        await asyncio.sleep(STORE_SYNC_INTERVAL)
+
+
+# ── Метрики ───────────────────────────────────────────────────────────────────
+def collect_stats(queue: ProductWorkQueue, write_buffer: ProductWriteBuffer, price_log: PriceObservationLog) -> dict:
+    return {
+        "queue": queue.get_stats(),
+        "scheduler": check_scheduler.get_stats(),
+        "repricing": repricing_engine.get_stats(),
+        "write_buffer": write_buffer.get_stats(),
+        "price_log": price_log.get_stats(),
+        "publisher": price_publisher.get_stats(),
+        "rate_governor": rate_governor.get_stats(),
+        "offer_cache": offer_cache.get_stats(),
+        "session_validation": get_validation_stats(),
+        "browser_pool": browser_pool.get_stats(),
+        "proxies": proxy_balancer.get_stats(),
+    }
+
+
+async def _report_stats_loop(stats_sink, queue, write_buffer, price_log, clogger):
+    """Периодически отправляет снимок метрик супервизору (demper_supervisor)"""
+    while True:
+        try:
+            stats_sink.put_nowait({
+                "index": INSTANCE_INDEX,
+                "pid": os.getpid(),
+                "ts": time.time(),
+                "stats": collect_stats(queue, write_buffer, price_log),
+            })
+        except Exception as e:
+            clogger.warning(f"Не удалось отправить метрики супервизору: {e}")
+        await asyncio.sleep(DEMPER_STATS_INTERVAL)
+
+
 # ── Главный цикл ──────────────────────────────────────────────────────────────
-async def check_and_update_prices():
+async def check_and_update_prices(stats_sink=None):
+    """stats_sink — очередь multiprocessing от супервизора; без него метрики только в логах"""
     clogger = logging.getLogger("price_checker")
     clogger.addFilter(ShardContext())
     clogger.setLevel(logging.INFO)
 
     pool = await create_pool()
+    queue = ProductWorkQueue(pool, id_is_uuid=ID_IS_UUID)
+    queue.start()
+    write_buffer = ProductWriteBuffer(pool, id_is_uuid=ID_IS_UUID, owner=queue.owner)
+    write_buffer.start()
+    price_log = PriceObservationLog(pool)
+    price_log.start()
+    store_sync_task = asyncio.create_task(_sync_stores_loop(pool, clogger))
+    clogger.info(f"Воркер очереди: {queue.owner}")
+    metrics_runner = await start_metrics_server()
+    report_task = None
+    if stats_sink is not None:
+        report_task = asyncio.create_task(_report_stats_loop(stats_sink, queue, write_buffer, price_log, clogger))
+
+    # docker stop шлёт SIGTERM — завершаемся через finally, чтобы дописать буфер
+    main_task = asyncio.current_task()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
+    except NotImplementedError:
+        pass
 
+    try:
+        await _run_cycles(queue, write_buffer, price_log, clogger)
+    finally:
+        store_sync_task.cancel()
+        if report_task is not None:
+            report_task.cancel()
+        # сначала публикуем накопленные цены, потом дописываем их исходы в БД
+        await price_publisher.close()
+        try:
+            await write_buffer.close()
+        except Exception as e:
+            clogger.error(f"Не удалось дописать буфер цен: {e}", exc_info=False)
+        try:
+            await price_log.close()
+        except Exception as e:
+            clogger.error(f"Не удалось дописать журнал цен: {e}", exc_info=False)
+        # необработанное возвращаем в очередь другим инстансам
+        try:
+            await queue.close()
+        except Exception as e:
+            clogger.error(f"Не удалось вернуть аренду товаров: {e}", exc_info=False)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        # переавторизации магазинов могли поднять Chromium
+        await browser_pool.close()
+        # закрываем общие keep-alive сессии к Kaspi
+        await close_http_clients()
+        await close_pool()
+
+
+async def _run_cycles(queue: ProductWorkQueue, write_buffer: ProductWriteBuffer, price_log: PriceObservationLog,
+                      clogger):
     while True:
         try:
-            clogger.info("Старт цикла демпера...")
-            products = await fetch_products(pool)
-            clogger.info(f"Найдено {len(products)} активных продуктов в моём шарде.")
+            products = await queue.claim()
+            if not products:
+                # очередь пуста — спим до ближайшего созревшего товара
+                await asyncio.sleep(max(await queue.seconds_until_due(), 1.0))
+                continue
+            claimed_at = time.monotonic()
+            clogger.info(f"Взято в работу {len(products)} товаров.")
 
             # обработка товаров
-            tasks = [asyncio.create_task(process_product(p, clogger, pool)) for p in products]
-            if tasks:
-                await asyncio.gather(*tasks)
-
-            # синхронизация магазинов
-            store_ids = {p["store_id"] for p in products}
-            if store_ids:
-                if SYNC_STORES_MODE == "leader" and INSTANCE_INDEX == 0:
-                    clogger.info(f"[leader] Синхронизируем {len(store_ids)} магазинов.")
-                    for sid in store_ids:
-                        await sync_store(sid, clogger)
-                elif SYNC_STORES_MODE == "shard":
-                    my_store_ids = [sid for sid in store_ids if _should_sync_stores_for_sid(sid)]
-                    clogger.info(f"[shard] Моих магазинов: {len(my_store_ids)}")
-                    for sid in my_store_ids:
-                        await sync_store(sid, clogger)
+            await process_batch(products, clogger, write_buffer, claimed_at, price_log)
+            queue.done(p["id"] for p in products)
+            await write_buffer.flush()
+            clogger.info(f"Очередь: {queue.get_stats()}")
+            clogger.info(f"Расписание проверок: {check_scheduler.get_stats()}")
+            clogger.info(f"Решения по ценам: {repricing_engine.get_stats()}")
+            clogger.info(f"Буфер записи: {write_buffer.get_stats()}")
+            clogger.info(f"Журнал цен: {price_log.get_stats()}")
+            clogger.info(f"Публикация цен: {price_publisher.get_stats()}")
+            clogger.info(f"Лимиты запросов: {rate_governor.get_stats()}")
+            clogger.info(f"Кэш офферов: {offer_cache.get_stats()}")
+            clogger.info(f"Проверки сессий: {get_validation_stats()}")
 
         except Exception as e:
             clogger.error(f"Error during price check/update: {e}", exc_info=False)
-
-        await asyncio.sleep(5)
+            await asyncio.sleep(5)
 
 
 if __name__ == "__main__":
-    asyncio.run(check_and_update_prices())
+    try:
+        asyncio.run(check_and_update_prices())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
@@ -0,0 +1,300 @@
+# demper_supervisor.py
+# Один процесс-супервизор вместо start_dempers.sh: запускает DEMPER_WORKERS воркеров
+# demper_instance, каждый со своим event loop (uvloop, если есть), пулом БД и срезом
+# прокси (proxy_config.shard_slice по INSTANCE_INDEX/COUNT воркера).
+# Упавший воркер перезапускается с экспоненциальной паузой; метрики воркеры присылают
+# через multiprocessing-очередь, супервизор сводит их и отдаёт по HTTP (/health, /stats).
+#
+# Несколько машин/контейнеров с супервизором: INSTANCE_INDEX/COUNT задают номер машины,
+# воркер k получает INSTANCE_INDEX = INSTANCE_INDEX * DEMPER_WORKERS + k
+# и INSTANCE_COUNT = INSTANCE_COUNT * DEMPER_WORKERS.
+import asyncio
+import logging
+import multiprocessing as mp
+import os
+import queue as queue_module
+import signal
+import time
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+DEMPER_WORKERS = int(os.getenv("DEMPER_WORKERS", str(os.cpu_count() or 1)))
+DEMPER_UVLOOP = os.getenv("DEMPER_UVLOOP", "true").lower() in ("1", "true", "yes")
+DEMPER_START_STAGGER = float(os.getenv("DEMPER_START_STAGGER", "2"))  # сек между стартами воркеров
+DEMPER_RESTART_BACKOFF = float(os.getenv("DEMPER_RESTART_BACKOFF", "1"))  # сек, первая пауза перед рестартом
+DEMPER_RESTART_BACKOFF_MAX = float(os.getenv("DEMPER_RESTART_BACKOFF_MAX", "60"))
+DEMPER_RESTART_RESET = float(os.getenv("DEMPER_RESTART_RESET", "60"))  # сек работы, после которых паузы сбрасываются
+DEMPER_STOP_TIMEOUT = float(os.getenv("DEMPER_STOP_TIMEOUT", "30"))  # сек на дописывание буферов при остановке
+DEMPER_SUPERVISOR_PORT = int(os.getenv("DEMPER_SUPERVISOR_PORT", "9100"))  # 0 — без HTTP
+DEMPER_METRICS_PORT = int(os.getenv("DEMPER_METRICS_PORT", "9101"))  # воркер k: порт + k; 0 — без /metrics
+DEMPER_STATS_INTERVAL = float(os.getenv("DEMPER_STATS_INTERVAL", "10"))  # как в demper_instance
+DEMPER_STALE_AFTER = 3 * DEMPER_STATS_INTERVAL  # нет отчёта дольше — воркер нездоров
+
+BASE_INDEX = int(os.getenv("INSTANCE_INDEX", "0"))
+BASE_COUNT = int(os.getenv("INSTANCE_COUNT", "1"))
+
+logger = logging.getLogger("demper_supervisor")
+
+
+# ── Воркер ────────────────────────────────────────────────────────────────────
+def _worker_main(instance_index: int, instance_count: int, metrics_port: int, stats_sink):
+    """Точка входа дочернего процесса (spawn): окружение — до импорта модулей демпера"""
+    os.environ["INSTANCE_INDEX"] = str(instance_index)
+    os.environ["INSTANCE_COUNT"] = str(instance_count)
+    os.environ["DEMPER_METRICS_PORT"] = str(metrics_port)
+    os.environ.setdefault("DEMPER_LOG_FILE", f"price_worker_{instance_index}.log")
+    # Ctrl+C в терминале ловит супервизор и гасит воркеров сам через SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if DEMPER_UVLOOP:
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            pass
+
+    import demper_instance
+    try:
+        asyncio.run(demper_instance.check_and_update_prices(stats_sink))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+class _Worker:
+    def __init__(self, slot: int, workers: int):
+        self.slot = slot
+        self.instance_index = BASE_INDEX * workers + slot
+        self.metrics_port = DEMPER_METRICS_PORT + slot if DEMPER_METRICS_PORT else 0
+        self.process: Optional[mp.Process] = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.failures_in_row = 0
+        self.restart_at: Optional[float] = None
+        self.last_exit_code: Optional[int] = None
+        self.last_report: Optional[dict] = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def healthy(self, now: float) -> bool:
+        if not self.alive:
+            return False
+        if self.last_report is None or self.last_report.get("pid") != self.process.pid:
+            # только что запущен — ждём первый отчёт
+            return now - self.started_at < DEMPER_STALE_AFTER
+        return now - self.last_report["ts"] < DEMPER_STALE_AFTER
+
+
+# Сводятся только счётчики. Настройки, оценки здоровья порта и квантили в total не попадают
+# (их смысл — у воркера, см. workers), как и доли и средние (avg_*, *_rate, *_ratio, last_*):
+# те, для которых есть числитель и знаменатель, пересчитываются из сумм (_TOTAL_RATIOS).
+_NOT_SUMMED = {
+    "ttl", "max_size", "capacity", "lease_seconds", "pool_size", "min_interval", "max_interval",
+    "rate", "burst", "time_to_reset", "concurrency", "refresh_after",
+    "p50", "p90", "p99", "score", "latency_ms", "error_rate", "cooldown_left", "open_left", "last_status",
+    "usage",  # индексы прокси локальны для среза воркера
+}
+_NOT_SUMMED_PREFIXES = ("avg_", "last_")
+_NOT_SUMMED_SUFFIXES = ("_rate", "_ratio")
+
+# раздел -> поле -> (слагаемые числителя, слагаемые знаменателя, знаков после запятой)
+_TOTAL_RATIOS = {
+    "offer_cache": {"hit_ratio": (("saved_requests",), ("hits", "misses", "coalesced"), 4)},
+    "repricing": {"stable_rate": (("stable",), ("products",), 3),
+                  "skip_rate": (("skipped",), ("changed",), 3)},
+    "write_buffer": {"avg_batch_size": (("rows_flushed",), ("flushes",), 1)},
+}
+
+
+def _merge_stats(total: dict, stats: dict):
+    """Складывает счётчики воркеров (max_* — максимум); прочее в total не сводится"""
+    for key, value in stats.items():
+        if isinstance(value, bool) or key in _NOT_SUMMED:
+            continue
+        if isinstance(value, (int, float)):
+            if key.startswith(_NOT_SUMMED_PREFIXES) or key.endswith(_NOT_SUMMED_SUFFIXES):
+                continue
+            if key.startswith("max_"):
+                total[key] = max(total.get(key, value), value)
+            else:
+                total[key] = total.get(key, 0) + value
+        elif isinstance(value, dict):
+            _merge_stats(total.setdefault(key, {}), value)
+
+
+def _add_total_ratios(total: dict):
+    for section, ratios in _TOTAL_RATIOS.items():
+        values = total.get(section)
+        if not values:
+            continue
+        for key, (numerator, denominator, digits) in ratios.items():
+            den = sum(values.get(k, 0) for k in denominator)
+            values[key] = round(sum(values.get(k, 0) for k in numerator) / den, digits) if den else 0.0
+
+
+# ── Супервизор ────────────────────────────────────────────────────────────────
+class DemperSupervisor:
+    def __init__(self, workers: int = DEMPER_WORKERS):
+        self._ctx = mp.get_context("spawn")
+        self.stats_sink = self._ctx.Queue()
+        self.workers: List[_Worker] = [_Worker(slot, workers) for slot in range(workers)]
+        self.instance_count = BASE_COUNT * workers
+        self._stopping = False
+
+    def _spawn(self, worker: _Worker):
+        worker.process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker.instance_index, self.instance_count, worker.metrics_port, self.stats_sink),
+            name=f"demper-{worker.instance_index}",
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+        logger.info(f"Воркер {worker.instance_index}/{self.instance_count} запущен (PID: {worker.process.pid})")
+
+    def _drain_reports(self):
+        while True:
+            try:
+                report = self.stats_sink.get_nowait()
+            except queue_module.Empty:
+                return
+            slot = report["index"] - BASE_INDEX * len(self.workers)
+            if 0 <= slot < len(self.workers):
+                self.workers[slot].last_report = report
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.alive or self._stopping:
+                continue
+            if worker.restart_at is None:
+                worker.last_exit_code = worker.process.exitcode
+                if now - worker.started_at >= DEMPER_RESTART_RESET:
+                    worker.failures_in_row = 0
+                delay = min(DEMPER_RESTART_BACKOFF * (2 ** worker.failures_in_row), DEMPER_RESTART_BACKOFF_MAX)
+                worker.failures_in_row += 1
+                worker.restart_at = now + delay
+                logger.warning(f"Воркер {worker.instance_index} завершился с кодом {worker.last_exit_code}, "
+                               f"перезапуск через {delay:.0f} сек")
+            elif now >= worker.restart_at:
+                worker.restarts += 1
+                self._spawn(worker)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+
+        runner = await self._start_http()
+        try:
+            for i, worker in enumerate(self.workers):
+                if stop.is_set():
+                    break
+                if i:
+                    # разносим старты, чтобы воркеры не логинились и не били Kaspi залпом
+                    await asyncio.sleep(DEMPER_START_STAGGER)
+                self._spawn(worker)
+
+            while not stop.is_set():
+                self._drain_reports()
+                self._check_workers()
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._stopping = True
+            await self._stop_workers()
+            if runner is not None:
+                await runner.cleanup()
+
+    async def _stop_workers(self):
+        alive = [w for w in self.workers if w.alive]
+        logger.info(f"Останавливаем {len(alive)} воркеров...")
+        for worker in alive:
+            worker.process.terminate()  # SIGTERM: воркер дописывает буферы и отпускает аренду
+        deadline = time.monotonic() + DEMPER_STOP_TIMEOUT
+        while any(w.alive for w in alive) and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        for worker in alive:
+            if worker.alive:
+                logger.warning(f"Воркер {worker.instance_index} не остановился за {DEMPER_STOP_TIMEOUT:.0f} сек, kill")
+                worker.process.kill()
+            worker.process.join(timeout=5)
+
+    # ── Здоровье и метрики ────────────────────────────────────────────────────
+    def get_health(self) -> Dict:
+        now = time.monotonic()
+        wall_now = time.time()
+        workers = []
+        for worker in self.workers:
+            report = worker.last_report
+            workers.append({
+                "instance_index": worker.instance_index,
+                "pid": worker.process.pid if worker.process else None,
+                "metrics_port": worker.metrics_port or None,
+                "alive": worker.alive,
+                "healthy": worker.healthy(now),
+                "uptime": round(now - worker.started_at, 1) if worker.alive else 0.0,
+                "restarts": worker.restarts,
+                "last_exit_code": worker.last_exit_code,
+                "last_report_age": round(wall_now - report["ts"], 1) if report else None,
+            })
+        healthy = sum(1 for w in workers if w["healthy"])
+        return {
+            "status": "ok" if healthy == len(workers) else ("degraded" if healthy else "down"),
+            "workers_total": len(workers),
+            "workers_healthy": healthy,
+            "instance_count": self.instance_count,
+            "workers": workers,
+        }
+
+    def get_stats(self) -> Dict:
+        total: dict = {}
+        per_worker = {}
+        for worker in self.workers:
+            if worker.last_report is None:
+                continue
+            stats = worker.last_report["stats"]
+            per_worker[worker.instance_index] = stats
+            _merge_stats(total, stats)
+        _add_total_ratios(total)
+        return {"total": total, "workers": per_worker}
+
+    async def _start_http(self) -> Optional[web.AppRunner]:
+        if not DEMPER_SUPERVISOR_PORT:
+            return None
+
+        async def health(request):
+            data = self.get_health()
+            return web.json_response(data, status=200 if data["status"] != "down" else 503)
+
+        async def stats(request):
+            return web.json_response(self.get_stats())
+
+        app = web.Application()
+        app.router.add_get("/health", health)
+        app.router.add_get("/stats", stats)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", DEMPER_SUPERVISOR_PORT).start()
+        logger.info(f"Здоровье и метрики: http://0.0.0.0:{DEMPER_SUPERVISOR_PORT}/health, /stats")
+        return runner
+
+
+def main():
+    # здесь, а не при импорте: воркеры (spawn) импортируют этот модуль как __mp_main__,
+    # и корневой логгер, настроенный супервизором, перекрыл бы их basicConfig с файлом
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s [supervisor] %(message)s")
+    logger.info(f"🚀 Запуск {DEMPER_WORKERS} воркеров демпера (uvloop: {DEMPER_UVLOOP})")
+    asyncio.run(DemperSupervisor().run())
+
+
+if __name__ == "__main__":
+    main()
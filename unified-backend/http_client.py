@@ -0,0 +1,119 @@
+# http_client.py
+# Общий пул HTTP-клиентов для запросов к Kaspi (kaspi.kz, mc.shop.kaspi.kz).
+# Одна долгоживущая aiohttp-сессия на upstream-хост: keep-alive, лимит соединений,
+# кэш DNS. Прокси передаётся в каждом запросе — aiohttp держит отдельный пул
+# соединений на каждую пару (хост, прокси), так что TCP/TLS и CONNECT через
+# прокси переиспользуются между вызовами.
+import asyncio
+import os
+import socket
+from typing import Dict, List, Optional
+
+from aiohttp import ClientSession, ClientTimeout, DummyCookieJar, TCPConnector
+from aiohttp.abc import AbstractResolver
+
+KASPI_HOST = "kaspi.kz"
+KASPI_MC_HOST = "mc.shop.kaspi.kz"
+
+# ── Настройки пула ────────────────────────────────────────────────────────────
+HTTP_LIMIT_TOTAL = int(os.getenv("HTTP_LIMIT_TOTAL", "200"))  # всего соединений на сессию
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", "20"))  # на (хост, прокси)
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))  # сек
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))  # сек
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))  # общий таймаут запроса, сек
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))  # сек
+# "127.0.0.1:8443" — все хосты Kaspi идут на этот адрес без проверки TLS (как curl --resolve).
+# Только для стенда/бенчмарка с фейковым Kaspi (scripts/fake_kaspi.py), не для продакшена.
+KASPI_RESOLVE = os.getenv("KASPI_RESOLVE", "")
+
+
+class _PinnedResolver(AbstractResolver):
+    """Резолвер, отдающий один адрес на любой хост"""
+
+    def __init__(self, address: str):
+        host, _, port = address.rpartition(":")
+        self.host = host or "127.0.0.1"
+        self.port = int(port)
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> List[Dict]:
+        return [{"hostname": host, "host": self.host, "port": self.port,
+                 "family": socket.AF_INET, "proto": 0, "flags": socket.AI_NUMERICHOST}]
+
+    async def close(self) -> None:
+        pass
+
+
+class KaspiHttpClient:
+    """Менеджер долгоживущих aiohttp-сессий по upstream-хостам"""
+
+    def __init__(self):
+        self._sessions: Dict[str, ClientSession] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _new_session(self) -> ClientSession:
+        pinned = {"resolver": _PinnedResolver(KASPI_RESOLVE), "ssl": False} if KASPI_RESOLVE else {}
+        connector = TCPConnector(
+            limit=HTTP_LIMIT_TOTAL,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_TTL,
+            use_dns_cache=True,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            **pinned,
+        )
+        return ClientSession(
+            connector=connector,
+            timeout=ClientTimeout(total=HTTP_TIMEOUT, sock_connect=HTTP_CONNECT_TIMEOUT),
+            # cookies передаются в каждом запросе; общий jar смешал бы сессии разных магазинов
+            cookie_jar=DummyCookieJar(),
+        )
+
+    async def get_session(self, host: str) -> ClientSession:
+        """Возвращает сессию для хоста, создаёт при первом обращении"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # сессии привязаны к event loop — в новом loop начинаем с чистого листа
+            self._sessions = {}
+            self._loop = loop
+            self._lock = asyncio.Lock()
+
+        session = self._sessions.get(host)
+        if session is not None and not session.closed:
+            return session
+
+        async with self._lock:
+            session = self._sessions.get(host)
+            if session is None or session.closed:
+                session = self._new_session()
+                self._sessions[host] = session
+        return session
+
+    async def close(self):
+        """Закрывает все сессии (на shutdown)"""
+        sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            if not session.closed:
+                await session.close()
+
+    def get_stats(self) -> Dict:
+        stats = {}
+        for host, session in self._sessions.items():
+            connector = session.connector
+            stats[host] = {
+                "closed": session.closed,
+                "limit": connector.limit if connector else 0,
+                "limit_per_host": connector.limit_per_host if connector else 0,
+            }
+        return stats
+
+
+kaspi_http = KaspiHttpClient()
+
+
+async def get_session(host: str = KASPI_HOST) -> ClientSession:
+    return await kaspi_http.get_session(host)
+
+
+async def close_http_clients():
+    """Закрыть пул HTTP-клиентов (на shutdown)."""
+    await kaspi_http.close()
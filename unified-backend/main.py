@@ -20,7 +20,7 @@ load_dotenv()
 
 import requests
 from bs4 import BeautifulSoup
-from fastapi import FastAPI, status, Depends, HTTPException
+from fastapi import FastAPI, status, Depends, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, EmailStr, Field
@@ -45,8 +45,14 @@ from routes.products import router as products_router
 from routes.kaspi import router as kaspi_router
 from routes.admin import router as admin_router
 from utils import set_supabase_client, has_existing_store
-from db import create_pool
+from db import create_pool, close_pool
 from config import settings
+from http_client import close_http_clients
+from browser_pool import browser_pool
+from sms_session_store import sms_session_store
+from session_refresher import session_refresher
+from response_cache import response_cache
+from store_versions import bump_store_versions, get_store_version
 
 app = FastAPI()
 
@@ -139,6 +145,16 @@ async def startup_event():
     supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
     set_supabase_client(supabase)
     logging.info("Supabase client initialized")
+    session_refresher.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await session_refresher.close()
+    await sms_session_store.close()
+    await browser_pool.close()
+    await close_http_clients()
+    await close_pool()
 
 
 print('Starting FastAPI application...')
@@ -269,6 +285,8 @@ async def authenticate_kaspi_store(auth_data: KaspiAuthRequest):
                 store_data["user_id"], store_data["merchant_id"], store_data["name"],
                 store_data["api_key"], store_data["guid"]
             )
+            if new_store:
+                await bump_store_versions([new_store["id"]], conn)
 
         if not new_store:
             raise HTTPException(
@@ -518,7 +536,8 @@ class PriceUpdateRequest(BaseModel):
 @app.post("/kaspi/update_product_price")
 async def update_product_price(payload: PriceUpdateRequest):
     try:
-        result = await sync_product(payload.product_id, payload.price)
+        # ручное изменение цены не ждёт пакетного окна
+        result = await sync_product(payload.product_id, payload.price, urgent=True)
 
         return {
             "success": True,
@@ -606,6 +625,7 @@ async def check_and_update_prices():
                                     """,
                                     int(new_price), product_id
                                 )
+                                await bump_store_versions([product["store_id"]], conn)
                             clogger.info(f"Демпер: Успешно - [{sku}] -> {new_price}")
                             # clogger.info(f"Update response: {update_response}")
                         else:
@@ -723,18 +743,18 @@ async def kaspi_sms_verify(req: SMSVerifyRequest):
 
     # Вставка новой записи в базу данных
     async with pool.acquire() as connection:
-        resp = await connection.execute(
+        # id новой записи — через RETURNING (статус "INSERT 0 1" его не содержит)
+        store_id = await connection.fetchval(
             """
             INSERT INTO kaspi_stores (user_id, merchant_id, name, api_key, guid, created_at, updated_at)
             VALUES ($1, $2, $3, $4, $5, $6, $7)
+            RETURNING id
             """,
             store_data["user_id"], store_data["merchant_id"], store_data["name"],
             store_data["api_key"], json.dumps(store_data["guid"]), datetime.now(),
             datetime.now()
         )
-
-    # Получаем id вставленной записи
-    store_id = resp.split()[-1]  # Получаем последний элемент, который будет ID вставленной записи
+        await bump_store_versions([store_id], connection)
 
     return {
         "success": True,
@@ -811,10 +831,15 @@ async def get_store_products_for_preorders(store_id: str):
 
 
 @app.get("/kaspi/preorders/list/{store_id}")
-async def get_store_preorders(store_id: str):
+async def get_store_preorders(request: Request, store_id: str):
     try:
+        version = await get_store_version(store_id)
+        cache_key = f"preorders:{store_id}"
+        cached = response_cache.lookup(request, cache_key, version)
+        if cached is not None:
+            return cached
         preorders_data = await fetch_preorders(store_id)
-        return {"success": True, "preorders": preorders_data}
+        return response_cache.respond(request, cache_key, version, {"success": True, "preorders": preorders_data})
     except Exception as e:
         return {"success": False, "error": str(e)}
 
@@ -856,6 +881,7 @@ async def create_preorder_item(preorder_data: dict):
                 datetime.now(),
                 datetime.now()
             )
+            await bump_store_versions([preorder_data["store_id"]], conn)
             
         return {"success": True, "preorder_id": preorder_id}
     except Exception as e:
@@ -867,16 +893,18 @@ async def update_preorder_status(preorder_id: str, status_data: dict):
     try:
         pool = await create_pool()
         async with pool.acquire() as conn:
-            await conn.execute(
+            store_id = await conn.fetchval(
                 """
                 UPDATE preorders 
                 SET status = $1, updated_at = $2
                 WHERE id = $3
+                RETURNING store_id
                 """,
                 status_data["status"],
                 datetime.now(),
                 preorder_id
             )
+            await bump_store_versions([store_id], conn)
         return {"success": True}
     except Exception as e:
         return {"success": False, "error": str(e)}
@@ -887,18 +915,24 @@ async def delete_preorder_item(preorder_id: str):
     try:
         pool = await create_pool()
         async with pool.acquire() as conn:
-            await conn.execute(
-                "DELETE FROM preorders WHERE id = $1",
+            store_id = await conn.fetchval(
+                "DELETE FROM preorders WHERE id = $1 RETURNING store_id",
                 preorder_id
             )
+            await bump_store_versions([store_id], conn)
         return {"success": True}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
 
 @app.get("/kaspi/preorders/stats/{store_id}")
-async def get_preorder_stats(store_id: str):
+async def get_preorder_stats(request: Request, store_id: str):
     try:
+        version = await get_store_version(store_id)
+        cache_key = f"preorder_stats:{store_id}"
+        cached = response_cache.lookup(request, cache_key, version)
+        if cached is not None:
+            return cached
         pool = await create_pool()
         async with pool.acquire() as conn:
             total = await conn.fetchval(
@@ -927,14 +961,14 @@ async def get_preorder_stats(store_id: str):
                 store_id
             )
             
-        return {
+        return response_cache.respond(request, cache_key, version, {
             "success": True,
             "stats": {
                 "total_preorders": total,
                 "status_counts": {r["status"]: r["count"] for r in status_counts},
                 "total_quantity": total_quantity
             }
-        }
+        })
     except Exception as e:
         return {"success": False, "error": str(e)}
 
@@ -0,0 +1,235 @@
+# metrics.py
+# Метрики демпера в текстовом формате Prometheus — без prometheus_client.
+# Каждый воркер держит свой реестр и отдаёт его на своём порту (DEMPER_METRICS_PORT, /metrics);
+# суммирование по воркерам — дело Prometheus (sum by ...).
+#
+# Стадии обработки товара (demper_stage_seconds{stage=...}):
+#   queue_wait — от захвата пачки из очереди до начала обработки товара;
+#   fetch      — запрос офферов к Kaspi (только промах кэша офферов);
+#   parse      — разбор JSON ответа и офферов;
+#   decision   — расчёт новых цен (repricing, на пачку, а не на товар);
+#   publish    — публикация цены в кабинет (sync_product);
+#   db_write   — пакетный UPDATE буфера записи (на пачку, а не на товар).
+# Там же ожидание браузера и длительность логинов (browser_pool) — переавторизация
+# случается и в воркерах демпера, и в API.
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from aiohttp import web
+
+DEMPER_METRICS_PORT = int(os.getenv("DEMPER_METRICS_PORT", "9101"))  # 0 — не поднимать HTTP
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+logger = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def samples(self) -> List[Tuple[Dict[str, str], float]]:
+        return [(dict(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = STAGE_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # метки -> [счётчики по корзинам, сумма, количество]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[0][i] += 1
+                break
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def label_sets(self) -> List[Dict[str, str]]:
+        return [dict(zip(self.labelnames, key)) for key in self._values]
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """Оценка квантиля по корзинам с линейной интерполяцией (как histogram_quantile)"""
+        state = self._values.get(self._key(labels))
+        if not state or not state[2]:
+            return None
+        counts, _, count = state
+        rank = q * count
+        cumulative = 0
+        lower = 0.0
+        for bound, bucket_count in zip(self.buckets, counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                if bound == float("inf"):
+                    return lower
+                return lower + (bound - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+            lower = bound
+        return lower
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+stage_seconds = registry.register(Histogram(
+    "demper_stage_seconds", "Длительность стадий обработки товара", ["stage"]))
+products_total = registry.register(Counter(
+    "demper_products_total", "Обработанные товары по исходу (changed, submitted, unchanged, skipped, no_competitors, publish_failed, error)",
+    ["outcome"]))
+errors_total = registry.register(Counter(
+    "demper_errors_total", "Ошибки по стадии и типу исключения", ["stage", "type"]))
+proxy_requests_total = registry.register(Counter(
+    "demper_proxy_requests_total", "Запросы через прокси по порту и результату", ["port", "result"]))
+in_flight = registry.register(Gauge(
+    "demper_in_flight", "Товары, обрабатываемые прямо сейчас"))
+queue_claimed_total = registry.register(Counter(
+    "demper_queue_claimed_total", "Товары, взятые из очереди"))
+browser_wait_seconds = registry.register(Histogram(
+    "browser_pool_wait_seconds", "Ожидание свободного контекста браузера (browser_pool)"))
+login_seconds = registry.register(Histogram(
+    "kaspi_login_seconds", "Длительность входа в кабинет через браузер", ["kind", "result"]))
+
+
+def observe_error(stage: str, error: BaseException):
+    errors_total.inc(stage=stage, type=type(error).__name__)
+
+
+def proxy_result(status: Optional[int] = None, error: bool = False) -> str:
+    """Компактная метка результата: 2xx/3xx/4xx/5xx, отдельные 403/429/526, error"""
+    if error or status is None:
+        return "error"
+    if status in (403, 429, 526):
+        return str(status)
+    return f"{status // 100}xx"
+
+
+async def start_metrics_server(port: int = DEMPER_METRICS_PORT) -> Optional[web.AppRunner]:
+    """Поднимает /metrics; порт занят или выключен — работаем без него"""
+    if not port:
+        return None
+
+    async def handle(request):
+        return web.Response(body=registry.render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, "0.0.0.0", port).start()
+    except OSError as e:
+        logger.warning(f"Метрики не подняты на порту {port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Метрики Prometheus: http://0.0.0.0:{port}/metrics")
+    return runner
@@ -0,0 +1,32 @@
+-- Миграция: Уникальность (kaspi_sku, store_id) для пакетной синхронизации каталога
+-- Дата: 2026-10-16
+-- Описание: sync_store_api пишет каталог пачками через
+--           INSERT … ON CONFLICT (kaspi_sku, store_id) DO UPDATE,
+--           для этого нужен уникальный индекс по паре (kaspi_sku, store_id).
+--           Перед созданием индекса удаляем дубли, оставляя самую раннюю запись
+--           (на ней настройки бота: bot_active, min_profit, max_profit, strategy).
+
+-- 1. Сколько дублей будет удалено
+SELECT COUNT(*) AS duplicates
+FROM (
+    SELECT row_number() OVER (PARTITION BY kaspi_sku, store_id ORDER BY created_at, id) AS rn
+    FROM products
+) d
+WHERE d.rn > 1;
+
+-- 2. Удаляем дубли
+DELETE FROM products p
+USING (
+    SELECT id,
+           row_number() OVER (PARTITION BY kaspi_sku, store_id ORDER BY created_at, id) AS rn
+    FROM products
+) d
+WHERE p.id = d.id
+  AND d.rn > 1;
+
+-- 3. Уникальный индекс (CONCURRENTLY — без блокировки записи; не запускать внутри транзакции)
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_products_kaspi_sku_store
+ON products (kaspi_sku, store_id);
+
+-- 4. Анализируем таблицу
+ANALYZE products;
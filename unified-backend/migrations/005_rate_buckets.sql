@@ -0,0 +1,19 @@
+-- Миграция: Общие для всех шардов ведра лимита запросов к Kaspi
+-- Дата: 2026-10-16
+-- Описание: rate_governor.py резервирует токены одним UPDATE по строке ведра.
+--           tat (theoretical arrival time, GCRA) — момент, с которого свободен следующий токен;
+--           rate — токенов в секунду на все инстансы, burst — допустимый всплеск в токенах.
+--           Строки создаются/обновляются самими инстансами при старте (RATE_*_PER_SEC, RATE_*_BURST).
+
+CREATE TABLE IF NOT EXISTS rate_buckets (
+    name  TEXT PRIMARY KEY,
+    rate  DOUBLE PRECISION NOT NULL CHECK (rate > 0),
+    burst DOUBLE PRECISION NOT NULL DEFAULT 1 CHECK (burst >= 0),
+    tat   TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp()
+);
+
+-- строка обновляется очень часто — оставляем место под HOT-update
+ALTER TABLE rate_buckets SET (fillfactor = 50);
+
+COMMENT ON TABLE rate_buckets IS
+'Token bucket (GCRA) по классам эндпоинтов Kaspi: offers, cabinet_write, catalog. Общий для всех инстансов демпера.';
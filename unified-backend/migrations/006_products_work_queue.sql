@@ -0,0 +1,27 @@
+-- Миграция: Очередь проверок товаров с арендой (вместо шардирования по hashtext(id))
+-- Дата: 2026-10-16
+-- Описание: work_queue.py забирает созревшие товары (next_check_at <= NOW()) через
+--           FOR UPDATE SKIP LOCKED и отмечает аренду (lease_owner, lease_expires_at).
+--           Буфер записи ставит следующий next_check_at и снимает аренду.
+--           Если инстанс упал, next_check_at = концу аренды — товар вернётся в очередь сам.
+
+ALTER TABLE products ADD COLUMN IF NOT EXISTS next_check_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS lease_owner TEXT;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITH TIME ZONE;
+
+-- товары, которые давно не проверялись, окажутся в начале очереди
+UPDATE products
+SET next_check_at = COALESCE(last_check_time, NOW())
+WHERE next_check_at IS NULL;
+
+ALTER TABLE products ALTER COLUMN next_check_at SET DEFAULT NOW();
+ALTER TABLE products ALTER COLUMN next_check_at SET NOT NULL;
+
+-- захват пачки: WHERE bot_active AND next_check_at <= NOW() ORDER BY next_check_at LIMIT n
+CREATE INDEX IF NOT EXISTS idx_products_work_queue
+ON products (next_check_at)
+WHERE bot_active = TRUE;
+
+COMMENT ON COLUMN products.next_check_at IS 'Когда товар снова должен попасть в очередь демпера';
+COMMENT ON COLUMN products.lease_owner IS 'Инстанс демпера, который сейчас обрабатывает товар';
+COMMENT ON COLUMN products.lease_expires_at IS 'Конец аренды; продлевается, пока товар в работе';
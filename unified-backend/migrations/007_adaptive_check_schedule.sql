@@ -0,0 +1,25 @@
+-- Миграция: Адаптивный интервал проверки товара
+-- Дата: 2026-10-16
+-- Описание: check_scheduler.py считает next_check_at из частоты смены минимальной цены
+--           конкурентов (price_change_score), числа конкурентов и того, держим ли мы
+--           самую низкую цену. Снимок наблюдения хранится в products, чтобы следующий
+--           инстанс, взявший товар из очереди, продолжил оценку.
+
+ALTER TABLE products ADD COLUMN IF NOT EXISTS check_interval_seconds INTEGER NOT NULL DEFAULT 30;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS competitor_min_price INTEGER;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS competitor_count INTEGER;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS price_change_score REAL;
+
+-- захват самых срочных: окно по next_check_at + сортировка по просрочке / интервалу
+-- без обращения к таблице (INCLUDE — PostgreSQL 11+)
+CREATE INDEX IF NOT EXISTS idx_products_work_queue_urgency
+ON products (next_check_at) INCLUDE (check_interval_seconds)
+WHERE bot_active = TRUE;
+
+-- индекс миграции 006 покрывается новым
+DROP INDEX IF EXISTS idx_products_work_queue;
+
+COMMENT ON COLUMN products.check_interval_seconds IS 'Последний интервал проверки, выбранный check_scheduler';
+COMMENT ON COLUMN products.competitor_min_price IS 'Минимальная цена конкурентов при последней проверке';
+COMMENT ON COLUMN products.competitor_count IS 'Число предложений конкурентов при последней проверке';
+COMMENT ON COLUMN products.price_change_score IS 'Затухающий счётчик смен минимальной цены (≈ частота * CHECK_VOLATILITY_WINDOW)';
@@ -0,0 +1,12 @@
+-- Миграция: Отпечаток набора конкурентов и последняя опубликованная цена
+-- Дата: 2026-10-16
+-- Описание: repricing.py хранит хэш офферов конкурентов (merchant_id + цена) с прошлой
+--           проверки. Если набор не изменился, а расчёт снова даёт уже опубликованную
+--           цену (в products.price её затёрла синхронизация каталога, который в кабинете
+--           ещё не обновился), демпер не публикует её повторно и откладывает следующую проверку.
+
+ALTER TABLE products ADD COLUMN IF NOT EXISTS competitor_fingerprint BIGINT;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS last_published_price INTEGER;
+
+COMMENT ON COLUMN products.competitor_fingerprint IS 'Хэш офферов конкурентов (merchant_id, цена) при последней проверке';
+COMMENT ON COLUMN products.last_published_price IS 'Последняя цена, принятая кабинетом Kaspi от демпера';
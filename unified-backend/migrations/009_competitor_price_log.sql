@@ -0,0 +1,27 @@
+-- Миграция: Журнал наблюдений цен конкурентов
+-- Дата: 2026-10-16
+-- Описание: price_log.py пишет снимки офферов товара при смене набора конкурентов.
+--           Таблица секционирована по дням; секции вперёд создаёт и старые удаляет
+--           сам демпер (PRICE_LOG_RETENTION_DAYS), здесь — только родитель и индексы.
+
+CREATE TABLE IF NOT EXISTS competitor_price_log (
+    observed_at       TIMESTAMPTZ NOT NULL,
+    product_id        TEXT        NOT NULL,
+    external_kaspi_id TEXT        NOT NULL,
+    city_id           TEXT        NOT NULL,
+    our_merchant_id   TEXT,
+    our_price         INTEGER,
+    merchant_ids      TEXT[]      NOT NULL,
+    prices            INTEGER[]   NOT NULL
+) PARTITION BY RANGE (observed_at);
+
+-- индексы на родителе наследуются всеми секциями (PostgreSQL 11+)
+CREATE INDEX IF NOT EXISTS idx_competitor_price_log_product
+ON competitor_price_log (product_id, observed_at);
+
+CREATE INDEX IF NOT EXISTS idx_competitor_price_log_merchants
+ON competitor_price_log USING GIN (merchant_ids);
+
+COMMENT ON TABLE competitor_price_log IS 'Снимки офферов товара при смене набора конкурентов (секции по дням)';
+COMMENT ON COLUMN competitor_price_log.product_id IS 'products.id как текст (uuid или bigint)';
+COMMENT ON COLUMN competitor_price_log.merchant_ids IS 'Продавцы снимка, параллельно prices; наш — our_merchant_id';
@@ -0,0 +1,26 @@
+-- Миграция: Индексы под keyset-пагинацию списка товаров
+-- Дата: 2026-10-16
+-- Описание: routes/products.list_products листает курсором
+--           WHERE store_id = $1 AND (колонка, id) после курсора
+--           ORDER BY колонка NULLS LAST, id вместо LIMIT/OFFSET.
+--           Индекс на каждый порядок сортировки отдаёт страницу без пересортировки
+--           и без чтения предыдущих страниц; (store_id, id) заодно ускоряет COUNT(*) магазина.
+--           DESC-порядок с id ASC обратным проходом не получить — для него свои индексы.
+--           CONCURRENTLY — без блокировки записи; не запускать внутри транзакции.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_products_store_id_id
+ON products (store_id, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_products_store_price_id
+ON products (store_id, price ASC NULLS LAST, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_products_store_price_desc_id
+ON products (store_id, price DESC NULLS LAST, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_products_store_bot_active_id
+ON products (store_id, bot_active ASC NULLS LAST, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_products_store_bot_active_desc_id
+ON products (store_id, bot_active DESC NULLS LAST, id);
+
+ANALYZE products;
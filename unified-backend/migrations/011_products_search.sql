@@ -0,0 +1,33 @@
+-- Миграция: Нечёткий поиск товаров по названию, SKU и категории
+-- Дата: 2026-10-16
+-- Описание: product_search.py ищет по нормализованному документу товара
+--           product_search_document(name, kaspi_sku, category): нижний регистр,
+--           ё → е, казахские буквы → ближайшие русские (ә → а, қ → к, ң → н, ө → о,
+--           ұ/ү → у, ғ → г, һ → х, і → и), всё кроме букв и цифр → пробел.
+--           Тот же алгоритм — normalize_search_text в Python, их нужно менять вместе.
+--           Подстрока (LIKE '%…%') и опечатки (<% word_similarity) обслуживаются одним
+--           GIN-индексом pg_trgm по (store_id, документ); store_id в GIN — через btree_gin.
+--           Заглавные буквы переводятся translate, а не lower(): lower() зависит от локали базы.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+CREATE OR REPLACE FUNCTION product_search_normalize(value TEXT) RETURNS TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT btrim(regexp_replace(
+        lower(translate(coalesce(value, ''),
+            'АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯёӘәҒғҚқҢңӨөҰұҮүҺһІі',
+            'абвгдеежзийклмнопрстуфхцчшщъыьэюяеааггккннооууууххии')),
+        '[^0-9a-zа-я]+', ' ', 'g'))
+$$;
+
+CREATE OR REPLACE FUNCTION product_search_document(name TEXT, kaspi_sku TEXT, category TEXT) RETURNS TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT product_search_normalize(concat_ws(' ', name, kaspi_sku, category))
+$$;
+
+-- CONCURRENTLY — без блокировки записи; не запускать внутри транзакции
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_products_search_trgm
+ON products USING gin (store_id, product_search_document(name, kaspi_sku, category) gin_trgm_ops);
+
+ANALYZE products;
@@ -0,0 +1,19 @@
+-- Миграция: Версии данных магазинов для кэша ответов и ETag
+-- Дата: 2026-10-16
+-- Описание: store_versions.py поднимает версию магазина на каждой записи, которую видит
+--           фронтенд: синхронизация каталога, batch_enable/disable, стратегия, цены демпера,
+--           предзаказы, создание и удаление магазина. response_cache.py отдаёт сохранённый
+--           ответ, пока версия не изменилась, и 304 на If-None-Match.
+--           Версии берутся из одной последовательности: её last_value — глобальная версия
+--           (сводная статистика админки). Строка магазина не удаляется вместе с ним —
+--           кэш по удалённому магазину тоже должен устареть.
+
+CREATE SEQUENCE IF NOT EXISTS store_version_seq;
+
+CREATE TABLE IF NOT EXISTS store_versions (
+    store_id   UUID PRIMARY KEY,
+    version    BIGINT NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+COMMENT ON TABLE store_versions IS 'Версия данных магазина: растёт на каждой записи, ключ кэша ответов API';
@@ -0,0 +1,12 @@
+-- Миграция: Время последней подтверждённой публикации цены
+-- Дата: 2026-10-16
+-- Описание: repricing.py пропускает повторную публикацию, если офферы конкурентов прежние
+--           и расчёт снова даёт last_published_price — products.price могла ещё не
+--           догнать кабинет до следующей синхронизации каталога. Но расхождение может
+--           быть и настоящим: цену поменяли в кабинете вручную или Kaspi её не принял.
+--           Пропуск действует только PRICE_PUBLISH_GRACE сек после публикации, дальше
+--           цена публикуется снова.
+
+ALTER TABLE products ADD COLUMN IF NOT EXISTS last_published_at TIMESTAMPTZ;
+
+COMMENT ON COLUMN products.last_published_at IS 'Когда кабинет Kaspi подтвердил last_published_price';
@@ -0,0 +1,11 @@
+-- Миграция: Захват перелогина магазина
+-- Дата: 2026-10-16
+-- Описание: session_refresher.py (и SessionManager.load() без refresher в процессе) перед
+--           Playwright-логином захватывает магазин коротким UPDATE: до
+--           session_refresh_until его не логинит никто другой. Раньше это держал
+--           pg_try_advisory_xact_lock — и с ним соединение пула на всё время логина.
+--           Упавший процесс не оставит магазин занятым дольше SESSION_REFRESH_CLAIM_SECONDS.
+
+ALTER TABLE kaspi_stores ADD COLUMN IF NOT EXISTS session_refresh_until TIMESTAMPTZ;
+
+COMMENT ON COLUMN kaspi_stores.session_refresh_until IS 'До какого момента магазин перелогинивает один процесс';
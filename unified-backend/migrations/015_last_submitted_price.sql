@@ -0,0 +1,13 @@
+-- Миграция: Последняя отправленная в кабинет цена
+-- Дата: 2026-10-16
+-- Описание: last_published_price/_at (миграции 008, 013) пишутся только для цен, которые
+--           кабинет подтвердил поштучно; файлом (PRICE_PUBLISH_MODE=batch) подтверждения нет.
+--           Пропуск повторной публикации в repricing.py сравнивает расчёт с последней
+--           отправленной ценой — подтверждённой или ушедшей файлом — и действует
+--           PRICE_PUBLISH_GRACE сек после отправки.
+
+ALTER TABLE products ADD COLUMN IF NOT EXISTS last_submitted_price INTEGER;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS last_submitted_at TIMESTAMPTZ;
+
+COMMENT ON COLUMN products.last_submitted_price IS 'Последняя цена, отправленная демпером в кабинет (в т.ч. файлом без подтверждения)';
+COMMENT ON COLUMN products.last_submitted_at IS 'Когда отправлена last_submitted_price';
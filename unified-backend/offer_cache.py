@@ -0,0 +1,104 @@
+# offer_cache.py
+# Кэш предложений конкурентов по (external_kaspi_id, city) с коротким TTL и LRU-вытеснением.
+# Несколько магазинов часто продают один мастер-товар — параллельные запросы по одному ключу
+# ждут единственный запрос к Kaspi (single-flight), а не шлют каждый свой через прокси.
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+OFFER_CACHE_TTL = float(os.getenv("OFFER_CACHE_TTL", "20"))  # сек
+OFFER_CACHE_MAX_SIZE = int(os.getenv("OFFER_CACHE_MAX_SIZE", "10000"))  # ключей
+
+CacheKey = Tuple[str, str]
+
+
+class CompetitorOfferCache:
+    def __init__(self, ttl: float = OFFER_CACHE_TTL, max_size: int = OFFER_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[CacheKey, Tuple[float, list]]" = OrderedDict()
+        self._inflight: Dict[CacheKey, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def _get_fresh(self, key: CacheKey) -> Optional[list]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, offers = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return offers
+
+    def _put(self, key: CacheKey, offers: list):
+        self._entries[key] = (time.monotonic(), offers)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_fetch(self, key: CacheKey, fetch: Callable[[], Awaitable[list]]) -> list:
+        """Возвращает офферы из кэша, либо ждёт уже идущий запрос, либо делает новый"""
+        offers = self._get_fresh(key)
+        if offers is not None:
+            self.hits += 1
+            return offers
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            # shield: отмена одного ожидающего не должна отменять общий запрос
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            offers = await fetch()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # исключение уже проброшено вызывающему — не оставляем его "неполученным"
+            future.exception()
+            raise
+        else:
+            # пустой список parse_product_by_sku отдаёт и при ошибке запроса — такое не кэшируем
+            if offers:
+                self._put(key, offers)
+            future.set_result(offers)
+            return offers
+        finally:
+            self._inflight.pop(key, None)
+
+    def invalidate(self, key: CacheKey):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "inflight": len(self._inflight),
+            # сколько запросов к Kaspi (и прокси) сэкономлено
+            "saved_requests": self.hits + self.coalesced,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 4) if lookups else 0.0,
+        }
+
+
+offer_cache = CompetitorOfferCache()
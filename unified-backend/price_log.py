@@ -0,0 +1,286 @@
+# price_log.py
+# Журнал наблюдений цен конкурентов: раньше офферы после решения демпера выбрасывались.
+# Таблица competitor_price_log (миграция 009) секционирована по дням observed_at;
+# одна строка — снимок офферов товара (merchant_ids[] и prices[] параллельными массивами,
+# наш оффер тоже в них, наш продавец — our_merchant_id).
+#
+# Сжатие — по изменениям: снимок пишется, только если отпечаток конкурентов (repricing)
+# отличается от прошлой проверки, поэтому стабильный каталог почти не растит журнал,
+# а история остаётся точной — между строками цены не менялись.
+#
+# Демпер только кладёт снимок в память (add); запись — фоновая, пачками через COPY.
+# Тот же фон раз в PRICE_LOG_MAINTENANCE_INTERVAL создаёт секции на дни вперёд и удаляет
+# секции старше PRICE_LOG_RETENTION_DAYS (под advisory-локом — делает один инстанс).
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import date, datetime, timedelta, timezone
+from typing import Deque, Dict, List, Optional, Tuple
+
+PRICE_LOG_ENABLED = os.getenv("PRICE_LOG_ENABLED", "true").lower() in ("1", "true", "yes")
+PRICE_LOG_MAX_BATCH = int(os.getenv("PRICE_LOG_MAX_BATCH", "2000"))  # строк на один COPY
+PRICE_LOG_FLUSH_INTERVAL = float(os.getenv("PRICE_LOG_FLUSH_INTERVAL", "5"))  # сек
+PRICE_LOG_MAX_PENDING = int(os.getenv("PRICE_LOG_MAX_PENDING", "50000"))  # сверх — старые снимки теряются
+PRICE_LOG_RETENTION_DAYS = int(os.getenv("PRICE_LOG_RETENTION_DAYS", "90"))
+PRICE_LOG_PARTITIONS_AHEAD = int(os.getenv("PRICE_LOG_PARTITIONS_AHEAD", "3"))  # дней вперёд
+PRICE_LOG_MAINTENANCE_INTERVAL = float(os.getenv("PRICE_LOG_MAINTENANCE_INTERVAL", "3600"))  # сек
+
+TABLE = "competitor_price_log"
+COLUMNS = ("observed_at", "product_id", "external_kaspi_id", "city_id",
+           "our_merchant_id", "our_price", "merchant_ids", "prices")
+_MAINTENANCE_LOCK = 720190  # ключ pg_try_advisory_xact_lock
+
+logger = logging.getLogger(__name__)
+
+Observation = Tuple[datetime, str, str, str, Optional[str], Optional[int], List[str], List[int]]
+
+
+def partition_name(day: date) -> str:
+    return f"{TABLE}_p{day:%Y%m%d}"
+
+
+class PriceObservationLog:
+    def __init__(self, pool, max_batch: int = PRICE_LOG_MAX_BATCH, flush_interval: float = PRICE_LOG_FLUSH_INTERVAL,
+                 max_pending: int = PRICE_LOG_MAX_PENDING, enabled: bool = PRICE_LOG_ENABLED):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self._pending: Deque[Observation] = deque(maxlen=max_pending)
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._last_maintenance = 0.0
+        # метрики
+        self.added = 0
+        self.dropped = 0
+        self.rows_written = 0
+        self.flushes = 0
+        self.failures = 0
+        self.partitions_created = 0
+        self.partitions_dropped = 0
+        self.total_flush_ms = 0.0
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def add(self, product_id, external_kaspi_id: str, city_id: str, offers: List[dict],
+            our_merchant_id: Optional[str] = None, our_price: Optional[int] = None,
+            observed_at: Optional[datetime] = None):
+        """Кладёт снимок офферов в буфер — без ввода-вывода, безопасно для горячего пути"""
+        if not self.enabled or not offers:
+            return
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1  # deque сам вытеснит самый старый снимок
+        self._pending.append((
+            observed_at or datetime.now(timezone.utc),
+            str(product_id),
+            str(external_kaspi_id),
+            str(city_id),
+            str(our_merchant_id) if our_merchant_id else None,
+            int(our_price) if our_price is not None else None,
+            [str(o["merchant_id"]) for o in offers],
+            [int(float(o["price"])) for o in offers],
+        ))
+        self.added += 1
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                if time.monotonic() - self._last_maintenance >= PRICE_LOG_MAINTENANCE_INTERVAL:
+                    await self.maintain()
+                    self._last_maintenance = time.monotonic()
+            except Exception as e:
+                logger.error(f"Обслуживание секций журнала цен не удалось: {e}")
+                self._last_maintenance = time.monotonic()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала цен: {e}")
+
+    async def flush(self) -> int:
+        """Пишет накопленное пачками по max_batch. Возвращает число строк."""
+        written = 0
+        async with self._flush_lock:
+            while self._pending:
+                chunk = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+                started = time.monotonic()
+                try:
+                    async with self.pool.acquire() as connection:
+                        await connection.copy_records_to_table(TABLE, records=chunk, columns=COLUMNS)
+                except Exception:
+                    self.failures += 1
+                    # возвращаем в начало, пока есть место; лишнее теряем вместо роста памяти
+                    room = self._pending.maxlen - len(self._pending)
+                    self.dropped += max(len(chunk) - room, 0)
+                    self._pending.extendleft(reversed(chunk[:room]))
+                    raise
+                self.total_flush_ms += (time.monotonic() - started) * 1000
+                self.flushes += 1
+                self.rows_written += len(chunk)
+                written += len(chunk)
+        return written
+
+    async def maintain(self, today: Optional[date] = None):
+        """Создаёт секции на PRICE_LOG_PARTITIONS_AHEAD дней вперёд и удаляет просроченные"""
+        today = today or datetime.now(timezone.utc).date()
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                if not await connection.fetchval("SELECT pg_try_advisory_xact_lock($1)", _MAINTENANCE_LOCK):
+                    return
+                for offset in range(-1, PRICE_LOG_PARTITIONS_AHEAD + 1):
+                    day = today + timedelta(days=offset)
+                    name = partition_name(day)
+                    if await connection.fetchval("SELECT to_regclass($1)", name) is not None:
+                        continue
+                    await connection.execute(
+                        f"CREATE TABLE {name} PARTITION OF {TABLE} "
+                        f"FOR VALUES FROM ('{day.isoformat()} 00:00+00') TO ('{day + timedelta(days=1)} 00:00+00')"
+                    )
+                    self.partitions_created += 1
+
+                cutoff = partition_name(today - timedelta(days=PRICE_LOG_RETENTION_DAYS))
+                rows = await connection.fetch(
+                    """
+                    SELECT c.relname
+                    FROM pg_inherits AS i
+                    JOIN pg_class AS c ON c.oid = i.inhrelid
+                    JOIN pg_class AS parent ON parent.oid = i.inhparent
+                    WHERE parent.relname = $1
+                    """,
+                    TABLE,
+                )
+                # имена секций сортируются как даты
+                for name in sorted(row["relname"] for row in rows):
+                    if name < cutoff:
+                        await connection.execute(f"DROP TABLE IF EXISTS {name}")
+                        self.partitions_dropped += 1
+                        logger.info(f"Журнал цен: удалена секция {name}")
+
+    async def close(self):
+        """Останавливает фон и дописывает остаток (на shutdown)"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.enabled and self._pending:
+            written = await self.flush()
+            logger.info(f"Журнал цен дописан при остановке: {written} строк")
+
+    def get_stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "pending": len(self._pending),
+            "added": self.added,
+            "dropped": self.dropped,
+            "rows_written": self.rows_written,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 1) if self.flushes else 0.0,
+            "partitions_created": self.partitions_created,
+            "partitions_dropped": self.partitions_dropped,
+        }
+
+
+# ── Запросы ───────────────────────────────────────────────────────────────────
+_PRODUCT_HISTORY_SQL = f"""
+    SELECT l.observed_at, o.merchant_id, o.price,
+           o.merchant_id = l.our_merchant_id AS is_ours
+    FROM {TABLE} AS l
+    CROSS JOIN LATERAL unnest(l.merchant_ids, l.prices) AS o(merchant_id, price)
+    WHERE l.product_id = $1
+      AND l.observed_at >= $2 AND l.observed_at < $3
+    ORDER BY l.observed_at DESC, o.price
+    LIMIT $4
+"""
+
+# только товары магазина $5: журнал общий для всех магазинов
+_MERCHANT_HISTORY_SQL = f"""
+    SELECT l.observed_at, l.product_id, l.external_kaspi_id, l.city_id, o.price
+    FROM {TABLE} AS l
+    JOIN products AS p ON p.id::text = l.product_id AND p.store_id = $5
+    CROSS JOIN LATERAL unnest(l.merchant_ids, l.prices) AS o(merchant_id, price)
+    WHERE l.merchant_ids @> ARRAY[$1::text]
+      AND o.merchant_id = $1
+      AND l.observed_at >= $2 AND l.observed_at < $3
+    ORDER BY l.observed_at DESC
+    LIMIT $4
+"""
+
+# событие — снимок, где самый дешёвый конкурент дешевле нас, а в прошлом снимке
+# либо нас не обгоняли, либо обгонял другой продавец
+_UNDERCUT_SQL = f"""
+    WITH observed AS (
+        SELECT l.observed_at, l.our_price, leader.merchant_id, leader.price
+        FROM {TABLE} AS l
+        LEFT JOIN LATERAL (
+            SELECT o.merchant_id, o.price
+            FROM unnest(l.merchant_ids, l.prices) AS o(merchant_id, price)
+            WHERE o.merchant_id IS DISTINCT FROM l.our_merchant_id
+            ORDER BY o.price
+            LIMIT 1
+        ) AS leader ON TRUE
+        WHERE l.product_id = $1
+          AND l.observed_at >= $2 AND l.observed_at < $3
+    ),
+    marked AS (
+        SELECT *,
+               price < our_price AS undercut,
+               LAG(price < our_price) OVER w AS was_undercut,
+               LAG(merchant_id) OVER w AS previous_leader
+        FROM observed
+        WINDOW w AS (ORDER BY observed_at)
+    )
+    SELECT observed_at, merchant_id, price, our_price
+    FROM marked
+    WHERE undercut
+      AND (was_undercut IS NOT TRUE OR previous_leader IS DISTINCT FROM merchant_id)
+    ORDER BY observed_at DESC
+    LIMIT $4
+"""
+
+
+def _window(since: Optional[datetime], until: Optional[datetime], days: int = 7) -> Tuple[datetime, datetime]:
+    until = until or datetime.now(timezone.utc)
+    return since or until - timedelta(days=days), until
+
+
+async def product_price_history(pool, product_id, since: Optional[datetime] = None,
+                                until: Optional[datetime] = None, limit: int = 1000) -> List[dict]:
+    """Офферы товара по снимкам (новые первыми); по умолчанию — за неделю"""
+    since, until = _window(since, until)
+    async with pool.acquire() as connection:
+        rows = await connection.fetch(_PRODUCT_HISTORY_SQL, str(product_id), since, until, limit)
+    return [dict(row) for row in rows]
+
+
+async def merchant_price_history(pool, merchant_id: str, store_id, since: Optional[datetime] = None,
+                                 until: Optional[datetime] = None, limit: int = 1000) -> List[dict]:
+    """Цены продавца по товарам магазина store_id, где он встречался"""
+    since, until = _window(since, until)
+    async with pool.acquire() as connection:
+        rows = await connection.fetch(_MERCHANT_HISTORY_SQL, str(merchant_id), since, until, limit,
+                                      str(store_id))
+    return [dict(row) for row in rows]
+
+
+async def undercut_timeline(pool, product_id, since: Optional[datetime] = None,
+                            until: Optional[datetime] = None, limit: int = 200) -> List[dict]:
+    """Кто и когда встал дешевле нас по товару"""
+    since, until = _window(since, until, days=30)
+    async with pool.acquire() as connection:
+        rows = await connection.fetch(_UNDERCUT_SQL, str(product_id), since, until, limit)
+    return [dict(row) for row in rows]
@@ -0,0 +1,246 @@
+# price_publisher.py
+# Пакетная публикация цен в кабинет продавца.
+# Изменения цен копятся по продавцу в коротком окне (PRICE_BATCH_WINDOW) и уходят одним
+# xlsx-файлом на /pricefeed/upload/merchant/upload — как upload_preorder_to_kaspi, только с ценами.
+# Каждый вызывающий получает исход по своему SKU. Мелкие пачки, срочные изменения и всё,
+# что не удалось залить файлом, публикуются по одному через /pricefeed/upload/merchant/process.
+# Ответ 2xx на файл значит лишь, что Kaspi его получил: какие строки кабинет принял, из этого
+# ответа не видно. Поэтому SKU из файла — submitted, но не success; подтверждёнными
+# (success) считаются только поштучные публикации.
+import asyncio
+import io
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+import aiohttp
+import pandas as pd
+
+from http_client import get_session, KASPI_MC_HOST
+from proxy_balancer import proxy_balancer
+from proxy_config import get_proxy_url as _proxy_url
+from rate_governor import rate_governor
+from session_registry import session_registry
+
+PRICE_PUBLISH_MODE = os.getenv("PRICE_PUBLISH_MODE", "single")  # "single" | "batch"
+PRICE_BATCH_WINDOW = float(os.getenv("PRICE_BATCH_WINDOW", "2"))  # сек накопления пачки
+PRICE_BATCH_MAX_ITEMS = int(os.getenv("PRICE_BATCH_MAX_ITEMS", "500"))  # SKU в одном файле
+PRICE_BATCH_MIN_FILE_ITEMS = int(os.getenv("PRICE_BATCH_MIN_FILE_ITEMS", "3"))  # меньше — поштучно
+
+PRICE_FILE_COLUMNS = ['SKU', 'model', 'brand', 'price', 'PP1', 'PP2', 'PP3', 'PP4', 'PP5', 'preorder']
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+logger = logging.getLogger(__name__)
+
+# (product_data, cookies) -> True, если Kaspi принял цену
+SingleSender = Callable[[dict, dict], Awaitable[bool]]
+
+
+class _PendingPrice:
+    __slots__ = ("product_data", "cookies", "send_single", "future")
+
+    def __init__(self, product_data: dict, cookies: dict, send_single: SingleSender, future: asyncio.Future):
+        self.product_data = product_data
+        self.cookies = cookies
+        self.send_single = send_single
+        self.future = future
+
+
+def _outcome(sku: str, success: bool, via: str, error: Optional[str] = None,
+             submitted: Optional[bool] = None) -> dict:
+    # success — Kaspi подтвердил цену SKU; submitted — цена доставлена в кабинет (файлом — без подтверждения)
+    return {"sku": sku, "success": success, "submitted": success if submitted is None else submitted,
+            "via": via, "error": error}
+
+
+def build_price_file(items: List[dict]) -> bytes:
+    """
+    xlsx в формате файла предзаказов (SKU, model, brand, price, PP1..PP5, preorder).
+    Наличие — только PP1, как в поштучном запросе (storeId {merchant}_PP1).
+    """
+    rows = [
+        {
+            'SKU': item["kaspi_sku"],
+            'model': item.get("name") or '',
+            'brand': '',
+            'price': int(item["price"]),
+            'PP1': 'yes',
+            'PP2': '',
+            'PP3': '',
+            'PP4': '',
+            'PP5': '',
+            'preorder': '',
+        }
+        for item in items
+    ]
+    buffer = io.BytesIO()
+    pd.DataFrame(rows, columns=PRICE_FILE_COLUMNS).to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+async def upload_price_file(merchant_id: str, cookies: dict, items: List[dict], store_id: Optional[str] = None):
+    """Заливает файл цен через multipart POST. Бросает исключение, если Kaspi его не принял."""
+    url = f"https://mc.shop.kaspi.kz/pricefeed/upload/merchant/upload?merchantUid={merchant_id}"
+    headers = {
+        'Origin': 'https://kaspi.kz',
+        'Referer': 'https://kaspi.kz/',
+        'User-Agent': (
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+            'AppleWebKit/537.36 (KHTML, like Gecko) '
+            'Chrome/134.0.0.0 Safari/537.36 OPR/119.0.0.0'
+        ),
+    }
+    # pandas/openpyxl — CPU-работа, не держим на ней event loop
+    content = await asyncio.to_thread(build_price_file, items)
+
+    form = aiohttp.FormData()
+    filename = f"prices_{merchant_id}_{time.strftime('%Y%m%d_%H%M%S')}.xlsx"
+    form.add_field('file', content, filename=filename, content_type=XLSX_CONTENT_TYPE)
+
+    proxy_dict = proxy_balancer.get_balanced_proxy(f"merchant_{merchant_id}")
+    proxy_url = _proxy_url(proxy_dict)
+
+    session = await get_session(KASPI_MC_HOST)
+    await rate_governor.acquire("cabinet_write")
+    started = time.monotonic()
+    try:
+        response = await session.post(url, data=form, headers=headers, cookies=cookies, proxy=proxy_url,
+                                      timeout=aiohttp.ClientTimeout(total=60))
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        proxy_balancer.report(proxy_dict, error=True)
+        raise
+    proxy_balancer.report(proxy_dict, status=response.status, latency=time.monotonic() - started)
+    async with response:
+        if response.status == 401 and store_id:
+            session_registry.invalidate(store_id)
+        response.raise_for_status()
+
+
+class PricePublisher:
+    def __init__(self, window: float = PRICE_BATCH_WINDOW, max_items: int = PRICE_BATCH_MAX_ITEMS,
+                 min_file_items: int = PRICE_BATCH_MIN_FILE_ITEMS):
+        self.window = window
+        self.max_items = max_items
+        self.min_file_items = min_file_items
+        # merchant_id -> kaspi_sku -> ожидающее изменение (новое изменение SKU вытесняет старое)
+        self._batches: Dict[str, Dict[str, _PendingPrice]] = {}
+        self._timers: Dict[str, asyncio.Task] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.files_uploaded = 0
+        self.file_failures = 0
+        self.skus_via_file = 0
+        self.skus_via_single = 0
+        self.fallbacks = 0
+        self.superseded = 0
+        self.failed = 0
+
+    async def publish(self, product_data: dict, cookies: dict, send_single: SingleSender,
+                      urgent: bool = False) -> dict:
+        """Публикует цену SKU и возвращает исход: {"sku", "success", "submitted", "via", "error"}"""
+        sku = product_data["kaspi_sku"]
+        if urgent:
+            return await self._send_single(_PendingPrice(product_data, cookies, send_single, None))
+
+        merchant_id = product_data["merchant_id"]
+        future = asyncio.get_running_loop().create_future()
+        batch = self._batches.setdefault(merchant_id, {})
+        previous = batch.get(sku)
+        batch[sku] = _PendingPrice(product_data, cookies, send_single, future)
+        if previous is not None:
+            self.superseded += 1
+            self._resolve(previous, _outcome(sku, False, "superseded", "вытеснено более новой ценой"))
+
+        if len(batch) >= self.max_items:
+            self._spawn(self._flush(merchant_id))
+        elif merchant_id not in self._timers:
+            self._timers[merchant_id] = self._spawn(self._flush_later(merchant_id))
+        return await future
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    @staticmethod
+    def _resolve(item: _PendingPrice, outcome: dict):
+        if item.future is not None and not item.future.done():
+            item.future.set_result(outcome)
+
+    async def _flush_later(self, merchant_id: str):
+        await asyncio.sleep(self.window)
+        await self._flush(merchant_id)
+
+    async def _flush(self, merchant_id: str):
+        timer = self._timers.pop(merchant_id, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        batch = self._batches.pop(merchant_id, None)
+        if not batch:
+            return
+        items = list(batch.values())
+        try:
+            if len(items) < self.min_file_items:
+                await asyncio.gather(*(self._send_single(item) for item in items))
+                return
+
+            last = items[-1]
+            try:
+                await upload_price_file(merchant_id, last.cookies, [i.product_data for i in items],
+                                        last.product_data.get("store_id"))
+            except Exception as e:
+                self.file_failures += 1
+                self.fallbacks += len(items)
+                logger.warning(f"Файл цен продавца {merchant_id} ({len(items)} SKU) не принят: {e}; "
+                               f"публикуем поштучно")
+                await asyncio.gather(*(self._send_single(item) for item in items))
+                return
+
+            self.files_uploaded += 1
+            self.skus_via_file += len(items)
+            logger.info(f"Файл цен продавца {merchant_id}: {len(items)} SKU загружено одним запросом")
+            for item in items:
+                self._resolve(item, _outcome(item.product_data["kaspi_sku"], False, "file",
+                                             "Kaspi не подтвердил строку файла", submitted=True))
+        except BaseException as e:
+            # что бы ни случилось — ожидающие не должны висеть вечно
+            for item in items:
+                self._resolve(item, _outcome(item.product_data["kaspi_sku"], False, "file", str(e)))
+            raise
+
+    async def _send_single(self, item: _PendingPrice) -> dict:
+        sku = item.product_data["kaspi_sku"]
+        self.skus_via_single += 1
+        try:
+            success = bool(await item.send_single(item.product_data, item.cookies))
+            outcome = _outcome(sku, success, "single", None if success else "Kaspi не принял цену")
+        except Exception as e:
+            outcome = _outcome(sku, False, "single", str(e))
+        if not outcome["success"]:
+            self.failed += 1
+        self._resolve(item, outcome)
+        return outcome
+
+    async def close(self):
+        """Публикует всё накопленное, не дожидаясь окон (на shutdown)"""
+        for merchant_id in list(self._batches):
+            await self._flush(merchant_id)
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def get_stats(self) -> Dict:
+        return {
+            "mode": PRICE_PUBLISH_MODE,
+            "pending": sum(len(b) for b in self._batches.values()),
+            "files_uploaded": self.files_uploaded,
+            "file_failures": self.file_failures,
+            "skus_via_file": self.skus_via_file,
+            "skus_via_single": self.skus_via_single,
+            "fallbacks": self.fallbacks,
+            "superseded": self.superseded,
+            "failed": self.failed,
+        }
+
+
+price_publisher = PricePublisher()
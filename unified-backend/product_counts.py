@@ -0,0 +1,92 @@
+# product_counts.py
+# Кэш total для списка товаров (routes/products.list_products) по магазину и фильтру.
+# Раньше каждая страница списка повторяла COUNT(*) с теми же фильтрами — на магазине
+# в 30k товаров это полный проход по его строкам при каждой прокрутке.
+# Счётчик живёт PRODUCT_COUNT_TTL сек (страховка от записей из других процессов)
+# и поддерживается записью в этом процессе:
+#   - синхронизация каталога добавила товары → общий счётчик магазина сдвигается на число
+#     вставленных, отфильтрованные сбрасываются;
+#   - batch_enable/batch_disable → сбрасываются счётчики с фильтром active (и name);
+#   - удаление магазина → сбрасывается всё по магазину.
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+PRODUCT_COUNT_TTL = float(os.getenv("PRODUCT_COUNT_TTL", "60"))  # сек
+PRODUCT_COUNT_MAX_STORES = int(os.getenv("PRODUCT_COUNT_MAX_STORES", "5000"))  # магазинов в кэше
+
+# (имя-фильтр, active-фильтр); (None, None) — все товары магазина
+FilterKey = Tuple[Optional[str], Optional[bool]]
+UNFILTERED: FilterKey = (None, None)
+
+
+class ProductCountCache:
+    def __init__(self, ttl: float = PRODUCT_COUNT_TTL, max_stores: int = PRODUCT_COUNT_MAX_STORES):
+        self.ttl = ttl
+        self.max_stores = max_stores
+        self._stores: Dict[str, Dict[FilterKey, Tuple[float, int]]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.adjustments = 0
+        self.invalidations = 0
+
+    def get(self, store_id, name: Optional[str] = None, active: Optional[bool] = None) -> Optional[int]:
+        entries = self._stores.get(str(store_id))
+        entry = entries.get((name, active)) if entries else None
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, store_id, count: int, name: Optional[str] = None, active: Optional[bool] = None):
+        store_id = str(store_id)
+        entries = self._stores.get(store_id)
+        if entries is None:
+            if len(self._stores) >= self.max_stores:
+                # самый давно добавленный магазин — dict хранит порядок вставки
+                del self._stores[next(iter(self._stores))]
+            entries = self._stores[store_id] = {}
+        entries[(name, active)] = (time.monotonic(), count)
+
+    def adjust(self, store_id, inserted: int):
+        """В магазин добавлено inserted товаров: общий счётчик сдвигаем, прочие сбрасываем"""
+        entries = self._stores.get(str(store_id))
+        if not entries:
+            return
+        total = entries.get(UNFILTERED)
+        entries.clear()
+        if total is not None:
+            # сдвиг не продлевает TTL: счётчик мог уже разойтись с записями других процессов
+            entries[UNFILTERED] = (total[0], total[1] + inserted)
+        self.adjustments += 1
+
+    def invalidate(self, store_id, filtered_only: bool = False):
+        """Сбрасывает счётчики магазина; filtered_only — общий остаётся (число товаров не менялось)"""
+        store_id = str(store_id)
+        entries = self._stores.get(store_id)
+        if not entries:
+            return
+        if filtered_only:
+            total = entries.get(UNFILTERED)
+            entries.clear()
+            if total is not None:
+                entries[UNFILTERED] = total
+        else:
+            del self._stores[store_id]
+        self.invalidations += 1
+
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "stores": len(self._stores),
+            "keys": sum(len(entries) for entries in self._stores.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "adjustments": self.adjustments,
+            "invalidations": self.invalidations,
+        }
+
+
+product_counts = ProductCountCache()
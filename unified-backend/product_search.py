@@ -0,0 +1,155 @@
+# product_search.py
+# Поиск товаров магазина по названию, SKU и категории (миграция 011).
+# Документ товара и запрос нормализуются одинаково (normalize_search_text здесь и
+# product_search_normalize в SQL): регистр, ё/казахские буквы, пунктуация. Совпадение —
+# подстрокой (LIKE '%…%') или с опечатками (pg_trgm word_similarity, оператор <%);
+# оба условия обслуживает GIN-индекс idx_products_search_trgm.
+# Порядок: сначала документы, начинающиеся с запроса, затем по word_similarity.
+# Без миграции (PRODUCT_SEARCH_TRGM=false) и в режиме Supabase — ILIKE по названию/SKU/
+# категории с тем же ранжированием в Python.
+import asyncio
+import os
+import re
+from typing import Dict, List, Optional
+
+import asyncpg
+
+from utils import get_supabase_client
+
+PRODUCT_SEARCH_TRGM = os.getenv("PRODUCT_SEARCH_TRGM", "true").lower() in ("1", "true", "yes")  # false — без миграции 011
+PRODUCT_SEARCH_THRESHOLD = float(os.getenv("PRODUCT_SEARCH_THRESHOLD", "0.4"))  # word_similarity для опечаток
+PRODUCT_SEARCH_CANDIDATES = int(os.getenv("PRODUCT_SEARCH_CANDIDATES", "200"))  # строк на ранжирование в fallback
+
+SEARCH_COLUMNS = "id, kaspi_product_id, name, kaspi_sku, category, price, image_url, bot_active"
+SEARCH_DOCUMENT = "product_search_document(name, kaspi_sku, category)"
+
+# ё и казахские буквы → ближайшие русские; то же в product_search_normalize (миграция 011)
+_SEARCH_FOLD = str.maketrans("ёәғқңөұүһі", "еагкноуухи")
+_SEARCH_TOKEN_RE = re.compile(r"[0-9a-zа-я]+")
+
+TRGM_SEARCH_SQL = f"""
+    SELECT {SEARCH_COLUMNS},
+           word_similarity($2, {SEARCH_DOCUMENT}) AS score
+    FROM products
+    WHERE store_id = $1
+      AND ({SEARCH_DOCUMENT} LIKE '%' || $2 || '%' OR $2 <% {SEARCH_DOCUMENT})
+    ORDER BY {SEARCH_DOCUMENT} LIKE $2 || '%' DESC, score DESC, name, id
+    LIMIT $3
+"""
+
+
+def normalize_search_text(value: Optional[str]) -> str:
+    """Нижний регистр, ё/казахские буквы → русские, всё кроме букв и цифр → пробел"""
+    text = (value or "").lower().translate(_SEARCH_FOLD)
+    return " ".join(_SEARCH_TOKEN_RE.findall(text))
+
+
+def _trigrams(word: str) -> set:
+    # как pg_trgm: слово дополняется двумя пробелами в начале и одним в конце
+    padded = f"  {word} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _score(query: str, document: str) -> float:
+    """Приближение word_similarity: лучшая похожесть запроса на слово документа"""
+    query_trigrams = set().union(*(_trigrams(w) for w in query.split())) if query else set()
+    if not query_trigrams:
+        return 0.0
+    best = 0.0
+    for word in document.split():
+        word_trigrams = _trigrams(word)
+        best = max(best, len(query_trigrams & word_trigrams) / len(query_trigrams | word_trigrams))
+    return 1.0 if query in document else best
+
+
+def _rank(query: str, rows: List[dict], limit: int) -> List[dict]:
+    scored = []
+    for row in rows:
+        document = normalize_search_text(" ".join(str(row.get(c) or "") for c in ("name", "kaspi_sku", "category")))
+        scored.append((document.startswith(query), _score(query, document), row))
+    scored.sort(key=lambda item: (not item[0], -item[1], item[2].get("name") or "", str(item[2].get("id"))))
+    return [{**row, "score": round(score, 3)} for _, score, row in scored[:limit]]
+
+
+class ProductSearch:
+    def __init__(self, trgm: bool = PRODUCT_SEARCH_TRGM, threshold: float = PRODUCT_SEARCH_THRESHOLD):
+        self.trgm = trgm
+        self.threshold = threshold
+        self.queries = 0
+        self.fallback_queries = 0
+        self.total_ms = 0.0
+
+    def document_condition(self, param: int) -> str:
+        """Фильтр «название/SKU/категория содержит $param» для list_products"""
+        if self.trgm:
+            return f"{SEARCH_DOCUMENT} LIKE '%' || ${param} || '%'"
+        return (f"(name ILIKE '%' || ${param} || '%' OR kaspi_sku ILIKE '%' || ${param} || '%'"
+                f" OR category ILIKE '%' || ${param} || '%')")
+
+    def filter_value(self, term: str) -> str:
+        """Значение для document_condition: нормализованное для индекса, экранированное для ILIKE"""
+        if self.trgm:
+            return normalize_search_text(term)
+        return re.sub(r"([%_\\])", r"\\\1", term)
+
+    async def search(self, pool, store_id, query: str, limit: int = 10) -> List[dict]:
+        """Подсказки для строки поиска: до limit товаров магазина по релевантности"""
+        normalized = normalize_search_text(query)
+        if not normalized:
+            return []
+        started = asyncio.get_running_loop().time()
+        self.queries += 1
+        try:
+            if not isinstance(pool, asyncpg.Pool):
+                return await self._search_supabase(store_id, query, normalized, limit)
+            if not self.trgm:
+                return await self._search_ilike(pool, store_id, query, normalized, limit)
+            async with pool.acquire() as conn, conn.transaction():
+                # порог только на эту транзакцию: у соединений пула он остаётся по умолчанию
+                await conn.execute("SELECT set_config('pg_trgm.word_similarity_threshold', $1, true)",
+                                   str(self.threshold))
+                rows = await conn.fetch(TRGM_SEARCH_SQL, str(store_id), normalized, limit)
+            return [{**dict(row), "score": round(float(row["score"]), 3)} for row in rows]
+        finally:
+            self.total_ms += (asyncio.get_running_loop().time() - started) * 1000
+
+    async def _search_ilike(self, pool, store_id, query: str, normalized: str, limit: int) -> List[dict]:
+        self.fallback_queries += 1
+        pattern = f"%{self.filter_value(query.strip())}%"
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(f"""
+                SELECT {SEARCH_COLUMNS}
+                FROM products
+                WHERE store_id = $1
+                  AND (name ILIKE $2 OR kaspi_sku ILIKE $2 OR category ILIKE $2)
+                LIMIT $3
+            """, str(store_id), pattern, PRODUCT_SEARCH_CANDIDATES)
+        return _rank(normalized, [dict(row) for row in rows], limit)
+
+    async def _search_supabase(self, store_id, query: str, normalized: str, limit: int) -> List[dict]:
+        self.fallback_queries += 1
+        # запятые и скобки ломают синтаксис or_() PostgREST
+        term = re.sub(r"[,()%*]", " ", query).strip()
+        supabase = get_supabase_client()
+
+        def fetch():
+            return (supabase.table("products").select(SEARCH_COLUMNS.replace(" ", ""))
+                    .eq("store_id", str(store_id))
+                    .or_(f"name.ilike.*{term}*,kaspi_sku.ilike.*{term}*,category.ilike.*{term}*")
+                    .limit(PRODUCT_SEARCH_CANDIDATES)
+                    .execute())
+
+        # клиент Supabase синхронный — не держим event loop
+        result = await asyncio.to_thread(fetch)
+        return _rank(normalized, result.data or [], limit)
+
+    def get_stats(self) -> Dict:
+        return {
+            "mode": "trgm" if self.trgm else "ilike",
+            "queries": self.queries,
+            "fallback_queries": self.fallback_queries,
+            "avg_ms": round(self.total_ms / self.queries, 2) if self.queries else 0.0,
+        }
+
+
+product_search = ProductSearch()
@@ -1,10 +1,91 @@
 # proxy_balancer.py
+# Выбор прокси из пула шарда с учётом здоровья порта.
+# У каждого прокси — EWMA задержки и доли ошибок, кулдаун после 429/526/403 и
+# circuit breaker: после серии сетевых ошибок порт "открывается" и не получает трафик,
+# по истечении паузы пропускает один пробный запрос (half-open) и по его итогу
+# закрывается или открывается снова на удвоенный срок.
+# Вызывающий код сообщает итог запроса через report(). Состояние цепи меняют только
+# ответы, выданные в CLOSED, и сама проба (_take помечает её словарь ключом "probe");
+# поздние ответы запросов, ушедших до открытия, идут лишь в статистику.
+import os
+import random
 import time
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 
-from proxy_config import (
-    get_pool_size, get_current_index, get_current_proxy, rotate_proxy
-)
+from metrics import proxy_requests_total, proxy_result
+from proxy_config import get_pool_size, get_proxy_pool
+
+PROXY_EWMA_ALPHA = float(os.getenv("PROXY_EWMA_ALPHA", "0.2"))
+PROXY_DEFAULT_LATENCY = float(os.getenv("PROXY_DEFAULT_LATENCY", "1.0"))  # сек, априори для новых портов
+PROXY_SAMPLE_SIZE = int(os.getenv("PROXY_SAMPLE_SIZE", "4"))  # кандидатов на один выбор
+PROXY_CB_FAILURES = int(os.getenv("PROXY_CB_FAILURES", "5"))  # ошибок подряд до открытия
+PROXY_CB_OPEN_SECONDS = float(os.getenv("PROXY_CB_OPEN_SECONDS", "30"))
+PROXY_CB_MAX_OPEN_SECONDS = float(os.getenv("PROXY_CB_MAX_OPEN_SECONDS", "600"))
+PROXY_PROBE_TIMEOUT = 60.0  # сек; проба без report() (упал вызывающий код) не блокирует порт навсегда
+
+# статус ответа Kaspi -> сколько секунд порт отдыхает
+PROXY_COOLDOWNS = {
+    429: float(os.getenv("PROXY_COOLDOWN_429", "60")),  # Too Many Requests
+    526: float(os.getenv("PROXY_COOLDOWN_526", "300")),  # блокировка Cloudflare
+    403: float(os.getenv("PROXY_COOLDOWN_403", "600")),  # бан IP
+}
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+ProxyKey = Tuple[str, int]
+
+
+def _key(proxy: Dict) -> ProxyKey:
+    return proxy['host'], int(proxy['port'])
+
+
+class ProxyHealth:
+    __slots__ = ("latency", "error_rate", "successes", "failures", "consecutive_failures",
+                 "cooldown_until", "state", "open_until", "open_seconds", "probe_started", "probe_id",
+                 "last_status")
+
+    def __init__(self):
+        self.latency = PROXY_DEFAULT_LATENCY
+        self.error_rate = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.state = CLOSED
+        self.open_until = 0.0
+        self.open_seconds = PROXY_CB_OPEN_SECONDS
+        self.probe_started = 0.0
+        self.probe_id = 0
+        self.last_status: Optional[int] = None
+
+    def available(self, now: float) -> bool:
+        if now < self.cooldown_until:
+            return False
+        if self.state == OPEN:
+            if now < self.open_until:
+                return False
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            return now - self.probe_started > PROXY_PROBE_TIMEOUT
+        return True
+
+    def score(self) -> float:
+        # быстрее и надёжнее -> больше вес
+        return 1.0 / (max(self.latency, 0.05) * (1.0 + 10.0 * self.error_rate))
+
+    def as_dict(self, now: float) -> Dict:
+        return {
+            "state": self.state,
+            "latency_ms": round(self.latency * 1000, 1),
+            "error_rate": round(self.error_rate, 4),
+            "successes": self.successes,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "cooldown_left": round(max(0.0, self.cooldown_until - now), 1),
+            "open_left": round(max(0.0, self.open_until - now), 1) if self.state == OPEN else 0.0,
+            "last_status": self.last_status,
+            "score": round(self.score(), 3),
+        }
 
 
 class ProxyBalancer:
@@ -13,8 +94,10 @@ class ProxyBalancer:
         # usage считаем по индексам реального пула
         self.proxy_usage_count = {i: 0 for i in range(n)}
         self.user_proxy_index = {}  # user_id -> pool_index
+        self.health: Dict[ProxyKey, ProxyHealth] = {}
         self.last_reset_time = time.time()
         self.reset_interval = 3600  # сек
+        self._probe_seq = 0
 
     def _tick_reset(self):
         if time.time() - self.last_reset_time > self.reset_interval:
@@ -28,40 +111,155 @@ class ProxyBalancer:
             self.proxy_usage_count[pool_index] = 0
         self.proxy_usage_count[pool_index] += 1
 
+    def _health(self, proxy: Dict) -> ProxyHealth:
+        key = _key(proxy)
+        health = self.health.get(key)
+        if health is None:
+            health = self.health[key] = ProxyHealth()
+        return health
+
+    def _take(self, pool: List[Dict], idx: int) -> Dict:
+        proxy = pool[idx]
+        health = self._health(proxy)
+        self._mark_used(idx)
+        if health.available(time.monotonic()) and health.state == HALF_OPEN:
+            # этот запрос — пробный; следующий пойдёт только после его итога (или PROXY_PROBE_TIMEOUT)
+            self._probe_seq += 1
+            health.probe_id = self._probe_seq
+            health.probe_started = time.monotonic()
+            return {**proxy, "probe": health.probe_id}
+        return proxy
+
+    def _select_index(self, pool: List[Dict]) -> int:
+        """Взвешенный по здоровью выбор среди нескольких случайных доступных портов"""
+        now = time.monotonic()
+        n = len(pool)
+        candidates, weights = [], []
+        for _ in range(PROXY_SAMPLE_SIZE * 4):
+            idx = random.randrange(n)
+            health = self.health.get(_key(pool[idx]))
+            if health is None:
+                candidates.append(idx)
+                weights.append(1.0 / PROXY_DEFAULT_LATENCY)
+            elif health.available(now):
+                candidates.append(idx)
+                weights.append(health.score())
+            if len(candidates) >= PROXY_SAMPLE_SIZE:
+                break
+        if candidates:
+            return random.choices(candidates, weights=weights)[0]
+
+        # выборка не нашла живых — полный проход; если живых нет вовсе, берём порт, который освободится раньше
+        available = [i for i in range(n) if self._health(pool[i]).available(now)]
+        if available:
+            return random.choice(available)
+        return min(range(n), key=lambda i: max(self._health(pool[i]).cooldown_until,
+                                               self._health(pool[i]).open_until))
+
     def get_proxy_for_user(self, user_id: str) -> Dict:
         self._tick_reset()
-        if user_id in self.user_proxy_index:
-            idx = self.user_proxy_index[user_id]
-            self._mark_used(idx)
-            # вернуть актуальный прокси на этом индексе
-            # (если пул перетасовали/пересобрали — поведение детерминированно в рамках жизни процесса)
-            return get_current_proxy() if idx == get_current_index() else rotate_proxy()
-
-        # иначе — отдаём текущий и закрепляем
-        idx = get_current_index()
-        self.user_proxy_index[user_id] = idx
-        self._mark_used(idx)
-        return get_current_proxy()
+        pool = get_proxy_pool()
+        if not pool:
+            raise RuntimeError("PROXY_POOL пуст. Проверь диапазон портов и переменные INSTANCE_INDEX/COUNT.")
+        idx = self.user_proxy_index.get(user_id)
+        if idx is None or idx >= len(pool) or not self._health(pool[idx]).available(time.monotonic()):
+            # первый логин или закреплённый порт болеет — закрепляем новый
+            idx = self._select_index(pool)
+            self.user_proxy_index[user_id] = idx
+        return self._take(pool, idx)
 
     def get_proxy_for_store(self, store_tag: str) -> Dict:
-        """Для магазинов просто крутим round-robin."""
+        """Для магазинов и SKU — взвешенный выбор по здоровью порта."""
         self._tick_reset()
-        p = rotate_proxy()
-        self._mark_used(get_current_index())
-        return p
+        pool = get_proxy_pool()
+        if not pool:
+            raise RuntimeError("PROXY_POOL пуст. Проверь диапазон портов и переменные INSTANCE_INDEX/COUNT.")
+        return self._take(pool, self._select_index(pool))
 
     def get_balanced_proxy(self, identifier: Optional[str] = None) -> Dict:
         if identifier and "@" in identifier:
             return self.get_proxy_for_user(identifier)  # выглядит как email → закрепляем
         return self.get_proxy_for_store(identifier or "generic")
 
+    def report(self, proxy: Optional[Dict], status: Optional[int] = None, latency: Optional[float] = None,
+               error: bool = False):
+        """
+        Итог запроса через прокси.
+        status — HTTP-статус ответа (если он был), latency — сек до ответа,
+        error=True — таймаут или сетевая ошибка (ответа нет).
+        """
+        if not proxy:
+            return
+        proxy_requests_total.inc(port=proxy.get("port"), result=proxy_result(status, error))
+        health = self._health(proxy)
+        now = time.monotonic()
+        health.last_status = status
+
+        if latency is not None:
+            health.latency += PROXY_EWMA_ALPHA * (latency - health.latency)
+
+        cooldown = PROXY_COOLDOWNS.get(status)
+        failed = error or cooldown is not None or (status is not None and status >= 500)
+        health.error_rate += PROXY_EWMA_ALPHA * ((1.0 if failed else 0.0) - health.error_rate)
+
+        if cooldown is not None:
+            health.cooldown_until = max(health.cooldown_until, now + cooldown)
+
+        if failed:
+            health.failures += 1
+        else:
+            health.successes += 1
+
+        if health.state == HALF_OPEN:
+            probe = proxy.get("probe")
+            if probe is None or probe != health.probe_id:
+                # ответ не пробы (запрос ушёл до открытия или проба просрочена) — цепь не трогаем
+                return
+            health.probe_id = 0
+            health.probe_started = 0.0
+            if failed:
+                # проба не прошла — снова открываем, пауза растёт
+                health.open_seconds = min(health.open_seconds * 2, PROXY_CB_MAX_OPEN_SECONDS)
+                health.state = OPEN
+                health.open_until = now + health.open_seconds
+            else:
+                health.state = CLOSED
+                health.open_seconds = PROXY_CB_OPEN_SECONDS
+                health.consecutive_failures = 0
+            return
+
+        if health.state == OPEN:
+            # поздний ответ запроса, выданного до открытия: пауза идёт своим чередом
+            return
+
+        if not failed:
+            health.consecutive_failures = 0
+            return
+        health.consecutive_failures += 1
+        if health.consecutive_failures >= PROXY_CB_FAILURES:
+            health.state = OPEN
+            health.open_until = now + health.open_seconds
+
     def get_stats(self) -> Dict:
         total = sum(self.proxy_usage_count.values())
+        now = time.monotonic()
+        states = {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}
+        cooling = 0
+        proxies = {}
+        for (host, port), health in self.health.items():
+            health.available(now)  # обновит open -> half_open по времени
+            states[health.state] += 1
+            if now < health.cooldown_until:
+                cooling += 1
+            proxies[port] = health.as_dict(now)
         return {
             "total_requests": total,
             "pool_size": get_pool_size(),
             "usage": self.proxy_usage_count,
             "time_to_reset": max(0, self.reset_interval - (time.time() - self.last_reset_time)),
+            "circuits": states,
+            "cooling_down": cooling,
+            "proxies": proxies,
         }
 
 
@@ -59,6 +59,9 @@ def get_current_index() -> int:
 def get_pool_size() -> int:
     return len(PROXY_POOL)
 
+def get_proxy_pool() -> List[Dict]:
+    return PROXY_POOL
+
 def get_proxy_config(proxy: Optional[Dict] = None) -> Dict[str, str]:
     """Конфиг для aiohttp/requests."""
     if not is_proxy_enabled():
@@ -69,5 +72,10 @@ def get_proxy_config(proxy: Optional[Dict] = None) -> Dict[str, str]:
     proxy_url = f"http://{auth}{proxy['host']}:{proxy['port']}"
     return {'http': proxy_url, 'https': proxy_url}
 
+def get_proxy_url(proxy: Optional[Dict] = None) -> Optional[str]:
+    """URL прокси для aiohttp (proxy=...); None — прокси выключены."""
+    cfg = get_proxy_config(proxy)
+    return cfg.get('http') if cfg else None
+
 def is_proxy_enabled() -> bool:
     return os.getenv('USE_PROXY', 'true').lower() == 'true'
@@ -0,0 +1,184 @@
+# rate_governor.py
+# Общий для всех шардов лимит запросов к Kaspi по классам эндпоинтов
+# (offers — публичные офферы, cabinet_write — запись в кабинет продавца, catalog — список товаров).
+# Ведро хранится в Postgres (таблица rate_buckets, миграция 005) как GCRA:
+# tat — момент, с которого свободен следующий токен. Инстанс одним UPDATE резервирует
+# пачку токенов и получает точное время каждого слота, затем раздаёт их локально,
+# засыпая ровно до своего слота — вместо случайных пауз.
+# Если БД недоступна (или это Supabase-адаптер), работает локальное ведро с долей
+# лимита 1/INSTANCE_COUNT.
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+import asyncpg
+
+INSTANCE_COUNT = int(os.getenv("INSTANCE_COUNT", "1"))
+
+# класс эндпоинта -> (токенов в секунду на все шарды, допустимый всплеск в токенах)
+RATE_LIMITS: Dict[str, tuple] = {
+    "offers": (float(os.getenv("RATE_OFFERS_PER_SEC", "20")), float(os.getenv("RATE_OFFERS_BURST", "10"))),
+    "cabinet_write": (float(os.getenv("RATE_CABINET_WRITE_PER_SEC", "5")),
+                      float(os.getenv("RATE_CABINET_WRITE_BURST", "5"))),
+    "catalog": (float(os.getenv("RATE_CATALOG_PER_SEC", "3")), float(os.getenv("RATE_CATALOG_BURST", "3"))),
+}
+RATE_RESERVE_BATCH = int(os.getenv("RATE_RESERVE_BATCH", "5"))  # токенов за один запрос к БД
+RATE_STALE_SLOT = 1.0  # сек сверх допустимого всплеска; более старый слот выбрасываем, иначе после простоя — залп
+RATE_RETRY_SHARED_AFTER = 60.0  # сек в локальном режиме до новой попытки общего ведра
+
+logger = logging.getLogger(__name__)
+
+_UPSERT_SQL = """
+    INSERT INTO rate_buckets (name, rate, burst, tat)
+    VALUES ($1, $2, $3, clock_timestamp())
+    ON CONFLICT (name) DO UPDATE SET rate = EXCLUDED.rate, burst = EXCLUDED.burst
+"""
+
+# резервирует $2 токенов; возвращает, через сколько секунд (по часам БД) освобождается последний
+_RESERVE_SQL = """
+    UPDATE rate_buckets
+    SET tat = GREATEST(tat, clock_timestamp() - make_interval(secs => burst / rate))
+              + make_interval(secs => $2 / rate)
+    WHERE name = $1
+    RETURNING EXTRACT(EPOCH FROM (tat - clock_timestamp()))::float8 AS ends_in, 1.0 / rate AS spacing
+"""
+
+
+class _Bucket:
+    def __init__(self, name: str, rate: float, burst: float):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.slots: Deque[float] = deque()  # time.monotonic() моменты зарезервированных токенов
+        self.lock = asyncio.Lock()
+        self.local_tat = 0.0
+        self.acquired = 0
+        self.reservations = 0
+        self.waited = 0.0
+        self.dropped = 0
+
+    def reserve_local(self, count: int):
+        """То же GCRA, но в памяти и на долю шарда"""
+        rate = self.rate / max(INSTANCE_COUNT, 1)
+        spacing = 1.0 / rate
+        now = time.monotonic()
+        start = max(self.local_tat, now - self.burst / max(INSTANCE_COUNT, 1) * spacing)
+        for i in range(count):
+            self.slots.append(start + i * spacing)
+        self.local_tat = start + count * spacing
+
+
+class RateGovernor:
+    def __init__(self, limits: Dict[str, tuple] = None, reserve_batch: int = RATE_RESERVE_BATCH):
+        limits = limits or RATE_LIMITS
+        self.reserve_batch = reserve_batch
+        self._buckets = {name: _Bucket(name, rate, burst) for name, (rate, burst) in limits.items()}
+        self._pool = None
+        self._shared = True
+        self._shared_retry_at = 0.0
+        self._registered = False
+        self._register_lock: Optional[asyncio.Lock] = None
+        self.fallbacks = 0
+
+    async def _get_pool(self):
+        if self._pool is None:
+            # импорт здесь: db тянет настройки и Supabase-клиент
+            from db import create_pool
+            self._pool = await create_pool()
+        return self._pool
+
+    def _go_local(self, reason):
+        if self._shared:
+            logger.warning(f"Общий лимит запросов недоступен ({reason}), перехожу на локальный")
+            self.fallbacks += 1
+        self._shared = False
+        self._shared_retry_at = time.monotonic() + RATE_RETRY_SHARED_AFTER
+
+    async def _register(self, pool):
+        if self._register_lock is None:
+            self._register_lock = asyncio.Lock()
+        async with self._register_lock:
+            if self._registered:
+                return
+            async with pool.acquire() as connection:
+                for bucket in self._buckets.values():
+                    await connection.execute(_UPSERT_SQL, bucket.name, bucket.rate, bucket.burst)
+            self._registered = True
+
+    async def _reserve_shared(self, bucket: _Bucket, count: int) -> bool:
+        pool = await self._get_pool()
+        if not isinstance(pool, asyncpg.Pool):
+            self._go_local("нет asyncpg-пула")
+            self._shared_retry_at = float("inf")  # Supabase-адаптер — это навсегда
+            return False
+        await self._register(pool)
+        async with pool.acquire() as connection:
+            row = await connection.fetchrow(_RESERVE_SQL, bucket.name, float(count))
+        if row is None:
+            self._registered = False
+            raise RuntimeError(f"ведро {bucket.name} отсутствует в rate_buckets")
+        # переводим время БД в локальные monotonic-часы: расхождение часов хостов не важно
+        last = time.monotonic() + row["ends_in"] - row["spacing"]
+        for i in range(count):
+            bucket.slots.append(last - (count - 1 - i) * row["spacing"])
+        return True
+
+    async def _refill(self, bucket: _Bucket):
+        count = self.reserve_batch
+        bucket.reservations += 1
+        if not self._shared and time.monotonic() >= self._shared_retry_at:
+            self._shared = True
+        if self._shared:
+            try:
+                if await self._reserve_shared(bucket, count):
+                    return
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError, RuntimeError) as e:
+                self._pool = None  # пул могли закрыть/пересоздать — возьмём заново при следующей попытке
+                self._go_local(e)
+        bucket.reserve_local(count)
+
+    async def acquire(self, name: str):
+        """Ждёт свой слот в ведре name. Неизвестный класс не ограничивается."""
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            return
+        stale_after = bucket.burst / bucket.rate + RATE_STALE_SLOT
+        while True:
+            async with bucket.lock:
+                while bucket.slots and bucket.slots[0] < time.monotonic() - stale_after:
+                    bucket.slots.popleft()
+                    bucket.dropped += 1
+                if not bucket.slots:
+                    await self._refill(bucket)
+                if bucket.slots:
+                    slot = bucket.slots.popleft()
+                    break
+        delay = slot - time.monotonic()
+        if delay > 0:
+            bucket.waited += delay
+            await asyncio.sleep(delay)
+        bucket.acquired += 1
+
+    def get_stats(self) -> Dict:
+        return {
+            "mode": "shared" if self._shared else "local",
+            "fallbacks": self.fallbacks,
+            "buckets": {
+                name: {
+                    "rate": b.rate,
+                    "burst": b.burst,
+                    "acquired": b.acquired,
+                    "reservations": b.reservations,
+                    "reserved_ahead": len(b.slots),
+                    "dropped_slots": b.dropped,
+                    "waited_seconds": round(b.waited, 2),
+                }
+                for name, b in self._buckets.items()
+            },
+        }
+
+
+rate_governor = RateGovernor()
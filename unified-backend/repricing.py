@@ -0,0 +1,209 @@
+# repricing.py
+# Решение о новой цене для целой пачки товаров за один векторный проход (NumPy)
+# вместо поштучных Decimal-сравнений на каждый товар.
+#
+# Вход — массивы по товарам: текущая цена, min_profit (пол), max_profit (потолок),
+# стратегия и минимальная цена конкурентов (без нашего собственного оффера).
+# Выход — новые цены в целых тенге и код причины для каждого товара.
+#
+# Стратегии (products.strategy):
+#   become_first — на REPRICE_STEP тенге дешевле самого дешёвого конкурента
+#                  (по умолчанию, в т.ч. "competitive" и пустая стратегия);
+#   equal_price  — ровно цена самого дешёвого конкурента.
+# Цена всегда в пределах [min_profit, max_profit]. Без max_profit демпер цену только
+# снижает (как раньше) — поднимает лишь до min_profit; с потолком — подтягивает цену
+# вверх до цели, если конкуренты подорожали.
+#
+# Отпечаток (fingerprint) — хэш набора офферов конкурентов (merchant_id + цена). Если он
+# совпал с прошлой проверкой, а расчёт снова даёт уже отправленную в кабинет цену
+# (last_submitted_price — подтверждённую поштучно или ушедшую файлом; в products.price
+# её могла затереть синхронизация каталога, пока кабинет не обновился), повторная
+# публикация пропускается (skip) — но только PRICE_PUBLISH_GRACE сек после отправки
+# (last_submitted_at). Дольше расхождение не списать на отставание каталога: цену
+# поправили в кабинете вручную или Kaspi её не принял — публикуем снова.
+import hashlib
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+REPRICE_STEP = int(os.getenv("REPRICE_STEP", "1"))  # тенге, на сколько дешевле лидера
+# сек после отправки цены, пока расхождение с каталогом считаем отставанием; по умолчанию — одна синхронизация
+PRICE_PUBLISH_GRACE = float(os.getenv("PRICE_PUBLISH_GRACE", os.getenv("STORE_SYNC_INTERVAL", "600")))
+
+STRATEGY_BECOME_FIRST = 0
+STRATEGY_EQUAL_PRICE = 1
+STRATEGY_CODES = {
+    "become_first": STRATEGY_BECOME_FIRST,
+    "competitive": STRATEGY_BECOME_FIRST,
+    "equal_price": STRATEGY_EQUAL_PRICE,
+    "equal": STRATEGY_EQUAL_PRICE,
+}
+
+# коды причин в порядке приоритета при расчёте
+REASON_NO_COMPETITORS = 0  # демпинговать не с кем — цена прежняя
+REASON_FLOOR = 1           # цель ниже min_profit — стоим на полу
+REASON_CEILING = 2         # цель выше max_profit — стоим на потолке
+REASON_HOLD = 3            # цена уже на цели (или выше цели нельзя без потолка)
+REASON_RAISE = 4           # конкуренты подорожали — поднимаемся к цели под потолком
+REASON_MATCH = 5           # equal_price: сравнялись с лидером
+REASON_UNDERCUT = 6        # become_first: встали дешевле лидера
+REASON_NAMES = ("no_competitors", "floor", "ceiling", "hold", "raise", "match", "undercut")
+
+
+class RepricingResult(NamedTuple):
+    new_price: np.ndarray         # int64, целые тенге
+    changed: np.ndarray           # bool
+    reason: np.ndarray            # int8, REASON_*
+    competitor_min: np.ndarray    # int64, 0 — конкурентов нет
+    competitor_count: np.ndarray  # int64, без нашего оффера
+    fingerprint: List[Optional[int]]  # None — офферов нет или запрос не удался
+    stable: np.ndarray            # bool, отпечаток совпал с прошлой проверкой
+    skip: np.ndarray              # bool, цена уже опубликована — кабинет не вызываем
+
+
+def strategy_code(strategy: Optional[str]) -> int:
+    return STRATEGY_CODES.get((strategy or "").strip().lower(), STRATEGY_BECOME_FIRST)
+
+
+def offer_fingerprint(offers: List[dict], our_merchant: str) -> int:
+    """Стабильный между процессами 64-битный хэш офферов конкурентов (без нашего)"""
+    pairs = sorted(f"{o['merchant_id']}:{float(o['price']):g}" for o in offers
+                   if str(o["merchant_id"]) != our_merchant)
+    digest = hashlib.blake2b("|".join(pairs).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def competitor_minimum(offer_product: np.ndarray, offer_price: np.ndarray, offer_is_ours: np.ndarray,
+                       size: int):
+    """
+    Минимальная цена и число конкурентов по товарам из плоского списка офферов.
+    offer_product — номер товара в пачке для каждого оффера; наши офферы не считаются.
+    Возвращает (минимум float64 с inf там, где конкурентов нет, количество int64).
+    """
+    mask = ~offer_is_ours
+    products = offer_product[mask]
+    minimum = np.full(size, np.inf)
+    np.minimum.at(minimum, products, offer_price[mask])
+    return minimum, np.bincount(products, minlength=size)
+
+
+def decide_prices(current: np.ndarray, min_profit: np.ndarray, max_profit: np.ndarray,
+                  strategy: np.ndarray, competitor_min: np.ndarray, step: int = REPRICE_STEP):
+    """
+    Векторное решение по пачке. Все массивы одной длины; min_profit/max_profit <= 0 — не задан,
+    competitor_min = inf — конкурентов нет. Возвращает (новая цена int64, причина int8).
+    """
+    current = np.asarray(current, dtype=np.float64)
+    has_competitors = np.isfinite(competitor_min)
+    leader = np.where(has_competitors, competitor_min, 0.0)
+
+    # целые тенге: "дешевле лидера" — ceil(лидер) - шаг, "не дороже лидера" — floor(лидер)
+    target = np.where(strategy == STRATEGY_EQUAL_PRICE, np.floor(leader), np.ceil(leader) - step)
+    floor = np.maximum(np.ceil(np.maximum(min_profit, 0.0)), 1.0)
+    has_ceiling = max_profit > 0
+    ceiling = np.where(has_ceiling, np.floor(max_profit), np.inf)
+
+    clamped = np.maximum(np.minimum(target, ceiling), floor)
+    # без потолка вверх не идём, но цену ниже min_profit всё равно поднимаем до пола
+    new_price = np.where(has_ceiling, clamped, np.minimum(clamped, np.maximum(current, floor)))
+    new_price = np.where(has_competitors, new_price, current)
+
+    reason = np.select(
+        [~has_competitors, target < floor, target > ceiling, new_price == current, new_price > current,
+         strategy == STRATEGY_EQUAL_PRICE],
+        [REASON_NO_COMPETITORS, REASON_FLOOR, REASON_CEILING, REASON_HOLD, REASON_RAISE, REASON_MATCH],
+        default=REASON_UNDERCUT,
+    ).astype(np.int8)
+    return new_price.astype(np.int64), reason
+
+
+class RepricingEngine:
+    def __init__(self, step: int = REPRICE_STEP, publish_grace: float = PRICE_PUBLISH_GRACE):
+        self.step = step
+        self.publish_grace = publish_grace
+        self.batches = 0
+        self.products = 0
+        self.changed = 0
+        self.stable = 0
+        self.skipped = 0
+        self.reasons = [0] * len(REASON_NAMES)
+        self.total_seconds = 0.0
+        self.last_batch_ms = 0.0
+
+    def decide(self, products: Sequence, offers: Sequence[Optional[List[dict]]]) -> RepricingResult:
+        """
+        products — строки из очереди (price, min_profit, max_profit, strategy, merchant_id,
+        competitor_fingerprint, last_submitted_price, last_submitted_at),
+        offers — офферы каждого товара из get_competitor_offers (None — запрос не удался).
+        """
+        started = time.perf_counter()
+        size = len(products)
+        current = np.fromiter((float(p["price"] or 0) for p in products), np.float64, size)
+        min_profit = np.fromiter((float(p.get("min_profit") or 0) for p in products), np.float64, size)
+        max_profit = np.fromiter((float(p.get("max_profit") or 0) for p in products), np.float64, size)
+        strategy = np.fromiter((strategy_code(p.get("strategy")) for p in products), np.int8, size)
+
+        counts = np.fromiter((len(o) if o else 0 for o in offers), np.int64, size)
+        total = int(counts.sum())
+        offer_product = np.repeat(np.arange(size), counts)
+        offer_price = np.fromiter((float(o["price"]) for batch in offers if batch for o in batch),
+                                  np.float64, total)
+        offer_merchant = np.array([str(o["merchant_id"]) for batch in offers if batch for o in batch], dtype=object)
+        our_merchant = np.array([str(p.get("merchant_id") or "") for p in products], dtype=object)
+        offer_is_ours = (offer_merchant == our_merchant[offer_product]) if total else np.zeros(0, dtype=bool)
+
+        competitor_min, competitor_count = competitor_minimum(offer_product, offer_price, offer_is_ours, size)
+        new_price, reason = decide_prices(current, min_profit, max_profit, strategy, competitor_min, self.step)
+
+        fingerprint = [offer_fingerprint(o, our_merchant[i]) if o else None for i, o in enumerate(offers)]
+        stable = np.fromiter((f is not None and f == p.get("competitor_fingerprint")
+                              for f, p in zip(fingerprint, products)), bool, size)
+        submitted = np.fromiter((float(p.get("last_submitted_price") or 0) for p in products), np.float64, size)
+        now = datetime.now(timezone.utc)
+        # без last_submitted_at (цена ещё не отправлялась) — льготы нет
+        submitted_age = np.fromiter(((now - p["last_submitted_at"]).total_seconds()
+                                     if p.get("last_submitted_at") else np.inf for p in products), np.float64, size)
+        changed = new_price != current
+        result = RepricingResult(
+            new_price=new_price,
+            changed=changed,
+            reason=reason,
+            competitor_min=np.where(np.isfinite(competitor_min), np.ceil(competitor_min), 0).astype(np.int64),
+            competitor_count=competitor_count,
+            fingerprint=fingerprint,
+            stable=stable,
+            skip=stable & changed & (new_price == submitted) & (submitted_age < self.publish_grace),
+        )
+
+        elapsed = time.perf_counter() - started
+        self.batches += 1
+        self.products += size
+        self.changed += int(result.changed.sum())
+        self.stable += int(stable.sum())
+        self.skipped += int(result.skip.sum())
+        for code, count in enumerate(np.bincount(reason, minlength=len(REASON_NAMES))):
+            self.reasons[code] += int(count)
+        self.total_seconds += elapsed
+        self.last_batch_ms = elapsed * 1000
+        return result
+
+    def get_stats(self) -> Dict:
+        return {
+            "batches": self.batches,
+            "products": self.products,
+            "changed": self.changed,
+            "stable": self.stable,
+            "skipped": self.skipped,
+            # доля товаров с прежними офферами и доля пропущенных публикаций среди изменённых цен
+            "stable_rate": round(self.stable / self.products, 3) if self.products else 0.0,
+            "skip_rate": round(self.skipped / self.changed, 3) if self.changed else 0.0,
+            "reasons": dict(zip(REASON_NAMES, self.reasons)),
+            "last_batch_ms": round(self.last_batch_ms, 3),
+            "avg_us_per_product": round(self.total_seconds / self.products * 1e6, 2) if self.products else 0.0,
+        }
+
+
+repricing_engine = RepricingEngine()
@@ -0,0 +1,96 @@
+# response_cache.py
+# Кэш готовых JSON-ответов API, ключ — (эндпоинт и параметры, версия данных).
+# Фронтенд постоянно опрашивает статистику магазина, список товаров, предзаказы и сводку
+# админки, а данные между циклами демпера меняются редко. Эндпоинт сначала читает версию
+# (store_versions), затем:
+#   - есть ответ с той же версией, моложе RESPONSE_CACHE_TTL → отдаём его без запросов к БД;
+#   - If-None-Match совпал с ETag ответа → 304 без тела;
+#   - иначе считаем заново и сохраняем.
+# ETag — хэш тела, поэтому 304 честный даже для данных, зависящих от времени (TTL
+# ограничивает, сколько такие данные могут устареть). Версия None — кэш не используется.
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "60"))  # сек, страховка от записей мимо версий
+RESPONSE_CACHE_MAX_SIZE = int(os.getenv("RESPONSE_CACHE_MAX_SIZE", "2000"))  # ответов
+
+CACHE_HEADERS = {"Cache-Control": "no-cache"}  # браузер хранит ответ, но каждый раз спрашивает ETag
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in (tag.strip() for tag in header.split(","))
+
+
+class ResponseCache:
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_size: int = RESPONSE_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        # ключ -> (версия, время сохранения, тело, etag)
+        self._entries: "OrderedDict[str, Tuple[int, float, bytes, str]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    def lookup(self, request: Request, key: str, version: Optional[int]) -> Optional[Response]:
+        """Готовый ответ (200 из кэша или 304) либо None — нужно посчитать и вызвать respond()"""
+        if version is None:
+            self.bypassed += 1
+            return None
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version or time.monotonic() - entry[1] > self.ttl:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        _, _, body, etag = entry
+        if _etag_matches(request, etag):
+            self.not_modified += 1
+            return Response(status_code=304, headers={"ETag": etag, **CACHE_HEADERS})
+        self.hits += 1
+        return Response(content=body, media_type="application/json", headers={"ETag": etag, **CACHE_HEADERS})
+
+    def respond(self, request: Request, key: str, version: Optional[int], data: Any):
+        """Сохраняет посчитанный ответ и отдаёт его с ETag; без версии — data как есть"""
+        if version is None:
+            return data
+        # как JSONResponse FastAPI: одинаковое тело из кэша и без него
+        body = json.dumps(jsonable_encoder(data), ensure_ascii=False, allow_nan=False,
+                          separators=(",", ":")).encode("utf-8")
+        etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+        self._entries[key] = (version, time.monotonic(), body, etag)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        if _etag_matches(request, etag):
+            self.not_modified += 1
+            return Response(status_code=304, headers={"ETag": etag, **CACHE_HEADERS})
+        return Response(content=body, media_type="application/json", headers={"ETag": etag, **CACHE_HEADERS})
+
+    def get_stats(self) -> Dict:
+        lookups = self.hits + self.misses + self.not_modified
+        return {
+            "entries": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "not_modified": self.not_modified,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "evictions": self.evictions,
+            # доля опросов без пересчёта из БД
+            "hit_rate": round((self.hits + self.not_modified) / lookups, 3) if lookups else 0.0,
+        }
+
+
+response_cache = ResponseCache()
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
 from typing import Dict, Any, List
 import asyncio
 import psutil
@@ -8,7 +8,12 @@ from pydantic import BaseModel
 from typing import Dict, Any, Optional
 from datetime import datetime
 
-from db import create_pool
+from browser_pool import browser_pool
+from sms_session_store import sms_session_store
+from session_refresher import session_refresher
+from response_cache import response_cache
+from store_versions import get_global_version, get_version_stats
+from db import create_pool, get_query_stats
 from utils import get_supabase_client
 
 router = APIRouter(prefix="/admin", tags=["admin"])
@@ -116,9 +121,15 @@ async def get_system_health(admin_user_id: str):
     return await get_system_status()
 
 @router.get("/system/stats", response_model=BackendStats)
-async def get_backend_stats(admin_user_id: str):
+async def get_backend_stats(request: Request, admin_user_id: str):
     await verify_admin(admin_user_id)
     try:
+        # сводка по всем магазинам: меняется вместе с версией любого из них
+        version = await get_global_version()
+        cached = response_cache.lookup(request, "admin_stats", version)
+        if cached is not None:
+            return cached
+
         pool = await create_pool()
         
         async with pool.acquire() as conn:
@@ -162,7 +173,7 @@ async def get_backend_stats(admin_user_id: str):
                 "SELECT COALESCE(SUM(price), 0) FROM products"
             )
             
-        return BackendStats(
+        return response_cache.respond(request, "admin_stats", version, BackendStats(
             stores=stores_count or 0,
             products=products_count or 0,
             preorders=preorders_count or 0,
@@ -174,7 +185,7 @@ async def get_backend_stats(admin_user_id: str):
             stores_with_sync=stores_with_sync or 0,
             total_products_value=float(total_value or 0),
             last_updated=datetime.utcnow()
-        )
+        ))
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error getting backend stats: {str(e)}")
@@ -257,6 +268,31 @@ async def get_database_stats(admin_user_id: str):
             last_checked=datetime.utcnow()
         )
 
+@router.get("/system/database/queries")
+async def get_database_query_stats(admin_user_id: str, limit: int = 20):
+    await verify_admin(admin_user_id)
+    return get_query_stats(limit)
+
+@router.get("/system/browser_pool")
+async def get_browser_pool_stats(admin_user_id: str):
+    await verify_admin(admin_user_id)
+    return browser_pool.get_stats()
+
+@router.get("/system/sms_sessions")
+async def get_sms_session_stats(admin_user_id: str):
+    await verify_admin(admin_user_id)
+    return sms_session_store.get_stats()
+
+@router.get("/system/session_refresher")
+async def get_session_refresher_stats(admin_user_id: str):
+    await verify_admin(admin_user_id)
+    return session_refresher.get_stats()
+
+@router.get("/system/response_cache")
+async def get_response_cache_stats(admin_user_id: str):
+    await verify_admin(admin_user_id)
+    return {**response_cache.get_stats(), "versions": get_version_stats()}
+
 @router.get("/system/processes", response_model=List[ProcessStats])
 async def get_process_stats(admin_user_id: str):
     await verify_admin(admin_user_id)
@@ -7,6 +7,8 @@ from pydantic import BaseModel, Field
 from uuid import uuid4
 from typing import Optional
 from db import create_pool
+from product_counts import product_counts
+from store_versions import bump_store_versions
 
 router = APIRouter(prefix="/kaspi/stores", tags=["stores"])
 
@@ -69,6 +71,8 @@ async def create_kaspi_store(store: KaspiStore):
                     """,
                     store.merchant_id, store.name, store.api_key, now, store.user_id
                 )
+                if result:
+                    await bump_store_versions([result["id"]], conn)
             
             logger.info(f"Store updated for user {store.user_id}: {result['id']}")
             return dict(result)
@@ -88,6 +92,8 @@ async def create_kaspi_store(store: KaspiStore):
                     store.merchant_id, store.name, store.api_key, store.products_count, 
                     store.last_sync, store.is_active
                 )
+                if result:
+                    await bump_store_versions([result["id"]], conn)
 
             if not result:
                 logger.error("Ошибка создания магазина: не удалось получить результат")
@@ -184,6 +190,8 @@ async def delete_kaspi_store(store_id: str, user_id: str):
             )
             
             if result == "DELETE 1":
+                product_counts.invalidate(store_id)
+                await bump_store_versions([store_id], conn)
                 logger.info(f"Successfully deleted store {store_id} for user {user_id}")
                 return {
                     "success": True,
@@ -1,9 +1,17 @@
-from fastapi import APIRouter, HTTPException, status, Query
+from fastapi import APIRouter, HTTPException, status, Query, Request
 from pydantic import BaseModel, Field
 from uuid import UUID
 from typing import List, Optional
 from datetime import datetime
+from decimal import Decimal
 from db import create_pool
+from product_counts import product_counts
+from product_search import product_search
+from response_cache import response_cache
+from store_versions import bump_store_versions, get_store_version
+from price_log import merchant_price_history, product_price_history, undercut_timeline
+import base64
+import json
 import logging
 import re
 import time
@@ -67,6 +75,7 @@ class PaginatedProductResponse(BaseModel):
     total: int
     page: int
     page_size: int
+    next_cursor: Optional[str] = None
 
     
 
@@ -98,6 +107,8 @@ async def batch_enable_products(request: BatchProductRequest):
                 WHERE kaspi_product_id = ANY($1) AND store_id = $2
             """
             await conn.execute(query, valid_ids, str(request.store_id))
+            await bump_store_versions([request.store_id], conn)
+        product_counts.invalidate(request.store_id, filtered_only=True)
 
         updated_count = len(valid_ids)
         logger.info(f"Enabled bot_active for {updated_count} products in store {request.store_id}, took {time.time() - start_time:.2f} seconds")
@@ -145,6 +156,8 @@ async def batch_disable_products(request: BatchProductRequest):
                 WHERE kaspi_product_id = ANY($1) AND store_id = $2
             """
             await conn.execute(query, valid_ids, str(request.store_id))
+            await bump_store_versions([request.store_id], conn)
+        product_counts.invalidate(request.store_id, filtered_only=True)
 
         updated_count = len(valid_ids)
         logger.info(f"Disabled bot_active for {updated_count} products in store {request.store_id}, took {time.time() - start_time:.2f} seconds")
@@ -164,18 +177,83 @@ async def batch_disable_products(request: BatchProductRequest):
             detail=f"Internal server error during batch disable: {str(e)}"
         )
 
+# Keyset-пагинация: курсор — непрозрачная строка с (значение колонки сортировки, id)
+# последней отданной строки. Следующая страница — WHERE (колонка, id) «после» курсора
+# по индексу (миграция 010) вместо OFFSET, который перечитывает все предыдущие страницы.
+# NULL в колонке сортировки всегда идут в конце, при равных значениях — id ASC.
+def _encode_cursor(order_by: str, direction: str, row) -> str:
+    value = None if order_by == "id" else row[order_by]
+    if isinstance(value, Decimal):
+        value = str(value)  # numeric-цена: без потери точности, обратно — Decimal
+    payload = {"o": order_by, "d": direction, "v": value, "id": str(row["id"])}
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str, order_by: str, direction: str) -> tuple:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        value, last_id = payload["v"], str(UUID(payload["id"]))
+        if order_by == "price" and value is not None:
+            value = Decimal(str(value))
+        same_order = payload["o"] == order_by and payload["d"] == direction
+    except (ValueError, KeyError, TypeError, ArithmeticError):
+        same_order = False
+    if not same_order:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor for this order_by/order_direction"
+        )
+    return value, last_id
+
+
+def _keyset_condition(order_by: str, direction: str, value, last_id: str, params: list) -> str:
+    """Условие «строго после курсора» для ORDER BY <order_by> <direction> NULLS LAST, id ASC"""
+    if order_by == "id":
+        params.append(last_id)
+        return f"id {'>' if direction == 'ASC' else '<'} ${len(params)}::uuid"
+    params.append(last_id)
+    id_param = len(params)
+    if value is None:
+        return f"({order_by} IS NULL AND id > ${id_param}::uuid)"
+    params.append(value)
+    value_param = f"${len(params)}::{'numeric' if order_by == 'price' else 'boolean'}"
+    return (f"({order_by} {'>' if direction == 'ASC' else '<'} {value_param}"
+            f" OR ({order_by} = {value_param} AND id > ${id_param}::uuid)"
+            f" OR {order_by} IS NULL)")
+
+
 @router.get("/", response_model=PaginatedProductResponse)
 async def list_products(
+    request: Request,
     store_id: UUID = Query(..., description="ID of the store"),
-    name: Optional[str] = Query(None, description="Filter by product name (min 3 characters)"),
+    name: Optional[str] = Query(None, description="Filter by product name, SKU or category (min 3 characters)"),
     active: Optional[bool] = Query(None, description="Filter by bot_active status"),
     order_by: str = Query("id", description="Order by field: id, price, bot_active", regex="^(id|price|bot_active)$"),
     order_direction: OrderDirection = Query(OrderDirection.ASC),
-    page: int = Query(1, ge=1, description="Page number"),
-    page_size: int = Query(20, ge=1, le=100, description="Number of products per page")
+    page: int = Query(1, ge=1, description="Page number (ignored when cursor is given)"),
+    page_size: int = Query(20, ge=1, le=100, description="Number of products per page"),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page")
 ):
     start_time = time.time()
     try:
+        normalized_direction = order_direction.value
+        after = _decode_cursor(cursor, order_by, normalized_direction) if cursor else None
+        name_term = product_search.filter_value(sanitize_name_filter(name)) if name else None
+        if name and not name_term:
+            # "---", "___" и т.п.: после нормализации искать нечего — без 400 вернули бы весь каталог
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Name filter must contain letters or digits"
+            )
+
+        # версия читается до данных: ответ никогда не старше версии, под которой сохранён.
+        # Проверку магазина кэш тоже экономит: удаление магазина поднимает его версию
+        version = await get_store_version(store_id)
+        cache_key = f"products:{store_id}:{request.url.query}"
+        cached = response_cache.lookup(request, cache_key, version)
+        if cached is not None:
+            return cached
+
         if not await validate_store_id(store_id):
             logger.warning(f"Store {store_id} not found")
             raise HTTPException(
@@ -184,90 +262,117 @@ async def list_products(
             )
 
         pool = await create_pool()
-        
-        base_query = """
-            SELECT id, store_id, kaspi_product_id, name, price, image_url, 
-                   category, bot_active, min_profit, max_profit, 
-                   external_kaspi_id, kaspi_sku, strategy
-            FROM products 
-            WHERE store_id = $1
-        """
+
+        filters = "store_id = $1"
         params = [str(store_id)]
-        param_count = 1
 
-        if name:
-            sanitized_name = sanitize_name_filter(name)
-            param_count += 1
-            base_query += f" AND name ILIKE ${param_count}"
-            params.append(f"%{sanitized_name}%")
+        if name_term:
+            # название, SKU или категория; с миграцией 011 — по trgm-индексу
+            params.append(name_term)
+            filters += f" AND {product_search.document_condition(len(params))}"
 
         if active is not None:
-            param_count += 1
-            base_query += f" AND bot_active = ${param_count}"
             params.append(active)
-            
-        normalized_direction = order_direction.value
+            filters += f" AND bot_active = ${len(params)}"
+
+        count_params = list(params)
+        page_filters = filters
+        if after is not None:
+            page_filters += " AND " + _keyset_condition(order_by, normalized_direction, *after, params)
 
         if order_by == "id":
-            base_query += f" ORDER BY id {normalized_direction}"
-        elif order_by == "price":
-            base_query += f" ORDER BY price {normalized_direction}, id ASC"
-        elif order_by == "bot_active":
-            base_query += f" ORDER BY bot_active {normalized_direction}, id ASC"
+            order_clause = f"id {normalized_direction}"
         else:
-            base_query += " ORDER BY id ASC"
-
-        offset = (page - 1) * page_size
-        base_query += f" LIMIT ${param_count + 1} OFFSET ${param_count + 2}"
-        params.extend([page_size, offset])
-
-        async with pool.acquire() as conn:
-            products = await conn.fetch(base_query, *params)
+            order_clause = f"{order_by} {normalized_direction} NULLS LAST, id ASC"
 
-        count_query = """
-            SELECT COUNT(*) as total
+        # на одну строку больше — так понятно, есть ли следующая страница
+        params.append(page_size + 1)
+        query = f"""
+            SELECT id, store_id, kaspi_product_id, name, price, image_url, 
+                   category, bot_active, min_profit, max_profit, 
+                   external_kaspi_id, kaspi_sku, strategy
             FROM products 
-            WHERE store_id = $1
+            WHERE {page_filters}
+            ORDER BY {order_clause}
+            LIMIT ${len(params)}
         """
-        count_params = [str(store_id)]
-        count_param_count = 1
-
-        if name:
-            count_param_count += 1
-            count_query += f" AND name ILIKE ${count_param_count}"
-            count_params.append(f"%{sanitized_name}%")
-
-        if active is not None:
-            count_param_count += 1
-            count_query += f" AND bot_active = ${count_param_count}"
-            count_params.append(active)
+        if after is None:
+            # старые клиенты листают номером страницы
+            params.append((page - 1) * page_size)
+            query += f" OFFSET ${len(params)}"
 
         async with pool.acquire() as conn:
-            count_result = await conn.fetchrow(count_query, *count_params)
-            total = count_result['total'] if count_result else 0
+            products = await conn.fetch(query, *params)
+
+            total = product_counts.get(store_id, name_term, active)
+            if total is None:
+                total = await conn.fetchval(f"SELECT COUNT(*) FROM products WHERE {filters}", *count_params)
+                product_counts.put(store_id, total, name_term, active)
+
+        has_more = len(products) > page_size
+        products = products[:page_size]
+        next_cursor = _encode_cursor(order_by, normalized_direction, products[-1]) if has_more else None
+
+        result = PaginatedProductResponse(
+            products=[dict(product) for product in products],
+            total=total,
+            page=page,
+            page_size=page_size,
+            next_cursor=next_cursor
+        )
+        return response_cache.respond(request, cache_key, version, result)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in list_products: {str(e)}, took {time.time() - start_time:.2f} seconds")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Internal server error during product retrieval: {str(e)}"
+        )
 
-        products_data = [dict(product) for product in products]
+@router.get("/search", response_model=dict)
+async def search_products(
+    store_id: UUID = Query(..., description="ID of the store"),
+    q: str = Query(..., min_length=2, max_length=100, description="Search text: name, SKU or category"),
+    limit: int = Query(10, ge=1, le=50, description="Number of suggestions")
+):
+    start_time = time.time()
+    try:
+        if not await validate_store_id(store_id):
+            logger.warning(f"Store {store_id} not found")
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Store {store_id} not found"
+            )
 
+        pool = await create_pool()
+        products = await product_search.search(pool, store_id, q, limit)
         return {
-            "products": products_data,
-            "total": total,
-            "page": page,
-            "page_size": page_size
+            "query": q,
+            "products": products,
+            "took_ms": round((time.time() - start_time) * 1000, 1)
         }
 
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error in list_products: {str(e)}, took {time.time() - start_time:.2f} seconds")
+        logger.error(f"Error in search_products: {str(e)}, took {time.time() - start_time:.2f} seconds")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Internal server error during product retrieval: {str(e)}"
+            detail=f"Internal server error during product search: {str(e)}"
         )
 
 @router.get("/store_stats", response_model=dict)
-async def get_store_stats(store_id: UUID = Query(..., description="ID of the store")):
+async def get_store_stats(request: Request, store_id: UUID = Query(..., description="ID of the store")):
     start_time = time.time()
     try:
+        version = await get_store_version(store_id)
+        cache_key = f"store_stats:{store_id}"
+        cached = response_cache.lookup(request, cache_key, version)
+        if cached is not None:
+            return cached
+
         if not await validate_store_id(store_id):
             logger.warning(f"Store {store_id} not found")
             raise HTTPException(
@@ -306,7 +411,7 @@ async def get_store_stats(store_id: UUID = Query(..., description="ID of the sto
         }
 
         logger.info(f"Fetched store stats for store {store_id}, took {time.time() - start_time:.2f} seconds")
-        return stats
+        return response_cache.respond(request, cache_key, version, stats)
 
     except HTTPException:
         raise
@@ -379,6 +484,7 @@ async def update_product_strategy(
                     status_code=status.HTTP_404_NOT_FOUND,
                     detail="Продукт не найден в указанном магазине"
                 )
+            await bump_store_versions([store_id], conn)
 
         logger.info(f"Updated product strategy for product {product_id} in store {store_id}, took {time.time() - start_time:.2f} seconds")
         return {
@@ -394,4 +500,108 @@ async def update_product_strategy(
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Internal server error during strategy update: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+
+async def _ensure_store_product(pool, store_id: UUID, product_id: str):
+    if not await validate_store_id(store_id):
+        logger.warning(f"Store {store_id} not found")
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Магазин {store_id} не найден"
+        )
+    async with pool.acquire() as conn:
+        found = await conn.fetchval(
+            "SELECT 1 FROM products WHERE id = $1 AND store_id = $2", product_id, str(store_id)
+        )
+    if not found:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Продукт не найден в указанном магазине"
+        )
+
+
+@router.get("/{product_id}/price_history", response_model=dict)
+async def get_product_price_history(
+    product_id: str,
+    store_id: UUID = Query(..., description="ID of the store"),
+    since: Optional[datetime] = Query(None, description="Start of the window (default: 7 days ago)"),
+    until: Optional[datetime] = Query(None, description="End of the window (default: now)"),
+    limit: int = Query(1000, ge=1, le=10000, description="Max offers returned")
+):
+    """Офферы товара из журнала цен: снимки при каждой смене набора конкурентов"""
+    start_time = time.time()
+    try:
+        pool = await create_pool()
+        await _ensure_store_product(pool, store_id, product_id)
+        history = await product_price_history(pool, product_id, since, until, limit)
+        logger.info(f"Fetched price history for product {product_id}, took {time.time() - start_time:.2f} seconds")
+        return {"product_id": product_id, "offers": history}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in get_product_price_history: {str(e)}, took {time.time() - start_time:.2f} seconds")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Internal server error during price history retrieval: {str(e)}"
+        )
+
+
+@router.get("/{product_id}/undercuts", response_model=dict)
+async def get_product_undercuts(
+    product_id: str,
+    store_id: UUID = Query(..., description="ID of the store"),
+    since: Optional[datetime] = Query(None, description="Start of the window (default: 30 days ago)"),
+    until: Optional[datetime] = Query(None, description="End of the window (default: now)"),
+    limit: int = Query(200, ge=1, le=5000, description="Max events returned")
+):
+    """Кто и когда встал дешевле нас по товару"""
+    start_time = time.time()
+    try:
+        pool = await create_pool()
+        await _ensure_store_product(pool, store_id, product_id)
+        events = await undercut_timeline(pool, product_id, since, until, limit)
+        logger.info(f"Fetched undercut timeline for product {product_id}, took {time.time() - start_time:.2f} seconds")
+        return {"product_id": product_id, "undercuts": events}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in get_product_undercuts: {str(e)}, took {time.time() - start_time:.2f} seconds")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Internal server error during undercut retrieval: {str(e)}"
+        )
+
+
+@router.get("/competitors/{merchant_id}/price_history", response_model=dict)
+async def get_competitor_price_history(
+    merchant_id: str,
+    store_id: UUID = Query(..., description="ID of the store"),
+    since: Optional[datetime] = Query(None, description="Start of the window (default: 7 days ago)"),
+    until: Optional[datetime] = Query(None, description="End of the window (default: now)"),
+    limit: int = Query(1000, ge=1, le=10000, description="Max observations returned")
+):
+    """Цены продавца по товарам магазина из журнала цен"""
+    start_time = time.time()
+    try:
+        if not await validate_store_id(store_id):
+            logger.warning(f"Store {store_id} not found")
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Магазин {store_id} не найден"
+            )
+        pool = await create_pool()
+        history = await merchant_price_history(pool, merchant_id, store_id, since, until, limit)
+        logger.info(f"Fetched price history for merchant {merchant_id}, took {time.time() - start_time:.2f} seconds")
+        return {"merchant_id": merchant_id, "observations": history}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in get_competitor_price_history: {str(e)}, took {time.time() - start_time:.2f} seconds")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Internal server error during price history retrieval: {str(e)}"
+        )
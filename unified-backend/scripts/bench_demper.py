@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Офлайн-бенчмарк пропускной способности демпера.
+
+Поднимает фейковый Kaspi (scripts/fake_kaspi.py, отдельным процессом, с TLS),
+сидирует локальную базу Postgres (по умолчанию demper_bench, схема — из migrations/)
+и гоняет настоящий цикл demper_instance.check_and_update_prices, пока все
+товары не будут обработаны один раз. Kaspi-хосты направляются на стенд через
+KASPI_RESOLVE, прокси выключены, лимиты запросов подняты до небесных.
+
+Отчёт: товаров/сек, p50/p99 по стадиям (из гистограмм metrics.py), запросов к БД
+на товар, запросы к стенду по путям и пиковый RSS процесса демпера.
+
+Подключение к Postgres — как у приложения (POSTGRES_HOST/PORT/USER/PASSWORD).
+База --database пересоздаётся целиком — не указывайте рабочую!
+
+    python scripts/bench_demper.py --products 5000 --stores 20 --latency lognormal:80,0.5 --p429 0.01
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import aiohttp
+import asyncpg
+
+SCRIPTS_DIR = Path(__file__).resolve().parent
+BACKEND_DIR = SCRIPTS_DIR.parent
+sys.path.insert(0, str(BACKEND_DIR))
+sys.path.insert(0, str(SCRIPTS_DIR))
+
+from fake_kaspi import add_stand_arguments, bench_external_id, bench_merchant, bench_sku  # noqa: E402
+
+STAGES = ("queue_wait", "fetch", "parse", "decision", "publish", "db_write")
+MIGRATIONS = ("004_products_sku_store_unique.sql", "005_rate_buckets.sql",
+              "006_products_work_queue.sql", "007_adaptive_check_schedule.sql",
+              "008_competitor_fingerprint.sql", "009_competitor_price_log.sql",
+              "012_store_versions.sql", "013_published_at.sql",
+              "014_session_refresh_claim.sql", "015_last_submitted_price.sql")
+
+# схема до миграций 004+ (в проде таблицы создаёт Supabase); last_check_time — миграция 001
+BASE_SCHEMA = """
+    CREATE TABLE kaspi_stores (
+        id             UUID PRIMARY KEY,
+        user_id        UUID,
+        merchant_id    TEXT,
+        name           TEXT,
+        api_key        TEXT,
+        products_count INTEGER DEFAULT 0,
+        last_sync      TIMESTAMP WITH TIME ZONE,
+        is_active      BOOLEAN DEFAULT TRUE,
+        guid           TEXT,
+        last_login     TIMESTAMP WITH TIME ZONE
+    );
+    CREATE TABLE products (
+        id                UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+        kaspi_product_id  TEXT,
+        kaspi_sku         TEXT,
+        store_id          UUID REFERENCES kaspi_stores (id),
+        price             INTEGER,
+        name              TEXT,
+        external_kaspi_id TEXT,
+        category          TEXT,
+        image_url         TEXT,
+        bot_active        BOOLEAN DEFAULT FALSE,
+        created_at        TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+        updated_at        TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+        min_profit        INTEGER,
+        max_profit        INTEGER,
+        strategy          TEXT,
+        last_check_time   TIMESTAMP WITH TIME ZONE
+    );
+"""
+
+logger = logging.getLogger("bench")
+
+
+def _sql_statements(path: Path):
+    """Файл миграции -> отдельные операторы (CONCURRENTLY нельзя в одной транзакции)"""
+    text = "\n".join(line for line in path.read_text(encoding="utf-8").splitlines()
+                     if not line.strip().startswith("--"))
+    statements, current, quoted = [], [], False
+    for char in text:
+        if char == "'":
+            quoted = not quoted
+        if char == ";" and not quoted:
+            statements.append("".join(current).strip())
+            current = []
+        else:
+            current.append(char)
+    statements.append("".join(current).strip())
+    return [statement for statement in statements if statement]
+
+
+def _pg_kwargs(database: str) -> dict:
+    return {
+        "host": os.getenv("POSTGRES_HOST", "localhost"),
+        "port": int(os.getenv("POSTGRES_PORT", "5432")),
+        "user": os.getenv("POSTGRES_USER", "postgres"),
+        "password": os.getenv("POSTGRES_PASSWORD", ""),
+        "database": database,
+    }
+
+
+async def seed_database(args):
+    admin = await asyncpg.connect(**_pg_kwargs("postgres"))
+    try:
+        await admin.execute(f'DROP DATABASE IF EXISTS "{args.database}" WITH (FORCE)')
+        await admin.execute(f'CREATE DATABASE "{args.database}"')
+    finally:
+        await admin.close()
+
+    conn = await asyncpg.connect(**_pg_kwargs(args.database))
+    try:
+        await conn.execute(BASE_SCHEMA)
+        for name in MIGRATIONS:
+            for statement in _sql_statements(BACKEND_DIR / "migrations" / name):
+                await conn.execute(statement)
+
+        store_ids = [uuid.uuid4() for _ in range(args.stores)]
+        guid = json.dumps({"cookies": [{"name": "mc-session", "value": "bench"}]})
+        await conn.executemany(
+            "INSERT INTO kaspi_stores (id, merchant_id, name, guid, last_login) VALUES ($1, $2, $3, $4, NOW())",
+            [(sid, bench_merchant(i), f"Bench store {i}", guid) for i, sid in enumerate(store_ids)],
+        )
+        indexes = list(range(args.products))
+        await conn.execute(
+            """
+            INSERT INTO products (kaspi_product_id, kaspi_sku, store_id, price, name, external_kaspi_id,
+                                  bot_active, min_profit, next_check_at)
+            SELECT 'OFFER-' || u.j, u.sku, u.store_id, $4, 'Товар ' || u.j, u.ext, TRUE, 0, NOW()
+            FROM unnest($1::int[], $2::text[], $3::uuid[], $5::text[]) AS u(j, sku, store_id, ext)
+            """,
+            indexes,
+            [bench_sku(j) for j in indexes],
+            [store_ids[j % args.stores] for j in indexes],
+            args.our_price,
+            [bench_external_id(j) for j in indexes],
+        )
+        await conn.execute("ANALYZE products")
+    finally:
+        await conn.close()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_for_fake(port: int, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(f"https://127.0.0.1:{port}/__stats", ssl=False) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError("Фейковый Kaspi не поднялся")
+            await asyncio.sleep(0.2)
+
+
+async def _fake_stats(port: int) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"https://127.0.0.1:{port}/__stats", ssl=False) as response:
+            return await response.json()
+
+
+def configure_environment(args, fake_port: int, workdir: str):
+    """Окружение демпера — до импорта его модулей (настройки читаются при импорте)"""
+    os.environ.update({
+        "DB_MODE": "postgres",
+        "POSTGRES_DB": args.database,
+        "ID_IS_UUID": "true",
+        "USE_PROXY": "false",
+        "KASPI_RESOLVE": f"127.0.0.1:{fake_port}",
+        "MAX_CONCURRENT_TASKS": str(args.concurrency),
+        "BATCH_SIZE": str(args.batch_size),
+        "PRICE_PUBLISH_MODE": args.publish_mode,
+        "SYNC_STORES_MODE": "leader" if args.store_sync else "off",
+        # каждый товар — ровно одна проверка за прогон
+        "CHECK_INTERVAL_SECONDS": "86400",
+        "CHECK_INTERVAL_MIN": "86400",
+        "CHECK_INTERVAL_MAX": "86400",
+        "DEMPER_METRICS_PORT": "0",
+        "DEMPER_LOG_FILE": os.path.join(workdir, "price_worker.log"),
+    })
+    for name in ("OFFERS", "CABINET_WRITE", "CATALOG"):
+        os.environ[f"RATE_{name}_PER_SEC"] = "1000000"
+        os.environ[f"RATE_{name}_BURST"] = "1000000"
+
+
+async def run_demper(args) -> dict:
+    import db
+    import demper_instance
+    import metrics
+
+    # демпер пишет в файл; в консоль — только отчёт бенчмарка
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if type(handler) is logging.StreamHandler:
+            root.removeHandler(handler)
+
+    started = time.monotonic()
+    task = asyncio.create_task(demper_instance.check_and_update_prices())
+    processed = 0
+    first_claim = None
+    while processed < args.products:
+        if task.done():
+            task.result()  # пробрасываем ошибку демпера
+            raise RuntimeError("Демпер завершился раньше времени")
+        if time.monotonic() - started > args.timeout:
+            logger.warning(f"Таймаут {args.timeout} сек: обработано {processed} из {args.products}")
+            break
+        if first_claim is None and metrics.queue_claimed_total.total():
+            first_claim = time.monotonic()
+        processed = int(metrics.products_total.total())
+        await asyncio.sleep(0.05)
+    finished = time.monotonic()
+
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+    shutdown = time.monotonic() - finished
+
+    queries = db.get_query_stats(limit=10 ** 6)["queries"]
+    round_trips = sum(q["calls"] for q in queries)
+    elapsed = finished - (first_claim or started)
+    return {
+        "products": processed,
+        "elapsed_seconds": round(elapsed, 2),
+        "startup_seconds": round((first_claim or started) - started, 2),
+        "shutdown_seconds": round(shutdown, 2),
+        "products_per_second": round(processed / elapsed, 1) if elapsed > 0 else None,
+        "outcomes": {labels["outcome"]: int(value) for labels, value in metrics.products_total.samples()},
+        "errors": {f"{labels['stage']}/{labels['type']}": int(value)
+                   for labels, value in metrics.errors_total.samples()},
+        "stages": {
+            stage: {
+                "count": metrics.stage_seconds.count(stage=stage),
+                "p50_ms": _ms(metrics.stage_seconds.quantile(0.5, stage=stage)),
+                "p99_ms": _ms(metrics.stage_seconds.quantile(0.99, stage=stage)),
+            }
+            for stage in STAGES
+        },
+        "db_round_trips": round_trips,
+        "db_round_trips_per_product": round(round_trips / processed, 2) if processed else None,
+        "top_queries": queries[:5],
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def _ms(value):
+    return round(value * 1000, 1) if value is not None else None
+
+
+def print_report(report: dict):
+    print()
+    print(f"Товаров:             {report['products']}")
+    print(f"Время:               {report['elapsed_seconds']} сек "
+          f"(старт {report['startup_seconds']} сек, остановка {report['shutdown_seconds']} сек)")
+    print(f"Товаров/сек:         {report['products_per_second']}")
+    print(f"Запросов к БД:       {report['db_round_trips']} ({report['db_round_trips_per_product']} на товар)")
+    print(f"Пиковый RSS:         {report['peak_rss_mb']} МБ")
+    print(f"Исходы:              {report['outcomes']}")
+    if report["errors"]:
+        print(f"Ошибки:              {report['errors']}")
+    print()
+    print(f"{'стадия':<12}{'кол-во':>10}{'p50, мс':>12}{'p99, мс':>12}   (≈ по корзинам гистограммы)")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<12}{stats['count']:>10}{str(stats['p50_ms']):>12}{str(stats['p99_ms']):>12}")
+    print()
+    print(f"Запросы к стенду:    {report['fake_kaspi']['requests']}")
+    print(f"Статусы стенда:      {report['fake_kaspi']['statuses']}")
+
+
+async def main(args):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [bench] %(message)s")
+    if not args.skip_seed:
+        logger.info(f"Сидируем {args.products} товаров в {args.stores} магазинах (база {args.database})")
+        await seed_database(args)
+
+    fake_port = _free_port()
+    fake_cmd = [
+        sys.executable, str(SCRIPTS_DIR / "fake_kaspi.py"), "--port", str(fake_port),
+        "--latency", args.latency, "--p429", str(args.p429), "--p526", str(args.p526),
+        "--competitors", str(args.competitors), "--our-price", str(args.our_price),
+        "--undercut-ratio", str(args.undercut_ratio), "--payload-pad", str(args.payload_pad),
+        "--catalog-products", str(args.products), "--catalog-stores", str(args.stores),
+    ]
+    fake = subprocess.Popen(fake_cmd, stdout=subprocess.DEVNULL)
+    try:
+        await _wait_for_fake(fake_port)
+        with tempfile.TemporaryDirectory() as workdir:
+            configure_environment(args, fake_port, workdir)
+            # api_parser создаёт рабочие папки в cwd — не мусорим в репозитории
+            os.chdir(workdir)
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                report = await run_demper(args)
+            report["fake_kaspi"] = await _fake_stats(fake_port)
+    finally:
+        fake.terminate()
+        fake.wait(timeout=10)
+
+    report["config"] = {k: v for k, v in vars(args).items()}
+    print_report(report)
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        logger.info(f"Отчёт сохранён: {args.json}")
+
+
+def build_bench_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк демпера")
+    add_stand_arguments(parser)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--stores", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=100, help="MAX_CONCURRENT_TASKS")
+    parser.add_argument("--batch-size", type=int, default=500, help="BATCH_SIZE захвата из очереди")
+    parser.add_argument("--publish-mode", choices=("single", "batch"), default="single")
+    parser.add_argument("--store-sync", action="store_true", help="включить синхронизацию магазинов (лидер)")
+    parser.add_argument("--database", default="demper_bench", help="пересоздаётся при сидировании!")
+    parser.add_argument("--skip-seed", action="store_true")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--json", help="куда сохранить отчёт")
+    return parser
+
+
+if __name__ == "__main__":
+    asyncio.run(main(build_bench_parser().parse_args()))
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Фейковый Kaspi для стенда и бенчмарка демпера (scripts/bench_demper.py).
+
+Отвечает на те же пути, что дёргает демпер:
+  POST /yml/offer-view/offers/{sku}           — офферы конкурентов
+  POST /pricefeed/upload/merchant/process     — публикация цены
+  POST /pricefeed/upload/merchant/upload      — файл цен (PRICE_PUBLISH_MODE=batch)
+  GET  /bff/offer-view/list                   — каталог продавца (синхронизация магазина)
+  GET  /s/m                                   — проверка сессии
+  GET  /__stats                               — счётчики запросов самого стенда
+
+Задержка — распределение ("fixed:50", "uniform:20,120", "lognormal:80,0.5" — медиана мс и сигма),
+429/526 — с заданной вероятностью на офферах. Демпер направляется сюда через KASPI_RESOLVE.
+
+Самостоятельный запуск (TLS обязателен — URL в коде https):
+    python scripts/fake_kaspi.py --port 8443 --latency lognormal:80,0.5 --p429 0.01
+    KASPI_RESOLVE=127.0.0.1:8443 USE_PROXY=false python demper_instance.py
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import ssl
+import subprocess
+import tempfile
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from aiohttp import web
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """Строка распределения -> функция, возвращающая задержку в секундах"""
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0] / 1000
+    if kind == "uniform":
+        low, high = values
+        return lambda: random.uniform(low, high) / 1000
+    if kind == "lognormal":
+        median, sigma = values
+        mu = math.log(median)
+        return lambda: random.lognormvariate(mu, sigma) / 1000
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+
+# Имена сидов бенчмарка: товар j принадлежит магазину j % stores
+def bench_merchant(store_idx: int) -> str:
+    return f"BENCH{store_idx}"
+
+
+def bench_sku(product_idx: int) -> str:
+    return f"BENCH-SKU-{product_idx}"
+
+
+def bench_external_id(product_idx: int) -> str:
+    return str(100000000 + product_idx)
+
+
+def bench_catalog(products: int, stores: int, our_price: int) -> Dict[str, List[dict]]:
+    """Каталог /bff/offer-view/list, совпадающий с сидами bench_demper.py"""
+    catalog: Dict[str, List[dict]] = {}
+    for j in range(products):
+        catalog.setdefault(bench_merchant(j % stores), []).append({
+            "offerId": f"OFFER-{j}",
+            "sku": bench_sku(j),
+            "masterTitle": f"Товар {j}",
+            "masterCategory": "Bench",
+            "minPrice": our_price,
+            "images": ["bench.jpg"],
+            "shopLink": f"/p/bench-{bench_external_id(j)}/",
+        })
+    return catalog
+
+
+def make_self_signed_cert(directory: str) -> ssl.SSLContext:
+    """Самоподписанный сертификат через openssl CLI (cryptography в зависимостях нет)"""
+    cert = Path(directory) / "fake_kaspi.crt"
+    key = Path(directory) / "fake_kaspi.key"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=kaspi.kz", "-keyout", str(key), "-out", str(cert)],
+        check=True, capture_output=True,
+    )
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(str(cert), str(key))
+    return context
+
+
+class FakeKaspi:
+    def __init__(self, latency: str = "fixed:0", p429: float = 0.0, p526: float = 0.0,
+                 competitors: int = 5, our_price: int = 10000, undercut_ratio: float = 0.5,
+                 payload_pad: int = 0, catalog: Optional[Dict[str, List[dict]]] = None):
+        self.latency = parse_latency(latency)
+        self.p429 = p429
+        self.p526 = p526
+        self.competitors = competitors
+        self.our_price = our_price
+        self.undercut_ratio = undercut_ratio
+        self.pad = "x" * payload_pad
+        self.catalog = catalog or {}  # merchant_id -> офферы каталога
+        self.requests: Counter = Counter()
+        self.statuses: Counter = Counter()
+        self.port = 0
+
+    def _rng(self, sku: str) -> random.Random:
+        # офферы SKU детерминированы: повторный запрос видит те же цены
+        return random.Random(int(hashlib.md5(sku.encode()).hexdigest()[:8], 16))
+
+    def competitor_offers(self, sku: str) -> List[dict]:
+        rng = self._rng(sku)
+        undercut = rng.random() < self.undercut_ratio
+        # дешевле нас — демпер будет публиковать цену; иначе цена остаётся
+        low, high = (0.8, 0.99) if undercut else (1.0, 1.3)
+        return [
+            {
+                "merchantId": f"COMP{rng.randrange(10 ** 6)}",
+                "merchantName": f"Конкурент {i}",
+                "price": int(self.our_price * rng.uniform(low, high)),
+                "deliveryDuration": "TOMORROW",
+                "pad": self.pad,
+            }
+            for i in range(self.competitors)
+        ]
+
+    async def _delay(self):
+        delay = self.latency()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _injected_error(self) -> Optional[web.Response]:
+        roll = random.random()
+        if roll < self.p429:
+            return web.Response(status=429, text="Too Many Requests")
+        if roll < self.p429 + self.p526:
+            return web.Response(status=526, text="Invalid SSL certificate")
+        return None
+
+    @web.middleware
+    async def _count(self, request: web.Request, handler):
+        if request.path == "/__stats":
+            return await handler(request)
+        resource = request.match_info.route.resource
+        self.requests[resource.canonical if resource else "404"] += 1
+        response = await handler(request)
+        self.statuses[response.status] += 1
+        return response
+
+    async def offers(self, request: web.Request) -> web.Response:
+        await request.read()
+        await self._delay()
+        error = self._injected_error()
+        if error is not None:
+            return error
+        sku = request.match_info["sku"]
+        return web.json_response({"offers": self.competitor_offers(sku), "total": self.competitors})
+
+    async def price_process(self, request: web.Request) -> web.Response:
+        await request.read()
+        await self._delay()
+        return web.json_response({"status": "success"})
+
+    async def price_upload(self, request: web.Request) -> web.Response:
+        await request.read()
+        await self._delay()
+        return web.json_response({"status": "success"})
+
+    async def offer_list(self, request: web.Request) -> web.Response:
+        await self._delay()
+        merchant = request.query.get("m", "")
+        page = int(request.query.get("p", "0"))
+        limit = int(request.query.get("l", "100"))
+        items = self.catalog.get(merchant, [])
+        return web.json_response({"data": items[page * limit:(page + 1) * limit], "total": len(items)})
+
+    async def session_check(self, request: web.Request) -> web.Response:
+        await self._delay()
+        return web.json_response({"merchants": []})
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._count], client_max_size=50 * 1024 ** 2)
+        app.router.add_post("/yml/offer-view/offers/{sku}", self.offers)
+        app.router.add_post("/pricefeed/upload/merchant/process", self.price_process)
+        app.router.add_post("/pricefeed/upload/merchant/upload", self.price_upload)
+        app.router.add_get("/bff/offer-view/list", self.offer_list)
+        app.router.add_get("/s/m", self.session_check)
+        app.router.add_get("/__stats", self.stats)
+        return app
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.get_stats())
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0,
+                    ssl_context: Optional[ssl.SSLContext] = None) -> web.AppRunner:
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port, ssl_context=ssl_context)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return runner
+
+    def get_stats(self) -> Dict:
+        return {"requests": dict(self.requests), "statuses": {str(k): v for k, v in self.statuses.items()}}
+
+
+async def _serve(args):
+    catalog = bench_catalog(args.catalog_products, args.catalog_stores, args.our_price) \
+        if args.catalog_products else None
+    fake = FakeKaspi(args.latency, args.p429, args.p526, args.competitors, args.our_price,
+                     args.undercut_ratio, args.payload_pad, catalog)
+    with tempfile.TemporaryDirectory() as tmp:
+        runner = await fake.start(args.host, args.port, make_self_signed_cert(tmp))
+        print(f"Фейковый Kaspi: https://{args.host}:{fake.port} (KASPI_RESOLVE={args.host}:{fake.port})")
+        try:
+            while True:
+                await asyncio.sleep(30)
+                print(json.dumps(fake.get_stats(), ensure_ascii=False))
+        finally:
+            await runner.cleanup()
+
+
+def add_stand_arguments(parser: argparse.ArgumentParser):
+    """Параметры поведения стенда — общие с bench_demper.py"""
+    parser.add_argument("--latency", default="lognormal:80,0.5", help="fixed:MS | uniform:A,B | lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--p429", type=float, default=0.0, help="доля ответов 429 на офферах")
+    parser.add_argument("--p526", type=float, default=0.0, help="доля ответов 526 на офферах")
+    parser.add_argument("--competitors", type=int, default=5, help="офферов конкурентов на SKU")
+    parser.add_argument("--our-price", type=int, default=10000)
+    parser.add_argument("--undercut-ratio", type=float, default=0.5, help="доля SKU, где конкурент дешевле нас")
+    parser.add_argument("--payload-pad", type=int, default=0, help="байт балласта в каждом оффере")
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Фейковый Kaspi для стенда демпера")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    add_stand_arguments(parser)
+    parser.add_argument("--catalog-products", type=int, default=0, help="каталог как у сидов bench_demper.py")
+    parser.add_argument("--catalog-stores", type=int, default=1)
+    return parser
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_serve(build_arg_parser().parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,304 @@
+# session_refresher.py
+# Фоновое обновление сессий Kaspi всех магазинов. Раньше перелогин (Playwright, десятки
+# секунд) случался внутри SessionManager.load() — посреди цикла демпера или API-запроса.
+# Теперь раз в SESSION_REFRESH_INTERVAL сек обходим kaspi_stores и:
+#   - сессии старше SESSION_MAX_AGE - SESSION_REFRESH_AHEAD (по last_login) обновляем заранее;
+#   - остальные проверяем запросом /s/m не чаще SESSION_VALIDATE_INTERVAL (вердикты общие
+#     с горячими путями, api_parser._session_verdicts) и перелогиниваем отклонённые;
+#   - магазины, о которых сообщил горячий путь (request), обновляем сразу, не дожидаясь обхода.
+# Без last_login (старые записи) возраст неизвестен — такие магазины только проверяются.
+# Одновременно не больше SESSION_REFRESH_CONCURRENCY логинов; после неудачи — пауза,
+# растущая вдвое до SESSION_REFRESH_BACKOFF_MAX. Свежие cookies публикуются в
+# kaspi_stores.guid (SessionManager.save) — оттуда их берут session_registry других
+# процессов — и сразу в session_registry этого. SessionManager.load() в процессе с
+# запущенным refresher только читает готовую сессию и просит обновить её; в процессах без
+# него (воркеры демпера) перелогинивается сам. Несколько процессов не логинят один магазин
+# дважды: логин идёт под захватом login_claim (kaspi_stores.session_refresh_until,
+# миграция 014) — коротким UPDATE, соединение пула на время логина не держится.
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Set
+
+import asyncpg
+
+from db import create_pool
+from session_registry import session_registry
+
+SESSION_REFRESHER_ENABLED = os.getenv("SESSION_REFRESHER_ENABLED", "true").lower() in ("1", "true", "yes")  # false — логин прямо в load(), как раньше
+SESSION_REFRESH_INTERVAL = float(os.getenv("SESSION_REFRESH_INTERVAL", "60"))  # сек между обходами магазинов
+SESSION_MAX_AGE = float(os.getenv("SESSION_MAX_AGE", "21600"))  # сек, сколько живёт сессия Kaspi после входа
+SESSION_REFRESH_AHEAD = float(os.getenv("SESSION_REFRESH_AHEAD", "1800"))  # сек до истечения, когда пора обновлять
+SESSION_VALIDATE_INTERVAL = float(os.getenv("SESSION_VALIDATE_INTERVAL", "300"))  # сек между проверками /s/m магазина
+SESSION_REFRESH_CONCURRENCY = int(os.getenv("SESSION_REFRESH_CONCURRENCY", "2"))  # логинов одновременно (из BROWSER_POOL_SIZE)
+SESSION_VALIDATE_CONCURRENCY = int(os.getenv("SESSION_VALIDATE_CONCURRENCY", "10"))  # проверок /s/m одновременно
+SESSION_REFRESH_BACKOFF_MAX = float(os.getenv("SESSION_REFRESH_BACKOFF_MAX", "3600"))  # сек, потолок паузы после неудач
+SESSION_REFRESH_CLAIM_SECONDS = float(os.getenv("SESSION_REFRESH_CLAIM_SECONDS", "300"))  # сек, дольше любого логина
+
+logger = logging.getLogger(__name__)
+
+_CLAIM_SQL = """
+    UPDATE kaspi_stores
+    SET session_refresh_until = NOW() + make_interval(secs => $2)
+    WHERE id = $1
+      AND (session_refresh_until IS NULL OR session_refresh_until < NOW())
+    RETURNING id
+"""
+_RELEASE_SQL = "UPDATE kaspi_stores SET session_refresh_until = NULL WHERE id = $1"
+
+_claims_unavailable = False  # нет миграции 014 — логиним без межпроцессного захвата
+
+
+@asynccontextmanager
+async def login_claim(store_id) -> AsyncIterator[bool]:
+    """Захватывает перелогин магазина между процессами; False — магазин логинит другой процесс"""
+    global _claims_unavailable
+    pool = await create_pool()
+    if _claims_unavailable or not store_id or not isinstance(pool, asyncpg.Pool):
+        yield True
+        return
+    try:
+        claimed = await pool.fetchval(_CLAIM_SQL, str(store_id), SESSION_REFRESH_CLAIM_SECONDS) is not None
+    except asyncpg.UndefinedColumnError:
+        _claims_unavailable = True
+        logger.warning("Нет kaspi_stores.session_refresh_until (миграция 014) — перелогин без захвата")
+        yield True
+        return
+    if not claimed:
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        try:
+            await pool.execute(_RELEASE_SQL, str(store_id))
+        except Exception as e:
+            # не снятый захват истечёт сам через SESSION_REFRESH_CLAIM_SECONDS
+            logger.warning(f"Не удалось снять захват перелогина магазина {store_id}: {e}")
+
+
+class StoreState:
+    """Что refresher знает о сессии магазина между обходами"""
+
+    __slots__ = ("store_id", "last_login", "valid", "validated_at", "failures", "retry_at", "refreshed_at")
+
+    def __init__(self, store_id: str):
+        self.store_id = store_id
+        self.last_login = None
+        self.valid: Optional[bool] = None
+        self.validated_at = 0.0
+        self.failures = 0
+        self.retry_at = 0.0
+        self.refreshed_at = 0.0
+
+
+class SessionRefresher:
+    def __init__(self, interval: float = SESSION_REFRESH_INTERVAL, max_age: float = SESSION_MAX_AGE,
+                 ahead: float = SESSION_REFRESH_AHEAD, validate_interval: float = SESSION_VALIDATE_INTERVAL,
+                 concurrency: int = SESSION_REFRESH_CONCURRENCY):
+        self.interval = interval
+        self.refresh_after = max(max_age - ahead, 0.0)
+        self.validate_interval = validate_interval
+        self.concurrency = concurrency
+        self._login_slots = asyncio.Semaphore(concurrency)
+        self._validate_slots = asyncio.Semaphore(SESSION_VALIDATE_CONCURRENCY)
+        self._stores: Dict[str, StoreState] = {}
+        self._refreshing: Set[str] = set()
+        self._urgent_tasks: Set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+        # метрики
+        self.scans = 0
+        self.validations = 0
+        self.invalid_found = 0
+        self.requests = 0
+        self.refreshed: Counter = Counter()  # причина (proactive/invalid/urgent) -> успешных логинов
+        self.failures = 0
+        self.locked_elsewhere = 0
+        self.no_credentials = 0  # магазинов без учётки на последнем обходе
+        self.last_scan_ms = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if SESSION_REFRESHER_ENABLED and not self.running:
+            self._task = asyncio.create_task(self._loop())
+            logger.info(f"Обновление сессий запущено: каждые {self.interval:.0f} сек, "
+                        f"заранее после {self.refresh_after:.0f} сек с входа")
+
+    def request(self, store_id):
+        """Горячий путь нашёл невалидную сессию — обновить вне очереди"""
+        if not store_id or not self.running:
+            # в процессе без refresher SessionManager.load() перелогинивается сам
+            return
+        store_id = str(store_id)
+        if store_id in self._refreshing or self._state(store_id).retry_at > time.monotonic():
+            return
+        self.requests += 1
+        # отдельной задачей: обход с плановыми логинами может идти долго
+        task = asyncio.create_task(self._refresh_urgent(store_id))
+        self._urgent_tasks.add(task)
+        task.add_done_callback(self._urgent_tasks.discard)
+
+    async def _loop(self):
+        while True:
+            started = time.monotonic()
+            try:
+                await self.scan()
+            except Exception as e:
+                logger.error(f"Ошибка обновления сессий: {e}")
+            await asyncio.sleep(max(self.interval - (time.monotonic() - started), 0.0))
+
+    async def scan(self):
+        """Один обход всех магазинов: проверки /s/m и плановые/срочные перелогины"""
+        # импорт здесь: api_parser сам использует refresher
+        from api_parser import SessionManager
+
+        started = time.perf_counter()
+        pool = await create_pool()
+        rows = await pool.fetch("""
+            SELECT id, guid, merchant_id, last_login
+            FROM kaspi_stores
+            WHERE guid IS NOT NULL
+              AND is_active IS NOT FALSE
+        """)
+
+        now = time.monotonic()
+        due, checks = [], []
+        seen = set()
+        no_credentials = 0
+        for row in rows:
+            manager = SessionManager(shop_uid=str(row["id"]))
+            try:
+                manager.apply_row(row)
+                email, password = manager.get_email_password()
+            except Exception as e:
+                logger.warning(f"Не удалось разобрать сессию магазина {row['id']}: {e}")
+                continue
+            seen.add(manager.store_id)
+            state = self._state(manager.store_id)
+            state.last_login = manager.last_login
+            if not email or not password:
+                # без учётки перелогиниться нечем — магазин авторизуется заново сам
+                no_credentials += 1
+                continue
+            if state.retry_at > now:
+                continue
+            if manager.last_login and manager.is_session_expired(self.refresh_after):
+                due.append((manager, "proactive"))
+            elif state.valid is False or now - state.validated_at >= self.validate_interval:
+                checks.append(manager)
+
+        # магазины, удалённые или выключенные с прошлого обхода
+        for store_id in set(self._stores) - seen:
+            del self._stores[store_id]
+
+        verdicts = await asyncio.gather(*(self._validate(m) for m in checks))
+        due.extend((m, "invalid") for m, valid in zip(checks, verdicts) if not valid)
+        await asyncio.gather(*(self._refresh(m, reason) for m, reason in due))
+
+        self.no_credentials = no_credentials
+        self.scans += 1
+        self.last_scan_ms = (time.perf_counter() - started) * 1000
+
+    async def _refresh_urgent(self, store_id: str):
+        from api_parser import SessionManager
+
+        manager = SessionManager(shop_uid=store_id)
+        try:
+            await manager._load_session_data()
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить сессию магазина {store_id}: {e}")
+            return
+        await self._refresh(manager, "urgent")
+
+    def _state(self, store_id: str) -> StoreState:
+        state = self._stores.get(store_id)
+        if state is None:
+            state = self._stores[store_id] = StoreState(store_id)
+        return state
+
+    async def _validate(self, manager) -> bool:
+        async with self._validate_slots:
+            valid = await manager.is_session_valid_async()
+        state = self._state(manager.store_id)
+        state.valid = valid
+        state.validated_at = time.monotonic()
+        self.validations += 1
+        if not valid:
+            self.invalid_found += 1
+        return valid
+
+    async def _refresh(self, manager, reason: str):
+        store_id = manager.store_id
+        if store_id in self._refreshing:
+            return
+        self._refreshing.add(store_id)
+        state = self._state(store_id)
+        try:
+            async with self._login_slots, login_claim(store_id) as claimed:
+                if not claimed:
+                    # этот магазин прямо сейчас обновляет другой процесс
+                    self.locked_elsewhere += 1
+                    return
+                # плановое обновление — даже живой сессии; после отказа Kaspi reauthorize
+                # сам перечитает guid и не станет логиниться, если соседи уже успели
+                ok = await manager.reauthorize(self.refresh_after if reason == "proactive" else None)
+            if not ok:
+                raise RuntimeError("нет учётных данных")
+        except Exception as e:
+            state.failures += 1
+            backoff = min(self.interval * 2 ** state.failures, SESSION_REFRESH_BACKOFF_MAX)
+            state.retry_at = time.monotonic() + backoff
+            self.failures += 1
+            logger.warning(f"Сессия магазина {store_id} не обновлена ({reason}): {e}; "
+                           f"повтор через {backoff:.0f} сек")
+            return
+        finally:
+            self._refreshing.discard(store_id)
+
+        state.failures = 0
+        state.retry_at = 0.0
+        state.valid = True
+        state.validated_at = state.refreshed_at = time.monotonic()
+        state.last_login = manager.last_login
+        self.refreshed[reason] += 1
+        session_registry.put(store_id, manager.get_cookies(), manager.merchant_uid)
+        logger.info(f"Сессия магазина {store_id} обновлена ({reason})")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._urgent_tasks):
+            task.cancel()
+
+    def get_stats(self) -> Dict:
+        now = time.monotonic()
+        return {
+            "enabled": SESSION_REFRESHER_ENABLED,
+            "running": self.running,
+            "stores": len(self._stores),
+            "invalid": sum(1 for s in self._stores.values() if s.valid is False),
+            "backing_off": sum(1 for s in self._stores.values() if s.retry_at > now),
+            "refreshing": len(self._refreshing),
+            "urgent_in_flight": len(self._urgent_tasks),
+            "concurrency": self.concurrency,
+            "refresh_after": self.refresh_after,
+            "scans": self.scans,
+            "validations": self.validations,
+            "invalid_found": self.invalid_found,
+            "requests": self.requests,
+            "refreshed": dict(self.refreshed),
+            "failures": self.failures,
+            "locked_elsewhere": self.locked_elsewhere,
+            "no_credentials": self.no_credentials,
+            "last_scan_ms": round(self.last_scan_ms, 1),
+        }
+
+
+session_refresher = SessionRefresher()
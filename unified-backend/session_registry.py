@@ -0,0 +1,141 @@
+# session_registry.py
+# Внутрипроцессный реестр сессий магазинов: store_id -> cookies + merchant_uid.
+# Горячий путь демпера (sync_product -> get_product_data_from_db) берёт сессию отсюда,
+# а не строит SessionManager (запрос в kaspi_stores + json-декод guid + проверка /s/m)
+# на каждое изменение цены. Проверенная сессия живёт SESSION_TTL секунд, после чего
+# отдаётся как есть и перепроверяется в фоне. 401 от Kaspi сбрасывает запись.
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, Optional, Set
+
+SESSION_TTL = float(os.getenv("SESSION_TTL", "600"))  # сек, сколько доверяем проверке
+SESSION_NEGATIVE_TTL = float(os.getenv("SESSION_NEGATIVE_TTL", "60"))  # сек, кэш "сессии нет"
+
+logger = logging.getLogger(__name__)
+
+
+class StoreSession:
+    """Готовая к использованию сессия магазина"""
+
+    __slots__ = ("store_id", "cookies", "merchant_uid", "validated_at", "valid")
+
+    def __init__(self, store_id: str, cookies: Optional[dict], merchant_uid: Optional[str], valid: bool):
+        self.store_id = store_id
+        self.cookies = cookies
+        self.merchant_uid = merchant_uid
+        self.valid = valid
+        self.validated_at = time.monotonic()
+
+    def age(self) -> float:
+        return time.monotonic() - self.validated_at
+
+
+class SessionRegistry:
+    def __init__(self, ttl: float = SESSION_TTL, negative_ttl: float = SESSION_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: Dict[str, StoreSession] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._refreshing: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.loads = 0
+        self.invalidations = 0
+
+    def _lock_for(self, store_id: str) -> asyncio.Lock:
+        lock = self._locks.get(store_id)
+        if lock is None:
+            lock = self._locks[store_id] = asyncio.Lock()
+        return lock
+
+    async def get(self, store_id) -> Optional[StoreSession]:
+        """
+        Возвращает валидную сессию магазина или None, если её нет
+        (нет учётки для переавторизации / магазин не найден).
+        """
+        store_id = str(store_id)
+        entry = self._entries.get(store_id)
+        if entry is not None:
+            if not entry.valid:
+                if entry.age() < self.negative_ttl:
+                    return None
+            elif entry.age() < self.ttl:
+                self.hits += 1
+                return entry
+            else:
+                # устарела — отдаём текущие cookies, перепроверяем в фоне
+                self.stale_hits += 1
+                self._schedule_refresh(store_id)
+                return entry
+
+        async with self._lock_for(store_id):
+            # пока ждали lock, сессию мог загрузить соседний вызов
+            entry = self._entries.get(store_id)
+            if entry is not None and entry.valid and entry.age() < self.ttl:
+                self.hits += 1
+                return entry
+            entry = await self._load(store_id)
+        return entry if entry.valid else None
+
+    async def _load(self, store_id: str) -> StoreSession:
+        # импорт здесь: api_parser сам использует реестр
+        from api_parser import SessionManager
+
+        self.loads += 1
+        session_manager = SessionManager(shop_uid=store_id)
+        try:
+            valid = bool(await session_manager.load())
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить сессию магазина {store_id}: {e}")
+            valid = False
+
+        entry = StoreSession(
+            store_id,
+            session_manager.get_cookies() if valid else None,
+            session_manager.merchant_uid,
+            valid,
+        )
+        self._entries[store_id] = entry
+        return entry
+
+    def _schedule_refresh(self, store_id: str):
+        if store_id in self._refreshing:
+            return
+        self._refreshing.add(store_id)
+        task = asyncio.create_task(self._refresh(store_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, store_id: str):
+        try:
+            async with self._lock_for(store_id):
+                await self._load(store_id)
+        finally:
+            self._refreshing.discard(store_id)
+
+    def put(self, store_id, cookies: dict, merchant_uid: str):
+        """Кладёт заведомо свежую сессию (например, сразу после логина)"""
+        self._entries[str(store_id)] = StoreSession(str(store_id), cookies, merchant_uid, True)
+
+    def invalidate(self, store_id):
+        """Сбрасывает сессию магазина (Kaspi ответил 401)"""
+        if self._entries.pop(str(store_id), None) is not None:
+            self.invalidations += 1
+            logger.info(f"Сессия магазина {store_id} сброшена")
+
+    def get_stats(self) -> Dict:
+        return {
+            "stores": len(self._entries),
+            "valid": sum(1 for e in self._entries.values() if e.valid),
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "loads": self.loads,
+            "invalidations": self.invalidations,
+            "refreshing": len(self._refreshing),
+        }
+
+
+session_registry = SessionRegistry()
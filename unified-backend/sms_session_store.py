@@ -0,0 +1,167 @@
+# sms_session_store.py
+# Хранилище незавершённых SMS-входов вместо голого словаря sms_sessions в api_parser.
+# Каждая сессия держит открытый контекст браузера (browser_pool) между /sms/start и
+# /sms/verify; брошенные входы раньше жили до рестарта API. Теперь:
+#   - не больше SMS_SESSION_MAX сессий одновременно (вместе с ещё стартующими);
+#   - новый старт при заполненном хранилище ждёт место SMS_ADMISSION_TIMEOUT сек,
+#     потом получает отказ (SmsCapacityError → 503 в api_parser);
+#   - сессия старше SMS_SESSION_TTL закрывается фоновым уборщиком и при обращении.
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+from browser_pool import BrowserLease, browser_pool
+
+SMS_SESSION_MAX = int(os.getenv("SMS_SESSION_MAX", "10"))  # одновременных SMS-входов на процесс
+SMS_SESSION_TTL = float(os.getenv("SMS_SESSION_TTL", "300"))  # сек на ввод кода
+SMS_ADMISSION_TIMEOUT = float(os.getenv("SMS_ADMISSION_TIMEOUT", "5"))  # сек ожидания места; 0 — сразу отказ
+SMS_REAPER_INTERVAL = float(os.getenv("SMS_REAPER_INTERVAL", "15"))  # сек
+
+logger = logging.getLogger(__name__)
+
+
+class SmsCapacityError(Exception):
+    """Все места под SMS-входы заняты"""
+
+
+class SmsSession:
+    __slots__ = ("session_id", "user_id", "lease", "page", "started_at")
+
+    def __init__(self, session_id: str, user_id: str, lease: BrowserLease, page):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.lease = lease
+        self.page = page
+        self.started_at = time.monotonic()
+
+    @property
+    def context(self):
+        return self.lease.context
+
+    def age(self) -> float:
+        return time.monotonic() - self.started_at
+
+
+class SmsSessionStore:
+    def __init__(self, max_sessions: int = SMS_SESSION_MAX, ttl: float = SMS_SESSION_TTL,
+                 admission_timeout: float = SMS_ADMISSION_TIMEOUT):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.admission_timeout = admission_timeout
+        # место занимается до запуска браузера, освобождается при завершении/вытеснении
+        self._slots = asyncio.Semaphore(max_sessions)
+        self._sessions: Dict[str, SmsSession] = {}
+        self._reaper: Optional[asyncio.Task] = None
+        self._waiting = 0
+        self._starting = 0
+        # метрики
+        self.admitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.evicted: Counter = Counter()  # причина -> сколько
+        self.total_admission_wait = 0.0
+
+    async def reserve(self):
+        """Занимает место под новый вход; при заполненном хранилище ждёт или отказывает"""
+        started = time.monotonic()
+        self._waiting += 1
+        try:
+            if self.admission_timeout > 0:
+                await asyncio.wait_for(self._slots.acquire(), timeout=self.admission_timeout)
+            elif self._slots.locked():
+                raise asyncio.TimeoutError
+            else:
+                await self._slots.acquire()
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise SmsCapacityError(f"Одновременно идёт {self.max_sessions} SMS-входов, попробуйте позже")
+        finally:
+            self._waiting -= 1
+        self.total_admission_wait += time.monotonic() - started
+        self.admitted += 1
+        self._starting += 1
+        self._ensure_reaper()
+
+    def cancel_reservation(self):
+        """Старт не удался — место возвращается"""
+        self._starting -= 1
+        self._slots.release()
+
+    def put(self, session_id: str, user_id: str, lease: BrowserLease, page) -> SmsSession:
+        """Регистрирует запущенный вход на занятое через reserve() место"""
+        self._starting -= 1
+        session = self._sessions[session_id] = SmsSession(session_id, user_id, lease, page)
+        return session
+
+    def get(self, session_id: str) -> Optional[SmsSession]:
+        session = self._sessions.get(session_id)
+        if session is not None and session.age() > self.ttl:
+            # уборщик ещё не дошёл — для вызывающего сессии уже нет
+            asyncio.create_task(self.evict(session_id, "expired"))
+            return None
+        return session
+
+    async def finish(self, session_id: str):
+        """Вход завершён — контекст возвращается в пул браузера"""
+        if await self._remove(session_id):
+            self.completed += 1
+
+    async def evict(self, session_id: str, reason: str):
+        if await self._remove(session_id):
+            self.evicted[reason] += 1
+            logger.info(f"SMS-сессия {session_id} закрыта: {reason}")
+
+    async def _remove(self, session_id: str) -> bool:
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        try:
+            await browser_pool.release(session.lease)
+        finally:
+            self._slots.release()
+        return True
+
+    def _ensure_reaper(self):
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(SMS_REAPER_INTERVAL)
+            expired = [sid for sid, s in self._sessions.items() if s.age() > self.ttl]
+            for session_id in expired:
+                try:
+                    await self.evict(session_id, "expired")
+                except Exception as e:
+                    logger.warning(f"Не удалось закрыть SMS-сессию {session_id}: {e}")
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for session_id in list(self._sessions):
+            await self.evict(session_id, "shutdown")
+
+    def get_stats(self) -> Dict:
+        oldest = max((s.age() for s in self._sessions.values()), default=0.0)
+        return {
+            "active": len(self._sessions),
+            "starting": self._starting,
+            "capacity": self.max_sessions,
+            "occupancy": round((len(self._sessions) + self._starting) / self.max_sessions, 3)
+            if self.max_sessions else 0.0,
+            "waiting": self._waiting,
+            "ttl": self.ttl,
+            "oldest_age": round(oldest, 1),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "evicted": dict(self.evicted),
+            "avg_admission_wait": round(self.total_admission_wait / self.admitted, 3) if self.admitted else 0.0,
+        }
+
+
+sms_session_store = SmsSessionStore()
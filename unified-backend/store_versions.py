@@ -0,0 +1,95 @@
+# store_versions.py
+# Версии данных магазинов (миграция 012). Каждый путь записи, который меняет видимое
+# фронтенду (товары, цены, настройки бота, предзаказы, сам магазин), вызывает
+# bump_store_versions; версия берётся из общей последовательности store_version_seq,
+# поэтому она только растёт, а last_value последовательности — глобальная версия.
+# Чтение версии — один поиск по первичному ключу; по ней response_cache решает, годится ли
+# сохранённый ответ. Сбой поднятия версии не ломает запись: ответ устареет по TTL кэша.
+import logging
+import os
+from typing import Dict, Iterable, Optional
+
+import asyncpg
+
+from db import create_pool
+
+STORE_VERSIONS_ENABLED = os.getenv("STORE_VERSIONS_ENABLED", "true").lower() in ("1", "true", "yes")  # false — без миграции 012
+
+logger = logging.getLogger(__name__)
+
+# DISTINCT до nextval: одна новая версия на магазин; порядок id — без взаимных блокировок
+BUMP_SQL = """
+    INSERT INTO store_versions (store_id, version, updated_at)
+    SELECT s.store_id, nextval('store_version_seq'), NOW()
+    FROM (SELECT DISTINCT store_id FROM unnest($1::uuid[]) AS t(store_id) ORDER BY store_id) s
+    ON CONFLICT (store_id) DO UPDATE
+        SET version    = EXCLUDED.version,
+            updated_at = EXCLUDED.updated_at
+"""
+
+stats: Dict[str, int] = {
+    "bumps": 0,  # вызовов bump_store_versions
+    "stores_bumped": 0,
+    "bump_failures": 0,
+    "reads": 0,
+}
+
+
+def get_version_stats() -> Dict:
+    return {**stats, "enabled": STORE_VERSIONS_ENABLED}
+
+
+async def bump_store_versions(store_ids: Iterable, conn=None):
+    """Поднимает версию магазинов после записи; conn — уже взятое соединение, если есть"""
+    store_ids = sorted({str(s) for s in store_ids if s})
+    if not STORE_VERSIONS_ENABLED or not store_ids:
+        return
+    try:
+        if conn is None:
+            pool = await create_pool()
+            if not isinstance(pool, asyncpg.Pool):
+                return
+            async with pool.acquire() as conn:
+                await conn.execute(BUMP_SQL, store_ids)
+        else:
+            await conn.execute(BUMP_SQL, store_ids)
+    except Exception as e:
+        stats["bump_failures"] += 1
+        logger.warning(f"Не удалось поднять версию магазинов {store_ids[:5]}: {e}")
+        return
+    stats["bumps"] += 1
+    stats["stores_bumped"] += len(store_ids)
+
+
+async def get_store_version(store_id) -> Optional[int]:
+    """Текущая версия магазина; None — версий нет (Supabase, без миграции), кэшировать нельзя"""
+    if not STORE_VERSIONS_ENABLED:
+        return None
+    pool = await create_pool()
+    if not isinstance(pool, asyncpg.Pool):
+        return None
+    stats["reads"] += 1
+    try:
+        async with pool.acquire() as conn:
+            version = await conn.fetchval("SELECT version FROM store_versions WHERE store_id = $1", str(store_id))
+    except asyncpg.PostgresError as e:
+        logger.warning(f"Версия магазина {store_id} недоступна: {e}")
+        return None
+    # магазин ещё ни разу не менялся с миграции
+    return version or 0
+
+
+async def get_global_version() -> Optional[int]:
+    """Версия всех данных сразу: растёт вместе с версией любого магазина"""
+    if not STORE_VERSIONS_ENABLED:
+        return None
+    pool = await create_pool()
+    if not isinstance(pool, asyncpg.Pool):
+        return None
+    stats["reads"] += 1
+    try:
+        async with pool.acquire() as conn:
+            return await conn.fetchval("SELECT last_value FROM store_version_seq")
+    except asyncpg.PostgresError as e:
+        logger.warning(f"Глобальная версия недоступна: {e}")
+        return None
@@ -0,0 +1,169 @@
+# work_queue.py
+# Очередь проверок товаров с арендой (lease) вместо шардирования по hashtext(id).
+# Инстанс забирает пачку "созревших" товаров (next_check_at <= now()) через
+# FOR UPDATE SKIP LOCKED и сдвигает им next_check_at на срок аренды — для остальных
+# инстансов товар пропадает из очереди. Пока товар в работе, аренда продлевается;
+# по завершении буфер записи (write_behind) ставит следующий next_check_at и снимает
+# аренду. Если инстанс умер, аренда истекает и товар сам возвращается в очередь.
+# Инстансы можно добавлять и убирать на ходу — INSTANCE_INDEX/COUNT очереди не нужны.
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from typing import Iterable, List, Optional, Set
+
+from metrics import queue_claimed_total
+
+WORK_BATCH_SIZE = int(os.getenv("BATCH_SIZE", "500"))  # товаров за один захват
+WORK_LEASE_SECONDS = float(os.getenv("WORK_LEASE_SECONDS", "120"))
+WORK_CLAIM_CANDIDATES = int(os.getenv("WORK_CLAIM_CANDIDATES", "4"))  # окно кандидатов = пачка * N
+WORK_IDLE_MAX_SLEEP = float(os.getenv("WORK_IDLE_MAX_SLEEP", "30"))  # сек, потолок ожидания пустой очереди
+
+logger = logging.getLogger(__name__)
+
+# из созревших по индексу берём окно кандидатов ($4) и захватываем самые срочные:
+# сильнее всего просроченные относительно своего интервала (волатильный товар,
+# опоздавший на минуту, важнее спокойного, опоздавшего на те же минуту)
+_CLAIM_SQL = """
+    WITH candidates AS (
+        SELECT id
+        FROM products
+        WHERE bot_active = TRUE
+          AND next_check_at <= NOW()
+        ORDER BY next_check_at
+        LIMIT $4
+    ),
+    due AS (
+        SELECT p.id
+        FROM products AS p
+        JOIN candidates AS c ON c.id = p.id
+        WHERE p.next_check_at <= NOW()
+        ORDER BY EXTRACT(EPOCH FROM (NOW() - p.next_check_at)) / GREATEST(p.check_interval_seconds, 1) DESC
+        LIMIT $2
+        FOR UPDATE OF p SKIP LOCKED
+    )
+    UPDATE products AS p
+    SET lease_owner      = $1,
+        lease_expires_at = NOW() + make_interval(secs => $3),
+        next_check_at    = NOW() + make_interval(secs => $3)
+    FROM due
+    WHERE p.id = due.id
+    RETURNING p.id, p.store_id, p.kaspi_sku, p.external_kaspi_id, p.price, p.min_profit,
+              p.max_profit, p.strategy,
+              (SELECT s.merchant_id FROM kaspi_stores AS s WHERE s.id = p.store_id) AS merchant_id,
+              p.last_check_time, p.competitor_min_price, p.competitor_count, p.price_change_score,
+              p.competitor_fingerprint, p.last_published_price, p.last_published_at,
+              p.last_submitted_price, p.last_submitted_at
+"""
+
+_RENEW_SQL = """
+    UPDATE products
+    SET lease_expires_at = NOW() + make_interval(secs => $3),
+        next_check_at    = NOW() + make_interval(secs => $3)
+    WHERE lease_owner = $1
+      AND id = ANY($2::{id_type}[])
+"""
+
+# незавершённые товары при остановке сразу возвращаем в очередь, не дожидаясь истечения аренды
+_RELEASE_SQL = """
+    UPDATE products
+    SET lease_owner      = NULL,
+        lease_expires_at = NULL,
+        next_check_at    = NOW()
+    WHERE lease_owner = $1
+      AND id = ANY($2::{id_type}[])
+"""
+
+_NEXT_DUE_SQL = """
+    SELECT EXTRACT(EPOCH FROM (MIN(next_check_at) - NOW()))::float8
+    FROM products
+    WHERE bot_active = TRUE
+"""
+
+
+def make_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class ProductWorkQueue:
+    def __init__(self, pool, id_is_uuid: bool = True, owner: Optional[str] = None,
+                 batch_size: int = WORK_BATCH_SIZE, lease_seconds: float = WORK_LEASE_SECONDS):
+        self.pool = pool
+        self.owner = owner or make_worker_id()
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        id_type = "uuid" if id_is_uuid else "bigint"
+        self._renew_sql = _RENEW_SQL.format(id_type=id_type)
+        self._release_sql = _RELEASE_SQL.format(id_type=id_type)
+        self._in_progress: Set = set()
+        self._renew_task: Optional[asyncio.Task] = None
+        self.claimed = 0
+        self.renewals = 0
+
+    def start(self):
+        if self._renew_task is None:
+            self._renew_task = asyncio.create_task(self._renew_loop())
+
+    async def claim(self, limit: Optional[int] = None) -> List:
+        """Забирает до limit созревших товаров в аренду"""
+        limit = limit or self.batch_size
+        async with self.pool.acquire() as connection:
+            rows = await connection.fetch(_CLAIM_SQL, self.owner, limit, self.lease_seconds,
+                                          limit * WORK_CLAIM_CANDIDATES)
+        self._in_progress.update(row["id"] for row in rows)
+        self.claimed += len(rows)
+        queue_claimed_total.inc(len(rows))
+        return rows
+
+    def done(self, product_ids: Iterable):
+        """Товар обработан — аренду больше не продлеваем (снимет её буфер записи)"""
+        for product_id in product_ids:
+            self._in_progress.discard(product_id)
+
+    async def renew(self):
+        if not self._in_progress:
+            return
+        async with self.pool.acquire() as connection:
+            await connection.execute(self._renew_sql, self.owner, list(self._in_progress), self.lease_seconds)
+        self.renewals += 1
+
+    async def _renew_loop(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self.renew()
+            except Exception as e:
+                logger.error(f"Не удалось продлить аренду {len(self._in_progress)} товаров: {e}")
+
+    async def seconds_until_due(self) -> float:
+        """Сколько ждать до следующего созревшего товара (0..WORK_IDLE_MAX_SLEEP)"""
+        async with self.pool.acquire() as connection:
+            wait = await connection.fetchval(_NEXT_DUE_SQL)
+        if wait is None:
+            return WORK_IDLE_MAX_SLEEP
+        return min(max(wait, 0.0), WORK_IDLE_MAX_SLEEP)
+
+    async def close(self):
+        """Останавливает продление и отпускает незавершённые товары (на shutdown)"""
+        if self._renew_task is not None:
+            self._renew_task.cancel()
+            try:
+                await self._renew_task
+            except asyncio.CancelledError:
+                pass
+            self._renew_task = None
+        if self._in_progress:
+            async with self.pool.acquire() as connection:
+                await connection.execute(self._release_sql, self.owner, list(self._in_progress))
+            logger.info(f"Возвращено в очередь незавершённых товаров: {len(self._in_progress)}")
+            self._in_progress.clear()
+
+    def get_stats(self) -> dict:
+        return {
+            "owner": self.owner,
+            "claimed": self.claimed,
+            "in_progress": len(self._in_progress),
+            "renewals": self.renewals,
+            "lease_seconds": self.lease_seconds,
+        }
@@ -0,0 +1,203 @@
+# write_behind.py
+# Отложенная пакетная запись результатов демпера в products.
+# демпер (apply_decision) не делает UPDATE на каждый товар, а кладёт (id, новая цена, время проверки,
+# следующая проверка и её обоснование из check_scheduler) в буфер; буфер сбрасывается одним UPDATE … FROM unnest(...) по размеру
+# пачки или по таймеру, а на остановке воркера дописывается до конца.
+# Аренду товара (work_queue) запись снимает, только если она всё ещё наша.
+# Пачка с новыми ценами поднимает версии своих магазинов (store_versions).
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from check_scheduler import Schedule
+from metrics import stage_seconds
+from store_versions import bump_store_versions
+
+WRITE_BUFFER_MAX_BATCH = int(os.getenv("WRITE_BUFFER_MAX_BATCH", "500"))  # строк на один UPDATE
+WRITE_BUFFER_FLUSH_INTERVAL = float(os.getenv("WRITE_BUFFER_FLUSH_INTERVAL", "2"))  # сек
+
+logger = logging.getLogger(__name__)
+
+# price = NULL — цену не трогаем, только отмечаем проверку;
+# last_submitted_price/_at — любая записанная цена (демпер пишет только отправленные в кабинет);
+# last_published_price/_at — только если кабинет подтвердил цену (published; файлом — нет)
+_UPDATE_SQL = """
+    UPDATE products AS p
+    SET price            = COALESCE(u.price, p.price),
+        last_published_price = CASE WHEN u.published THEN u.price ELSE p.last_published_price END,
+        last_published_at    = CASE WHEN u.published THEN u.checked_at ELSE p.last_published_at END,
+        last_submitted_price = COALESCE(u.price, p.last_submitted_price),
+        last_submitted_at    = CASE WHEN u.price IS NOT NULL THEN u.checked_at ELSE p.last_submitted_at END,
+        last_check_time  = u.checked_at,
+        next_check_at    = CASE WHEN p.lease_owner IS NOT DISTINCT FROM $5::text
+                                THEN COALESCE(u.next_check_at, p.next_check_at) ELSE p.next_check_at END,
+        lease_owner      = CASE WHEN p.lease_owner IS NOT DISTINCT FROM $5::text
+                                THEN NULL ELSE p.lease_owner END,
+        lease_expires_at = CASE WHEN p.lease_owner IS NOT DISTINCT FROM $5::text
+                                THEN NULL ELSE p.lease_expires_at END,
+        check_interval_seconds = COALESCE(u.check_interval, p.check_interval_seconds),
+        competitor_min_price   = COALESCE(u.competitor_min_price, p.competitor_min_price),
+        competitor_count       = COALESCE(u.competitor_count, p.competitor_count),
+        price_change_score     = COALESCE(u.price_change_score, p.price_change_score),
+        competitor_fingerprint = COALESCE(u.competitor_fingerprint, p.competitor_fingerprint)
+    FROM unnest($1::{id_type}[], $2::int[], $3::timestamptz[], $4::timestamptz[],
+                $6::int[], $7::int[], $8::int[], $9::real[], $10::bigint[], $11::bool[])
+             AS u(id, price, checked_at, next_check_at, check_interval,
+                  competitor_min_price, competitor_count, price_change_score, competitor_fingerprint,
+                  published)
+    WHERE p.id = u.id
+    RETURNING p.store_id, u.price IS NOT NULL AS repriced
+"""
+
+
+def _merge_pending(older: Optional[tuple], newer: tuple) -> tuple:
+    """Более новая запись по товару перекрывает прежнюю, но проверка без смены цены
+    (price None) не затирает ещё не записанную новую цену и её флаг published"""
+    if older is None or newer[0] is not None or older[0] is None:
+        return newer
+    return (older[0],) + newer[1:4] + (older[4],)
+
+
+class ProductWriteBuffer:
+    def __init__(self, pool, id_is_uuid: bool = True, owner: Optional[str] = None,
+                 max_batch: int = WRITE_BUFFER_MAX_BATCH, flush_interval: float = WRITE_BUFFER_FLUSH_INTERVAL):
+        self.pool = pool
+        self.owner = owner  # lease_owner воркера из work_queue
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._sql = _UPDATE_SQL.format(id_type="uuid" if id_is_uuid else "bigint")
+        # id -> (цена или None, время проверки, следующая проверка, расписание, цена подтверждена кабинетом);
+        # повторная запись по id перекрывает прежнюю
+        self._pending: Dict[object, Tuple[Optional[int], datetime, Optional[datetime], Optional[Schedule], bool]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+        # метрики
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.failures = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def add(self, product_id, new_price: Optional[int] = None, checked_at: Optional[datetime] = None,
+            next_check_at: Optional[datetime] = None, schedule: Optional[Schedule] = None,
+            published: bool = True):
+        """
+        Ставит запись в очередь; сам UPDATE выполнит фоновый сброс.
+        published=False — цена ушла без подтверждения кабинета и не станет last_published_price.
+        """
+        if self._closed:
+            raise RuntimeError("ProductWriteBuffer закрыт")
+        checked_at = checked_at or datetime.now(timezone.utc)
+        if schedule is not None and next_check_at is None:
+            next_check_at = schedule.next_check_at
+        self._pending[product_id] = _merge_pending(
+            self._pending.get(product_id),
+            (new_price, checked_at, next_check_at, schedule, published and new_price is not None))
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка фонового сброса буфера цен: {e}")
+
+    async def flush(self) -> int:
+        """Записывает всё накопленное пачками по max_batch. Возвращает число строк."""
+        written = 0
+        async with self._flush_lock:
+            while self._pending:
+                batch, self._pending = self._pending, {}
+                items = list(batch.items())
+                for i in range(0, len(items), self.max_batch):
+                    chunk = items[i:i + self.max_batch]
+                    try:
+                        await self._write(chunk)
+                    except Exception:
+                        self.failures += 1
+                        # возвращаем неудачную и оставшиеся пачки; более свежие записи главнее,
+                        # но цену из неудачной пачки (уже опубликованную) не теряем
+                        for product_id, value in items[i:]:
+                            newer = self._pending.get(product_id)
+                            self._pending[product_id] = value if newer is None else _merge_pending(value, newer)
+                        raise
+                    written += len(chunk)
+        return written
+
+    async def _write(self, chunk):
+        started = time.monotonic()
+        schedules = [schedule for _, (_, _, _, schedule, _) in chunk]
+        async with self.pool.acquire() as connection:
+            rows = await connection.fetch(
+                self._sql,
+                [product_id for product_id, _ in chunk],
+                [price for _, (price, _, _, _, _) in chunk],
+                [checked_at for _, (_, checked_at, _, _, _) in chunk],
+                [next_check_at for _, (_, _, next_check_at, _, _) in chunk],
+                self.owner,
+                [s.interval if s else None for s in schedules],
+                [s.competitor_min_price if s else None for s in schedules],
+                [s.competitor_count if s else None for s in schedules],
+                [s.price_change_score if s else None for s in schedules],
+                [s.competitor_fingerprint if s else None for s in schedules],
+                [published for _, (_, _, _, _, published) in chunk],
+            )
+            # новые цены видны фронтенду — версия магазина для кэша ответов API
+            repriced = {row["store_id"] for row in rows if row["repriced"]}
+            if repriced:
+                await bump_store_versions(repriced, connection)
+        elapsed_ms = (time.monotonic() - started) * 1000
+        stage_seconds.observe(elapsed_ms / 1000, stage="db_write")
+        self.flushes += 1
+        self.rows_flushed += len(chunk)
+        self.last_batch_size = len(chunk)
+        self.max_batch_size = max(self.max_batch_size, len(chunk))
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self.total_flush_ms += elapsed_ms
+
+    async def close(self):
+        """Останавливает фоновый сброс и дописывает остаток (на shutdown)"""
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pending:
+            written = await self.flush()
+            logger.info(f"Буфер цен сброшен при остановке: {written} строк")
+
+    def get_stats(self) -> Dict:
+        return {
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "rows_flushed": self.rows_flushed,
+            "failures": self.failures,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "avg_batch_size": round(self.rows_flushed / self.flushes, 1) if self.flushes else 0.0,
+            "last_flush_ms": round(self.last_flush_ms, 1),
+            "max_flush_ms": round(self.max_flush_ms, 1),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 1) if self.flushes else 0.0,
+        }